@@ -1,10 +1,37 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
 import os
 import requests
-from github import Github
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from github import Github, GithubException, InputGitAuthor, InputGitTreeElement
+from github.Requester import Requester
 import base64
+import json
+import threading
+import time
+import hashlib
+import tempfile
+import bisect
+import heapq
+import fnmatch
+import mimetypes
+import fcntl
+import contextvars
+import contextlib
+import shutil
+import subprocess
+import tarfile
+import re
+import socket
+from urllib.parse import quote, unquote, urlparse, parse_qs, urlencode
+from array import array
+from collections import OrderedDict, deque
+from queue import Queue, Empty
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
@@ -14,51 +41,57 @@ NEBIUS_API_KEY = os.environ.get('NEBIUS_API_KEY')
 NEBIUS_API_URL = os.environ.get('NEBIUS_API_URL', 'https://api.studio.nebius.ai/v1/chat/completions')
 OLLAMA_API_URL = os.environ.get('OLLAMA_API_URL', 'https://llm.windowwanker.com/v1/chat/completions')
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
 GITHUB_EMAIL = os.environ.get('GITHUB_EMAIL', 'your-email@example.com')
 GITHUB_NAME = os.environ.get('GITHUB_NAME', 'Your Name')
 
 # Initialize GitHub client
-github_client = Github(GITHUB_TOKEN) if GITHUB_TOKEN else None
+github_client = Github(GITHUB_TOKEN, base_url=GITHUB_API_URL) if GITHUB_TOKEN else None
 
 # Local Ollama models (FREE)
-# supports_tools=True marks models with reliable OpenAI-compatible function calling
+# supports_tools=True marks models with reliable OpenAI-compatible function calling.
+# context_window should match the num_ctx the Ollama server runs models with.
+# max_concurrency caps requests in flight per model (default LOCAL_MAX_CONCURRENCY);
+# see the local model admission section below.
+LOCAL_CONTEXT_WINDOW = int(os.environ.get('LOCAL_CONTEXT_WINDOW', '8192'))
 LOCAL_MODELS = [
-    {"id": "local/llama3.1:8b", "name": "Llama 3.1 8B", "provider": "Local", "ollama_id": "llama3.1:8b", "tier": "free", "supports_tools": True},
-    {"id": "local/mistral:7b-instruct", "name": "Mistral 7B Instruct", "provider": "Local", "ollama_id": "mistral:7b-instruct", "tier": "free", "supports_tools": False},
-    {"id": "local/qwen2.5:latest", "name": "Qwen 2.5", "provider": "Local", "ollama_id": "qwen2.5:latest", "tier": "free", "supports_tools": True},
-    {"id": "local/qwen2.5-coder:7b", "name": "Qwen 2.5 Coder 7B", "provider": "Local", "ollama_id": "qwen2.5-coder:7b", "tier": "free", "supports_tools": True},
-    {"id": "local/deepseek-coder:6.7b", "name": "DeepSeek Coder 6.7B", "provider": "Local", "ollama_id": "deepseek-coder:6.7b", "tier": "free", "supports_tools": False},
-    {"id": "local/nous-hermes2:latest", "name": "Nous Hermes 2", "provider": "Local", "ollama_id": "nous-hermes2:latest", "tier": "free", "supports_tools": False},
-    {"id": "local/gemma-3-12b-abliterated", "name": "Gemma 3 12B Abliterated", "provider": "Local", "ollama_id": "hf.co/mlabonne/gemma-3-12b-it-abliterated-GGUF:Q4_K_M", "tier": "free", "supports_tools": False},
-    {"id": "local/bakllava:latest", "name": "BakLLaVA (Vision)", "provider": "Local", "ollama_id": "bakllava:latest", "tier": "free", "supports_tools": False},
+    {"id": "local/llama3.1:8b", "name": "Llama 3.1 8B", "provider": "Local", "ollama_id": "llama3.1:8b", "tier": "free", "supports_tools": True, "context_window": LOCAL_CONTEXT_WINDOW},
+    {"id": "local/mistral:7b-instruct", "name": "Mistral 7B Instruct", "provider": "Local", "ollama_id": "mistral:7b-instruct", "tier": "free", "supports_tools": False, "context_window": LOCAL_CONTEXT_WINDOW, "bytes_per_token": 3.0},
+    {"id": "local/qwen2.5:latest", "name": "Qwen 2.5", "provider": "Local", "ollama_id": "qwen2.5:latest", "tier": "free", "supports_tools": True, "context_window": LOCAL_CONTEXT_WINDOW},
+    {"id": "local/qwen2.5-coder:7b", "name": "Qwen 2.5 Coder 7B", "provider": "Local", "ollama_id": "qwen2.5-coder:7b", "tier": "free", "supports_tools": True, "context_window": LOCAL_CONTEXT_WINDOW},
+    {"id": "local/deepseek-coder:6.7b", "name": "DeepSeek Coder 6.7B", "provider": "Local", "ollama_id": "deepseek-coder:6.7b", "tier": "free", "supports_tools": False, "context_window": LOCAL_CONTEXT_WINDOW, "bytes_per_token": 3.0},
+    {"id": "local/nous-hermes2:latest", "name": "Nous Hermes 2", "provider": "Local", "ollama_id": "nous-hermes2:latest", "tier": "free", "supports_tools": False, "context_window": LOCAL_CONTEXT_WINDOW, "bytes_per_token": 3.0},
+    {"id": "local/gemma-3-12b-abliterated", "name": "Gemma 3 12B Abliterated", "provider": "Local", "ollama_id": "hf.co/mlabonne/gemma-3-12b-it-abliterated-GGUF:Q4_K_M", "tier": "free", "supports_tools": False, "context_window": LOCAL_CONTEXT_WINDOW, "max_concurrency": 1},
+    {"id": "local/bakllava:latest", "name": "BakLLaVA (Vision)", "provider": "Local", "ollama_id": "bakllava:latest", "tier": "free", "supports_tools": False, "context_window": LOCAL_CONTEXT_WINDOW, "bytes_per_token": 3.0, "max_concurrency": 1},
 ]
 
-# Available models (Nebius cloud - PAID per token) with correct IDs from their API docs
+# Available models (Nebius cloud - PAID per token) with correct IDs from their API docs.
+# context_window is the model's maximum context length in tokens.
 NEBIUS_MODELS = [
-    {"id": "MiniMaxAI/MiniMax-M2.1", "name": "MiniMax-M2.1", "provider": "Minimax", "tier": "paid"},
-    {"id": "zai-org/GLM-4.7-FP8", "name": "GLM-4.7", "provider": "Z.ai", "tier": "paid"},
-    {"id": "deepseek-ai/DeepSeek-V3.2", "name": "DeepSeek-V3.2", "provider": "DeepSeek", "tier": "paid"},
-    {"id": "openai/gpt-oss-120b", "name": "gpt-oss-120b", "provider": "OpenAI", "tier": "paid"},
-    {"id": "moonshotai/Kimi-K2-Instruct", "name": "Kimi-K2-Instruct", "provider": "Moonshot AI", "tier": "paid"},
-    {"id": "moonshotai/Kimi-K2-Thinking", "name": "Kimi-K2-Thinking", "provider": "Moonshot AI", "tier": "paid"},
-    {"id": "Qwen/Qwen3-Coder-480B-A35B-Instruct", "name": "Qwen3-Coder-480B-A35B-Instruct", "provider": "Qwen", "tier": "paid"},
-    {"id": "NousResearch/Hermes-4-405B", "name": "Hermes-4-405B", "provider": "NousResearch", "tier": "paid"},
-    {"id": "NousResearch/Hermes-4-70B", "name": "Hermes-4-70B", "provider": "NousResearch", "tier": "paid"},
-    {"id": "openai/gpt-oss-20b", "name": "gpt-oss-20b", "provider": "OpenAI", "tier": "paid"},
-    {"id": "zai-org/GLM-4.5", "name": "GLM-4.5", "provider": "Z.ai", "tier": "paid"},
-    {"id": "zai-org/GLM-4.5-Air", "name": "GLM-4.5-Air", "provider": "Z.ai", "tier": "paid"},
-    {"id": "PrimeIntellect/INTELLECT-3", "name": "INTELLECT-3", "provider": "Prime Intellect", "tier": "paid"},
-    {"id": "Qwen/Qwen3-Next-80B-A3B-Thinking", "name": "Qwen3-Next-80B-A3B-Thinking", "provider": "Qwen", "tier": "paid"},
-    {"id": "deepseek-ai/DeepSeek-R1-0528", "name": "DeepSeek-R1-0528", "provider": "DeepSeek", "tier": "paid"},
-    {"id": "deepseek-ai/DeepSeek-R1-0528-fast", "name": "DeepSeek-R1-0528 (Fast)", "provider": "DeepSeek", "tier": "paid"},
-    {"id": "Qwen/Qwen3-235B-A22B-Thinking-2507", "name": "Qwen3-235B-A22B-Thinking-2507", "provider": "Qwen", "tier": "paid"},
-    {"id": "Qwen/Qwen3-235B-A22B-Instruct-2507", "name": "Qwen3-235B-A22B-Instruct-2507", "provider": "Qwen", "tier": "paid"},
-    {"id": "Qwen/Qwen3-30B-A3B-Thinking-2507", "name": "Qwen3-30B-A3B-Thinking-2507", "provider": "Qwen", "tier": "paid"},
-    {"id": "Qwen/Qwen3-30B-A3B-Instruct-2507", "name": "Qwen3-30B-A3B-Instruct-2507", "provider": "Qwen", "tier": "paid"},
-    {"id": "Qwen/Qwen3-Coder-30B-A3B-Instruct", "name": "Qwen3-Coder-30B-A3B-Instruct", "provider": "Qwen", "tier": "paid"},
-    {"id": "Qwen/Qwen3-32B", "name": "Qwen3-32B", "provider": "Qwen", "tier": "paid"},
-    {"id": "Qwen/Qwen3-32B-fast", "name": "Qwen3-32B (Fast)", "provider": "Qwen", "tier": "paid"},
-    {"id": "nvidia/Llama-3.1-Nemotron-Ultra-253B-v1", "name": "Llama-3.1-Nemotron-Ultra-253B-v1", "provider": "NVIDIA", "tier": "paid"}
+    {"id": "MiniMaxAI/MiniMax-M2.1", "name": "MiniMax-M2.1", "provider": "Minimax", "tier": "paid", "context_window": 196608},
+    {"id": "zai-org/GLM-4.7-FP8", "name": "GLM-4.7", "provider": "Z.ai", "tier": "paid", "context_window": 202752},
+    {"id": "deepseek-ai/DeepSeek-V3.2", "name": "DeepSeek-V3.2", "provider": "DeepSeek", "tier": "paid", "context_window": 163840},
+    {"id": "openai/gpt-oss-120b", "name": "gpt-oss-120b", "provider": "OpenAI", "tier": "paid", "context_window": 131072},
+    {"id": "moonshotai/Kimi-K2-Instruct", "name": "Kimi-K2-Instruct", "provider": "Moonshot AI", "tier": "paid", "context_window": 131072},
+    {"id": "moonshotai/Kimi-K2-Thinking", "name": "Kimi-K2-Thinking", "provider": "Moonshot AI", "tier": "paid", "context_window": 262144},
+    {"id": "Qwen/Qwen3-Coder-480B-A35B-Instruct", "name": "Qwen3-Coder-480B-A35B-Instruct", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "NousResearch/Hermes-4-405B", "name": "Hermes-4-405B", "provider": "NousResearch", "tier": "paid", "context_window": 131072},
+    {"id": "NousResearch/Hermes-4-70B", "name": "Hermes-4-70B", "provider": "NousResearch", "tier": "paid", "context_window": 131072},
+    {"id": "openai/gpt-oss-20b", "name": "gpt-oss-20b", "provider": "OpenAI", "tier": "paid", "context_window": 131072},
+    {"id": "zai-org/GLM-4.5", "name": "GLM-4.5", "provider": "Z.ai", "tier": "paid", "context_window": 131072},
+    {"id": "zai-org/GLM-4.5-Air", "name": "GLM-4.5-Air", "provider": "Z.ai", "tier": "paid", "context_window": 131072},
+    {"id": "PrimeIntellect/INTELLECT-3", "name": "INTELLECT-3", "provider": "Prime Intellect", "tier": "paid", "context_window": 131072},
+    {"id": "Qwen/Qwen3-Next-80B-A3B-Thinking", "name": "Qwen3-Next-80B-A3B-Thinking", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "deepseek-ai/DeepSeek-R1-0528", "name": "DeepSeek-R1-0528", "provider": "DeepSeek", "tier": "paid", "context_window": 163840},
+    {"id": "deepseek-ai/DeepSeek-R1-0528-fast", "name": "DeepSeek-R1-0528 (Fast)", "provider": "DeepSeek", "tier": "paid", "context_window": 163840},
+    {"id": "Qwen/Qwen3-235B-A22B-Thinking-2507", "name": "Qwen3-235B-A22B-Thinking-2507", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "Qwen/Qwen3-235B-A22B-Instruct-2507", "name": "Qwen3-235B-A22B-Instruct-2507", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "Qwen/Qwen3-30B-A3B-Thinking-2507", "name": "Qwen3-30B-A3B-Thinking-2507", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "Qwen/Qwen3-30B-A3B-Instruct-2507", "name": "Qwen3-30B-A3B-Instruct-2507", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "Qwen/Qwen3-Coder-30B-A3B-Instruct", "name": "Qwen3-Coder-30B-A3B-Instruct", "provider": "Qwen", "tier": "paid", "context_window": 262144},
+    {"id": "Qwen/Qwen3-32B", "name": "Qwen3-32B", "provider": "Qwen", "tier": "paid", "context_window": 40960},
+    {"id": "Qwen/Qwen3-32B-fast", "name": "Qwen3-32B (Fast)", "provider": "Qwen", "tier": "paid", "context_window": 40960},
+    {"id": "nvidia/Llama-3.1-Nemotron-Ultra-253B-v1", "name": "Llama-3.1-Nemotron-Ultra-253B-v1", "provider": "NVIDIA", "tier": "paid", "context_window": 131072}
 ]
 
 # Combine all models - Local first, then Nebius
@@ -75,6 +108,13 @@ def get_ollama_model_id(model_id):
             return model.get('ollama_id', model_id.replace('local/', ''))
     return model_id.replace('local/', '')
 
+def get_model_info(model_id):
+    """The LOCAL_MODELS / NEBIUS_MODELS entry for a model ID, or {}"""
+    for model in ALL_MODELS:
+        if model['id'] == model_id:
+            return model
+    return {}
+
 def local_model_supports_tools(model_id):
     """Check if a local model has reliable function calling support"""
     for model in LOCAL_MODELS:
@@ -82,240 +122,5360 @@ def local_model_supports_tools(model_id):
             return model.get('supports_tools', False)
     return False
 
-@app.route('/')
-def index():
-    return send_from_directory('static', 'index.html')
+# Metrics. Each worker process keeps its own counters and histograms and
+# snapshots them to a JSON file in METRICS_DIR every couple of seconds;
+# /api/metrics merges every worker's file into one Prometheus text page, so
+# the numbers are right no matter which gunicorn worker serves the scrape.
+# Files of exited workers are kept so counters never go backwards.
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), f'llm-dashboard-metrics-{os.getppid()}')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '2'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_BUCKETS = {
+    'http_request_duration_seconds': LATENCY_BUCKETS,
+    'tool_duration_seconds': LATENCY_BUCKETS,
+    'llm_upstream_duration_seconds': LATENCY_BUCKETS,
+    'llm_time_to_first_token_seconds': LATENCY_BUCKETS,
+    'llm_tokens_per_second': (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    'github_calls_per_request': (0, 1, 2, 3, 5, 10, 20, 50),
+    'local_queue_wait_seconds': LATENCY_BUCKETS,
+}
+METRIC_HELP = {
+    'http_request_duration_seconds': 'Time to serve a request, including streamed bodies',
+    'tool_duration_seconds': 'Time to run one repository tool call',
+    'llm_upstream_duration_seconds': 'Duration of upstream completion calls',
+    'llm_time_to_first_token_seconds': 'Time until the first streamed chunk',
+    'llm_tokens_per_second': 'Completion tokens per second of generation',
+    'llm_prompt_tokens_total': 'Prompt tokens reported by upstream usage',
+    'llm_completion_tokens_total': 'Completion tokens reported by upstream usage',
+    'github_api_calls_total': 'GitHub API requests made',
+    'github_calls_per_request': 'GitHub API requests made while serving one request',
+    'github_rate_limit_remaining': 'Remaining GitHub API rate limit, from the latest response',
+    'github_rate_limit_limit': 'GitHub API rate limit, from the latest response',
+    'local_queue_wait_seconds': 'Time a local model request waited for a free slot',
+    'local_admission_rejected_total': 'Local model requests turned away because the queue was too long',
+    'llm_response_cache_total': 'Cacheable chat requests by result: hit, miss or store',
+}
+
+class Metrics:
+    """Per-process counters, gauges and histograms, merged across workers via files"""
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._dirty = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._dirty = True
+
+    def set(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = (value, time.time())
+            self._dirty = True
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        buckets = METRIC_BUCKETS[name]
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0, 'count': 0}
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            self._dirty = True
+
+    def flush(self):
+        """Write this worker's snapshot if anything changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = json.dumps({
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value, at] for (name, labels), (value, at) in self.gauges.items()],
+                'histograms': [[name, labels, h] for (name, labels), h in self.histograms.items()]
+            })
+            self._dirty = False
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(snapshot)
+        os.replace(tmp, os.path.join(self.directory, f'{os.getpid()}.json'))
+
+    def collect(self):
+        """Merge every worker's snapshot into (counters, gauges, histograms)"""
+        self.flush()
+        counters, gauges, histograms = {}, {}, {}
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric, labels, value in snapshot['counters']:
+                key = (metric, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for metric, labels, value, at in snapshot['gauges']:
+                key = (metric, tuple(map(tuple, labels)))
+                if key not in gauges or gauges[key][1] < at:
+                    gauges[key] = (value, at)
+            for metric, labels, h in snapshot['histograms']:
+                key = (metric, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, {'buckets': [0] * len(h['buckets']), 'sum': 0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], h['buckets'])]
+                merged['sum'] += h['sum']
+                merged['count'] += h['count']
+        return counters, gauges, histograms
+
+    def render(self):
+        """Prometheus text exposition format for all workers"""
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for kind, series in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({key[0] for key in series}):
+                lines += [f'# HELP {name} {METRIC_HELP.get(name, name)}', f'# TYPE {name} {kind}']
+                for (metric, labels), value in sorted(series.items()):
+                    if metric == name:
+                        value = value[0] if kind == 'gauge' else value
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+        for name in sorted({key[0] for key in histograms}):
+            lines += [f'# HELP {name} {METRIC_HELP.get(name, name)}', f'# TYPE {name} histogram']
+            for (metric, labels), h in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRIC_BUCKETS[name], h['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {h["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels)} {round(h["sum"], 6)}')
+                lines.append(f'{name}_count{format_labels(labels)} {h["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        """Start this process's background flusher (once per worker)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+metrics = Metrics(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{key}="{escape_label(value)}"' for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RequestMetrics:
+    """What one HTTP request did, collected from whichever thread does the work"""
+
+    def __init__(self, route):
+        self.route = route
+        self.labels = {}
+        self.github_calls = 0
+        self._lock = threading.Lock()
+
+    def count_github_call(self):
+        with self._lock:
+            self.github_calls += 1
+
+current_request_metrics = contextvars.ContextVar('current_request_metrics', default=None)
+
+def record_github_call(client, headers, started=None, name=None):
+    """Count one GitHub API call and note the rate limit it reported.
+
+    Traced calls become spans; without a start time, one starts where the
+    thread's previous traced event left off.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add('github', name or client, trace.last_mark() if started is None else started, time.time(),
+                  {'client': client})
+    tracked = current_request_metrics.get()
+    route = tracked.route if tracked else 'background'
+    if tracked:
+        tracked.count_github_call()
+    metrics.inc('github_api_calls_total', {'route': route, 'client': client})
+    remaining = headers.get('X-RateLimit-Remaining') or headers.get('x-ratelimit-remaining')
+    limit = headers.get('X-RateLimit-Limit') or headers.get('x-ratelimit-limit')
+    if remaining is not None:
+        metrics.set('github_rate_limit_remaining', int(float(remaining)))
+    if limit is not None:
+        metrics.set('github_rate_limit_limit', int(float(limit)))
+
+def counting_github_calls(method, headers_at):
+    """Wrap a PyGithub Requester method so every call it makes is recorded.
+
+    headers_at is where the response headers sit in the method's result;
+    a GithubException carries its own.
+    """
+    def counted(self, verb, url, *args, **kwargs):
+        started = time.time()
+        name = f"{verb} {urlparse(str(url)).path}"
+        try:
+            result = method(self, verb, url, *args, **kwargs)
+        except GithubException as e:
+            record_github_call('pygithub', e.headers or {}, started, name)
+            raise
+        record_github_call('pygithub', result[headers_at] or {}, started, name)
+        return result
+    return counted
+
+# Every PyGithub request goes through one of these public Requester methods;
+# the other *AndCheck variants call the first three.
+Requester.requestJson = counting_github_calls(Requester.requestJson, 1)
+Requester.requestMultipart = counting_github_calls(Requester.requestMultipart, 1)
+Requester.requestBlob = counting_github_calls(Requester.requestBlob, 1)
+Requester.requestMemoryBlobAndCheck = counting_github_calls(Requester.requestMemoryBlobAndCheck, 0)
+
+@app.before_request
+def start_request_metrics():
+    metrics.start()
+    tracked = RequestMetrics(request.endpoint or 'unmatched')
+    g.request_metrics = tracked
+    g.request_started = time.time()
+    current_request_metrics.set(tracked)
+    g.request_trace = start_request_trace()
+
+@app.after_request
+def finish_request_metrics(response):
+    tracked = g.get('request_metrics')
+    started = g.get('request_started')
+    if tracked is None or tracked.route in ('prometheus_metrics', 'static'):
+        return response
+    status = response.status_code
+    trace = g.get('request_trace')
+    if trace:
+        response.headers['X-Trace-Id'] = trace.trace_id
+
+    # Runs once the body, streamed or not, has been sent
+    def record():
+        labels = dict(tracked.labels, route=tracked.route, status=str(status))
+        metrics.observe('http_request_duration_seconds', time.time() - started, labels)
+        metrics.observe('github_calls_per_request', tracked.github_calls, {'route': tracked.route})
+        if trace:
+            finish_request_trace(trace, status, dict(tracked.labels, github_calls=tracked.github_calls))
+
+    response.call_on_close(record)
+    return response
+
+def set_request_label(name, value):
+    """Attach an extra label, like the tool name, to this request's metrics"""
+    tracked = current_request_metrics.get()
+    if tracked:
+        tracked.labels[name] = value
+
+# Tracing. A client that sends an X-Trace-Id header gets a timeline of where
+# a run's wall-clock time went. Every request carrying the id becomes one
+# span, with child spans for upstream completions, local queue waits,
+# GitHub calls, JSON parsing and serialisation, cache lookups and tool runs.
+# Operations too small and frequent to list, like parsing stream chunks,
+# are totalled per request instead. Spans are buffered on the request and
+# appended to one file per trace in TRACE_DIR when the response is done, so
+# any worker can serve the timeline. Gaps between a run's requests are time
+# spent in the browser or on the network. Without a trace id every hook
+# costs one context variable lookup.
+TRACING = os.environ.get('TRACING', 'true').lower() in ('1', 'true', 'yes')
+TRACE_DIR = os.environ.get('TRACE_DIR') or os.path.join(tempfile.gettempdir(), f'llm-dashboard-traces-{os.getppid()}')
+TRACE_TTL = float(os.environ.get('TRACE_TTL', '3600'))
+TRACE_MAX_SPANS = 5000  # per request; later spans are counted but dropped
+TRACE_ID = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+class RequestTrace:
+    """Spans recorded while serving one request that belongs to a trace"""
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started = time.time()
+        self.spans = []
+        self.totals = {}
+        self.dropped = 0
+        self._marks = {}
+        self._lock = threading.Lock()
+
+    def add(self, category, name, started, ended, args=None):
+        thread = threading.get_ident()
+        with self._lock:
+            self._marks[thread] = ended
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append((category, name, started, ended, thread, args or None))
+
+    def tally(self, key, seconds):
+        """Add time to a per-request total, for operations too small to list"""
+        with self._lock:
+            total = self.totals.setdefault(key, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def mark(self):
+        """Note that this thread started something, for spans that only know their end"""
+        self._marks[threading.get_ident()] = time.time()
+
+    def last_mark(self):
+        return max(self._marks.get(threading.get_ident(), self.started), self.started)
+
+    def record(self, status, labels):
+        return {
+            'request': self.name, 'pid': os.getpid(), 'status': status, 'labels': labels,
+            'start': self.started, 'end': time.time(), 'thread': threading.get_ident(),
+            'spans': self.spans, 'totals': self.totals, 'dropped': self.dropped
+        }
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def trace_span(category, name, started, ended=None, **args):
+    """Record a finished span on the current trace, if there is one"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(category, name, started, time.time() if ended is None else ended, args)
+
+@contextlib.contextmanager
+def traced(category, name, **args):
+    """Record the enclosed block as a span on the current trace"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    trace.mark()
+    started = time.time()
+    try:
+        yield
+    finally:
+        trace.add(category, name, started, time.time(), args)
+
+class TraceStore:
+    """Trace files shared by all workers: one JSON line per traced request"""
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_sweep = 0
+
+    def write(self, record):
+        os.makedirs(self.directory, exist_ok=True)
+        line = json.dumps(record, default=str) + '\n'
+        with open(self._path(record['trace_id']), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+        self._maybe_sweep()
+
+    def load(self, trace_id):
+        """The trace's request records in start order, or None if unknown"""
+        try:
+            with open(self._path(trace_id)) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                records = [json.loads(line) for line in f if line.endswith('\n')]
+        except FileNotFoundError:
+            return None
+        return sorted(records, key=lambda record: record['start'])
+
+    def timeline(self, trace_id):
+        """Spans relative to the first request, with time per category and idle gaps"""
+        records = self.load(trace_id)
+        if not records:
+            return None
+        origin = records[0]['start']
+        end = max(record['end'] for record in records)
+        ms = lambda seconds: round(seconds * 1000, 3)
+        spans, summary = [], {}
+
+        def add(category, name, started, ended, pid, thread, args):
+            spans.append({'category': category, 'name': name, 'start_ms': ms(started - origin),
+                          'duration_ms': ms(ended - started), 'pid': pid, 'thread': thread, 'args': args or {}})
+            if category != 'request':
+                tally(category, ended - started, 1)
+
+        def tally(category, seconds, count):
+            entry = summary.setdefault(category, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += count
+
+        idle, covered_until = 0.0, origin
+        for record in records:
+            args = dict(record['labels'], status=record['status'])
+            if record['dropped']:
+                args['dropped_spans'] = record['dropped']
+            for key, (seconds, count) in record['totals'].items():
+                args[key] = {'ms': ms(seconds), 'count': count}
+                tally(key.split(':', 1)[0], seconds, count)
+            add('request', record['request'], record['start'], record['end'], record['pid'], record['thread'], args)
+            for category, name, started, ended, thread, span_args in record['spans']:
+                add(category, name, started, ended, record['pid'], thread, span_args)
+            idle += max(0.0, record['start'] - covered_until)
+            covered_until = max(covered_until, record['end'])
+
+        spans.sort(key=lambda span: (span['start_ms'], -span['duration_ms']))
+        return {
+            'trace_id': trace_id,
+            'started': origin,
+            'duration_ms': ms(end - origin),
+            'requests': len(records),
+            'idle_ms': ms(idle),
+            'summary': {category: {'ms': ms(seconds), 'count': count} for category, (seconds, count) in summary.items()},
+            'spans': spans
+        }
+
+    def chrome(self, trace_id):
+        """The trace in Chrome's Trace Event Format, for chrome://tracing or Perfetto"""
+        timeline = self.timeline(trace_id)
+        if timeline is None:
+            return None
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': f'worker {pid}'}}
+                  for pid in sorted({span['pid'] for span in timeline['spans']})]
+        for span in timeline['spans']:
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X',
+                           'ts': round(span['start_ms'] * 1000), 'dur': round(span['duration_ms'] * 1000),
+                           'pid': span['pid'], 'tid': span['thread'], 'args': span['args']})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'trace_id': trace_id, 'started': timeline['started']}}
+
+    def _maybe_sweep(self):
+        """Delete traces untouched for longer than the TTL, at most every few minutes"""
+        if time.time() - self._last_sweep < min(self.ttl / 4, 300):
+            return
+        self._last_sweep = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _path(self, trace_id):
+        return os.path.join(self.directory, trace_id + '.jsonl')
+
+trace_store = TraceStore(TRACE_DIR, TRACE_TTL)
+
+def start_request_trace():
+    """Attach a RequestTrace when the request names a trace id"""
+    trace_id = request.headers.get('X-Trace-Id') or request.args.get('trace_id')
+    if not TRACING or not trace_id or not TRACE_ID.match(trace_id) or request.endpoint in ('get_trace', 'static'):
+        return None
+    trace = RequestTrace(trace_id, f"{request.method} {request.path}")
+    current_trace.set(trace)
+    if request.is_json:
+        with traced('json', 'parse request', bytes=request.content_length):
+            request.get_json(silent=True)
+    return trace
+
+def finish_request_trace(trace, status, labels):
+    try:
+        trace_store.write(dict(trace.record(status, labels), trace_id=trace.trace_id))
+    except OSError as e:
+        app.logger.warning("Could not write trace %s: %s", trace.trace_id, e)
+
+# Upstream LLM connections. Each provider gets a pooled keep-alive session so
+# consecutive agent steps reuse the same TCP/TLS connection.
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', '2'))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', '0.5'))
+NEBIUS_POOL_SIZE = int(os.environ.get('NEBIUS_POOL_SIZE', '10'))
+OLLAMA_POOL_SIZE = int(os.environ.get('OLLAMA_POOL_SIZE', '4'))
+
+class UpstreamAbort:
+    """Lets another thread end an upstream call, even one blocked before its first byte.
+
+    While it is set in upstream_abort, every connection the call sends a
+    request on is remembered until it goes back to the pool; abort() shuts
+    those sockets down, which wakes a blocked read with an error.
+    """
+
+    def __init__(self):
+        self.aborted = False
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def watch(self, connection):
+        with self._lock:
+            connection.upstream_abort = self
+            self._connections.append(connection)
+            if self.aborted:
+                self._shutdown(connection)
+
+    def release(self, connection):
+        with self._lock:
+            connection.upstream_abort = None
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            for connection in self._connections:
+                if connection.upstream_abort is self:
+                    self._shutdown(connection)
+
+    def _shutdown(self, connection):
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+upstream_abort = contextvars.ContextVar('upstream_abort', default=None)
+
+class AbortableConnection:
+    """Registers itself with the calling thread's UpstreamAbort, if any"""
+    upstream_abort = None
+
+    def request(self, *args, **kwargs):
+        watcher = upstream_abort.get()
+        if watcher is not None:
+            watcher.watch(self)
+        return super().request(*args, **kwargs)
+
+class AbortableHTTPConnection(AbortableConnection, HTTPConnection):
+    pass
+
+class AbortableHTTPSConnection(AbortableConnection, HTTPSConnection):
+    pass
+
+class AbortablePool:
+    """Forgets a connection's abort watcher once it is back in the pool and free for reuse"""
+
+    def _put_conn(self, conn):
+        if conn is not None and conn.upstream_abort is not None:
+            conn.upstream_abort.release(conn)
+        return super()._put_conn(conn)
+
+class AbortableHTTPConnectionPool(AbortablePool, HTTPConnectionPool):
+    ConnectionCls = AbortableHTTPConnection
+
+class AbortableHTTPSConnectionPool(AbortablePool, HTTPSConnectionPool):
+    ConnectionCls = AbortableHTTPSConnection
+
+class UpstreamRetry(Retry):
+    """Retry that replays a POST only on statuses saying it was never processed.
+
+    A 502 or 504 from a gateway can arrive while the model is still
+    generating behind it, so replaying the completion would run it twice.
+    """
+    POST_RETRY_STATUSES = (429, 503)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == 'POST' and status_code not in self.POST_RETRY_STATUSES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+class UpstreamClient:
+    """Pooled, retrying HTTP client for one OpenAI-compatible endpoint.
+
+    The session is created lazily and recreated after a fork, so every
+    gunicorn worker owns its own connection pool. Only connection failures
+    and 429/5xx responses are retried, and POSTs only on 429/503; a request
+    whose body was already being generated is never replayed.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, name, url, pool_size, headers=None, connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 max_retries=UPSTREAM_MAX_RETRIES, backoff=UPSTREAM_BACKOFF):
+        self.name = name
+        self.url = url
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        retry = UpstreamRetry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=self.max_retries,
+            allowed_methods=None,  # POST too, but only on UpstreamRetry.POST_RETRY_STATUSES
+            status_forcelist=self.RETRY_STATUSES,
+            backoff_factor=self.backoff,
+            backoff_jitter=self.backoff,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        adapter.poolmanager.pool_classes_by_scheme = {'http': AbortableHTTPConnectionPool,
+                                                      'https': AbortableHTTPSConnectionPool}
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Content-Type': 'application/json', **self.headers})
+        return session
+
+    def post(self, payload, read_timeout, stream=False):
+        """POST a completion request; timeouts are (connect, read)"""
+        return self.session.post(self.url, json=payload, timeout=(self.connect_timeout, read_timeout), stream=stream)
+
+nebius_client = UpstreamClient('nebius', NEBIUS_API_URL, NEBIUS_POOL_SIZE,
+                               headers={'Authorization': f'Bearer {NEBIUS_API_KEY}'})
+ollama_client = UpstreamClient('ollama', OLLAMA_API_URL, OLLAMA_POOL_SIZE)
+
+# Model catalog. /api/models answers from a catalog kept fresh by a
+# background thread in each worker. The thread asks Ollama which models are
+# installed (/api/tags) and loaded (/api/ps), lists Nebius's models, and
+# records whether each endpoint answered. Local models picked in the UI are
+# preloaded with a long keep_alive and kept loaded for LOCAL_WARM_WINDOW
+# seconds, so the first real request does not spend its budget loading
+# weights. The measured load time is reported per model as cold_start_seconds.
+# Models installed in Ollama but missing from LOCAL_MODELS are listed too,
+# without tool support.
+OLLAMA_BASE_URL = (os.environ.get('OLLAMA_BASE_URL') or OLLAMA_API_URL.split('/v1/')[0]).rstrip('/')
+NEBIUS_MODELS_URL = NEBIUS_API_URL.rsplit('/chat/completions', 1)[0] + '/models'
+MODEL_PROBE_INTERVAL = float(os.environ.get('MODEL_PROBE_INTERVAL', '30'))
+LOCAL_KEEP_ALIVE = os.environ.get('LOCAL_KEEP_ALIVE', '30m')
+LOCAL_WARM_WINDOW = float(os.environ.get('LOCAL_WARM_WINDOW', '1800'))
+LOCAL_WARM_MODELS = [model_id.strip() for model_id in os.environ.get('LOCAL_WARM_MODELS', '').split(',') if model_id.strip()]
+MODEL_PROBE_TIMEOUT = 5
+LOCAL_WARMUP_TIMEOUT = 300
+
+def ollama_tag(name):
+    """Ollama model name with the implicit :latest tag spelled out"""
+    return name if ':' in name.rsplit('/', 1)[-1] else name + ':latest'
+
+class ModelCatalog:
+    """Installed, loaded and reachable models, refreshed in the background"""
+
+    def __init__(self, probe_interval, keep_alive, warm_window, always_warm):
+        self.probe_interval = probe_interval
+        self.keep_alive = keep_alive
+        self.warm_window = warm_window
+        self.always_warm = always_warm
+        self.endpoints = {}  # endpoint -> {ok, latency_ms, checked_at, error}
+        self.installed = None  # Ollama tags, None until the first probe answers
+        self.loaded = set()
+        self.cloud_ids = None
+        self.cold_starts = {}  # model id -> seconds spent loading weights
+        self.probes = 0
+        self.warmups = 0
+        self._selected = {}  # model id -> when it was last picked
+        self._warming = set()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def models(self):
+        """ALL_MODELS plus discovered local models, each with its availability"""
+        self.start()
+        with self._lock:
+            installed = set(self.installed) if self.installed is not None else None
+            loaded = set(self.loaded)
+            cloud_ids = set(self.cloud_ids) if self.cloud_ids is not None else None
+            ollama_ok = self.endpoints.get(ollama_client.name, {}).get('ok')
+            nebius_ok = self.endpoints.get(nebius_client.name, {}).get('ok')
+
+        models = []
+        for model in LOCAL_MODELS:
+            tag = ollama_tag(model.get('ollama_id', model['id'].replace('local/', '')))
+            models.append(self._describe(model, tag, installed, loaded, ollama_ok))
+        known = {ollama_tag(model.get('ollama_id', '')) for model in LOCAL_MODELS}
+        for tag in sorted((installed or set()) - known):
+            discovered = {"id": f"local/{tag}", "name": tag, "provider": "Local", "ollama_id": tag, "tier": "free",
+                          "supports_tools": False, "context_window": LOCAL_CONTEXT_WINDOW, "discovered": True}
+            models.append(self._describe(discovered, tag, installed, loaded, ollama_ok))
+        for model in NEBIUS_MODELS:
+            listed = cloud_ids is None or model['id'] in cloud_ids
+            models.append(dict(model, available=None if nebius_ok is None else bool(nebius_ok and listed)))
+        return models
+
+    def warm(self, model_id):
+        """Preload a local model in the background and keep it loaded; returns its status.
+
+        Only LOCAL_MODELS and models Ollama reported as installed are
+        accepted, so clients cannot make up ids to start warm-ups for.
+        """
+        if not is_local_model(model_id):
+            return 'not_local'
+        self.start()
+        tag = ollama_tag(get_ollama_model_id(model_id))
+        known = bool(get_model_info(model_id))
+        if not known:
+            model_id = f"local/{tag}"  # as listed for discovered models
+        with self._lock:
+            if self.installed is None and not known:
+                return 'unknown'
+            if self.installed is not None and tag not in self.installed:
+                return 'not_installed'
+            self._selected[model_id] = time.time()
+            status = 'warm' if tag in self.loaded else 'warming'
+        # Refresh keep_alive even when loaded; Ollama answers at once then
+        self._preload_in_background(model_id)
+        return status
+
+    def probe(self):
+        """One round of discovery and health checks"""
+        tags = self._check(ollama_client, OLLAMA_BASE_URL + '/api/tags')
+        running = self._check(ollama_client, OLLAMA_BASE_URL + '/api/ps', record=False) if tags is not None else None
+        cloud = self._check(nebius_client, NEBIUS_MODELS_URL) if NEBIUS_API_KEY else None
+        with self._lock:
+            if tags is not None:
+                self.installed = {ollama_tag(model.get('name') or model.get('model') or '') for model in tags.get('models', [])}
+            if running is not None:
+                self.loaded = {ollama_tag(model.get('name') or model.get('model') or '') for model in running.get('models', [])}
+            if cloud is not None and cloud.get('data'):
+                self.cloud_ids = {model.get('id') for model in cloud['data']}
+            self.probes += 1
+
+    def start(self):
+        """Start this process's probe thread, once (and again after a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='model-catalog', daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'endpoints': {name: dict(endpoint) for name, endpoint in self.endpoints.items()},
+                'installed': sorted(self.installed) if self.installed is not None else None,
+                'loaded': sorted(self.loaded),
+                'cold_start_seconds': dict(self.cold_starts),
+                'kept_warm': sorted(self._kept_warm()),
+                'probes': self.probes,
+                'warmups': self.warmups
+            }
+
+    def _describe(self, model, tag, installed, loaded, ollama_ok):
+        return dict(
+            model,
+            installed=None if installed is None else tag in installed,
+            loaded=tag in loaded,
+            available=None if ollama_ok is None else bool(ollama_ok and (installed is None or tag in installed)),
+            cold_start_seconds=self.cold_starts.get(model['id'])
+        )
+
+    def _run(self):
+        while True:
+            try:
+                self.probe()
+                with self._lock:
+                    warm = self._kept_warm()
+                for model_id in warm:
+                    self._preload_in_background(model_id)
+            except Exception as e:
+                app.logger.warning("Model catalog probe failed: %s", e)
+            time.sleep(self.probe_interval)
+
+    def _kept_warm(self):
+        now = time.time()
+        for model_id in [model_id for model_id, at in self._selected.items() if now - at >= self.warm_window]:
+            del self._selected[model_id]
+        selected = set(self._selected)
+        warm = selected | set(self.always_warm)
+        if self.installed is not None:
+            warm = {model_id for model_id in warm if ollama_tag(get_ollama_model_id(model_id)) in self.installed}
+        return warm
+
+    def _check(self, client, url, record=True):
+        """GET url and record the endpoint's health; returns the JSON body or None"""
+        started = time.time()
+        try:
+            response = client.session.get(url, timeout=(client.connect_timeout, MODEL_PROBE_TIMEOUT))
+            response.raise_for_status()
+            body = response.json()
+            error = None
+        except Exception as e:
+            body, error = None, str(e)[:200]
+        if record:
+            with self._lock:
+                self.endpoints[client.name] = {
+                    'ok': error is None,
+                    'latency_ms': round((time.time() - started) * 1000, 1),
+                    'checked_at': time.time(),
+                    'error': error
+                }
+        return body
+
+    def _preload_in_background(self, model_id):
+        with self._lock:
+            if model_id in self._warming:
+                return
+            self._warming.add(model_id)
+        threading.Thread(target=self._preload, args=(model_id,), name='model-warmup', daemon=True).start()
+
+    def _preload(self, model_id):
+        """Ask Ollama to load a model (a generate call without a prompt) and time it"""
+        tag = ollama_tag(get_ollama_model_id(model_id))
+        started = time.time()
+        try:
+            with self._lock:
+                was_loaded = tag in self.loaded
+            response = ollama_client.session.post(OLLAMA_BASE_URL + '/api/generate',
+                                                  json={'model': tag, 'keep_alive': self.keep_alive},
+                                                  timeout=(ollama_client.connect_timeout, LOCAL_WARMUP_TIMEOUT))
+            response.raise_for_status()
+            # Ollama reports the time spent loading weights in nanoseconds
+            load_seconds = (response.json().get('load_duration') or 0) / 1e9 or time.time() - started
+            with self._lock:
+                if not was_loaded:
+                    self.cold_starts[model_id] = round(load_seconds, 2)
+                self.loaded.add(tag)
+                self.warmups += 1
+        except Exception as e:
+            app.logger.warning("Warming up %s failed: %s", model_id, e)
+        finally:
+            with self._lock:
+                self._warming.discard(model_id)
+
+model_catalog = ModelCatalog(MODEL_PROBE_INTERVAL, LOCAL_KEEP_ALIVE, LOCAL_WARM_WINDOW, LOCAL_WARM_MODELS)
+
+@app.route('/')
+def index():
+    return send_from_directory('static', 'index.html')
+
+@app.route('/api/models', methods=['GET'])
+def get_models():
+    """Models with availability, load state and cold-start times from the catalog"""
+    return jsonify({"models": model_catalog.models(), "endpoints": model_catalog.stats()['endpoints']})
+
+@app.route('/api/models/warm', methods=['POST'])
+def warm_model():
+    """Preload a local model the user just picked so their first message does not wait on loading"""
+    model_id = (request.json or {}).get('model')
+    if not model_id:
+        return jsonify({"error": "model is required"}), 400
+    status = model_catalog.warm(model_id)
+    if status in ('unknown', 'not_installed'):
+        return jsonify({"model": model_id, "status": status, "error": f"{model_id} is not an installed local model"}), 404
+    return jsonify({"model": model_id, "status": status}), 202
+
+# System prompt for efficient tool usage when a repo is connected
+REPO_SYSTEM_PROMPT = """You are a helpful coding assistant with access to a GitHub repository. You can read AND edit files directly.
+
+YOU HAVE FULL READ AND WRITE ACCESS. Use edit_file or write_file to make changes.
+
+EFFICIENCY GUIDELINES - Follow these to avoid running out of steps:
+1. READ files only ONCE. Don't re-read files you've already seen.
+2. Use edit_file with replace_all=true for bulk changes (e.g., changing all occurrences of a color).
+3. PLAN your edits first, then execute them efficiently.
+4. For color scheme changes: identify all unique colors, then use edit_file with replace_all=true for each color.
+5. Combine related changes - don't make separate calls for the same type of change.
+6. You have a maximum of 25 tool calls, so be efficient!
+
+CRITICAL - edit_file EXACT MATCH RULES:
+- old_text must be copied EXACTLY from the file — same whitespace, indentation, and line endings.
+- After reading a file, copy-paste the exact text you want to replace as old_text.
+- Do NOT paraphrase, reformat, or clean up old_text.
+- If edit_file says "Could not find the specified text", re-read the file and copy old_text more carefully.
+- For multi-line old_text, include enough surrounding context (3-5 lines) to make it unique.
+
+TOOL TIPS:
+- read_files: Use to read several files in one call instead of calling read_file for each.
+- read_file: Large files come back in pages. Use outline_file first, then read_file with start_line/end_line for just the part you need.
+- edit_file: Best for targeted changes. Use old_text/new_text with replace_all=true for global find-replace.
+- apply_patch: Best for several changes across one or more files. Send one unified diff with 2-3 context lines per hunk; all files are committed together. If a hunk fails, the result shows the actual lines found there, so fix that hunk and resend only that file.
+- write_file: Only use for new files or complete rewrites. Avoid for small edits.
+- list_files: Use to discover available files before reading. Pass path or pattern to list only part of a large repo.
+- search_files: Use to find where text or a regex occurs across the repo (with line numbers) instead of reading files one by one."""
+
+def build_repo_tools(repo_context):
+    """Tool definitions for GitHub file operations on the connected repo"""
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": "read_file",
+                "description": f"Read the contents of any file from the repository {repo_context['repo']} on branch {repo_context['branch']}. Large files are returned one page at a time; the result says which start_line to continue from.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {
+                            "type": "string",
+                            "description": "The path to the file in the repository (e.g., 'src/app.py', 'README.md')"
+                        },
+                        "start_line": {
+                            "type": "integer",
+                            "description": "First line to read (1-based). Omit to start at the top."
+                        },
+                        "end_line": {
+                            "type": "integer",
+                            "description": "Last line to read (inclusive). Omit to read a full page."
+                        },
+                        "start_column": {
+                            "type": "integer",
+                            "description": "Where to start within start_line (1-based). Only needed to continue a line longer than a page; the result gives next_start_column."
+                        }
+                    },
+                    "required": ["file_path"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "read_files",
+                "description": f"Read several files from the repository {repo_context['repo']} on branch {repo_context['branch']} in one call. Prefer this over several read_file calls. Errors are reported per file; large files come back as their first page.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_paths": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": f"Paths of the files to read (at most {READ_FILES_MAX_FILES})"
+                        }
+                    },
+                    "required": ["file_paths"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "outline_file",
+                "description": "List the classes and functions of a Python or JavaScript/TypeScript file, or the headings of a Markdown file, with their line ranges. Much cheaper than reading a large file; follow up with read_file start_line/end_line.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {
+                            "type": "string",
+                            "description": "The path to the file in the repository"
+                        }
+                    },
+                    "required": ["file_path"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "write_file",
+                "description": f"Write or update a file in the repository {repo_context['repo']} on branch {repo_context['branch']}. Changes are automatically committed. Use this for creating new files or complete rewrites.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {
+                            "type": "string",
+                            "description": "The path to the file in the repository"
+                        },
+                        "content": {
+                            "type": "string",
+                            "description": "The complete content to write to the file"
+                        },
+                        "commit_message": {
+                            "type": "string",
+                            "description": "Commit message describing the changes"
+                        }
+                    },
+                    "required": ["file_path", "content", "commit_message"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "edit_file",
+                "description": f"Edit a file by replacing specific text. Use this for making targeted changes to existing files - much more efficient than rewriting the whole file. You can call this multiple times to make multiple changes.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {
+                            "type": "string",
+                            "description": "The path to the file in the repository"
+                        },
+                        "old_text": {
+                            "type": "string",
+                            "description": "The exact text to find and replace (must match exactly)"
+                        },
+                        "new_text": {
+                            "type": "string",
+                            "description": "The new text to replace it with"
+                        },
+                        "replace_all": {
+                            "type": "boolean",
+                            "description": "If true, replace ALL occurrences. If false (default), replace only the first occurrence."
+                        },
+                        "commit_message": {
+                            "type": "string",
+                            "description": "Commit message describing the change"
+                        }
+                    },
+                    "required": ["file_path", "old_text", "new_text", "commit_message"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "apply_patch",
+                "description": f"Apply a unified diff to one or more files in {repo_context['repo']} on branch {repo_context['branch']}, committed together. Hunks are placed by their context lines, so line numbers may be approximate and whitespace differences are tolerated. Reports the result of every hunk; a file is only written if all of its hunks apply.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "patch": {
+                            "type": "string",
+                            "description": "Unified diff: for each file a '--- a/path' and '+++ b/path' line (--- /dev/null for a new file), then @@ hunks with ' ' context, '-' removed and '+' added lines"
+                        },
+                        "commit_message": {
+                            "type": "string",
+                            "description": "Commit message describing the changes"
+                        }
+                    },
+                    "required": ["patch", "commit_message"]
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "list_files",
+                "description": f"List files in the repository {repo_context['repo']} on branch {repo_context['branch']}. Optionally restrict to a directory and/or a glob pattern.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "path": {
+                            "type": "string",
+                            "description": "Only list files under this directory (e.g., 'src/components')"
+                        },
+                        "pattern": {
+                            "type": "string",
+                            "description": "Glob pattern to match (e.g., '*.py', 'static/**/*.css'). Patterns without '/' match file names."
+                        }
+                    }
+                }
+            }
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "search_files",
+                "description": f"Search the contents of all files in the repository {repo_context['repo']} on branch {repo_context['branch']}. Returns matching lines with file paths and line numbers. One call replaces reading many files.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "Text to find (e.g., '#3b82f6'), or a Python regular expression if regex is true"
+                        },
+                        "regex": {
+                            "type": "boolean",
+                            "description": "Treat query as a regular expression (default false: literal text)"
+                        },
+                        "case_sensitive": {
+                            "type": "boolean",
+                            "description": "Match case exactly (default false)"
+                        },
+                        "path": {
+                            "type": "string",
+                            "description": "Only search files under this directory (e.g., 'src')"
+                        },
+                        "pattern": {
+                            "type": "string",
+                            "description": "Only search files matching this glob (e.g., '*.css'). Patterns without '/' match file names."
+                        },
+                        "max_results": {
+                            "type": "integer",
+                            "description": f"Maximum matching lines to return (default 50, at most {SEARCH_MAX_RESULTS})"
+                        }
+                    },
+                    "required": ["query"]
+                }
+            }
+        }
+    ]
+
+# Context compaction. Before each upstream call the conversation is fitted
+# to the model's context budget: tool results that a later call made stale
+# become short stubs, and if that is not enough, older tool results are
+# stubbed and then the oldest exchanges dropped. Token counts are estimated
+# from UTF-8 size, calibrated per model against the usage upstream reports.
+CONTEXT_COMPACTION = os.environ.get('CONTEXT_COMPACTION', 'true').lower() in ('1', 'true', 'yes')
+CONTEXT_MAX_TOKENS = int(os.environ.get('CONTEXT_MAX_TOKENS', '0'))  # optional cap below the window, 0 = none
+DEFAULT_BYTES_PER_TOKEN = 3.6
+MESSAGE_OVERHEAD_TOKENS = 4
+WRITE_TOOLS = {'write_file', 'edit_file', 'apply_patch'}
+
+class TokenEstimator:
+    """Cheap per-model token estimates from UTF-8 byte counts.
+
+    Starts from the model's bytes_per_token and drifts towards the ratio
+    implied by the prompt_tokens that upstream reports back.
+    """
+
+    def __init__(self):
+        self.ratios = {}
+        self.requests = 0
+        self.compacted = 0
+        self.tokens_saved = 0
+        self._lock = threading.Lock()
+
+    def bytes_per_token(self, model_id):
+        ratio = self.ratios.get(model_id)
+        return ratio or get_model_info(model_id).get('bytes_per_token', DEFAULT_BYTES_PER_TOKEN)
+
+    def message_tokens(self, model_id, message):
+        size = len(message_text(message).encode('utf-8'))
+        return int(size / self.bytes_per_token(model_id)) + MESSAGE_OVERHEAD_TOKENS
+
+    def tools_tokens(self, model_id, tools):
+        if not tools:
+            return 0
+        return int(len(json.dumps(tools).encode('utf-8')) / self.bytes_per_token(model_id))
+
+    def observe(self, model_id, prompt_bytes, prompt_tokens):
+        """Calibrate against a real prompt token count"""
+        if not prompt_bytes or not prompt_tokens:
+            return
+        measured = min(max(prompt_bytes / prompt_tokens, 1.5), 8.0)
+        with self._lock:
+            current = self.ratios.get(model_id)
+            self.ratios[model_id] = measured if current is None else current * 0.8 + measured * 0.2
+
+    def record(self, stats):
+        with self._lock:
+            self.requests += 1
+            if stats['tokens_saved']:
+                self.compacted += 1
+                self.tokens_saved += stats['tokens_saved']
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'compacted': self.compacted,
+            'tokens_saved': self.tokens_saved,
+            'bytes_per_token': {model: round(ratio, 2) for model, ratio in self.ratios.items()}
+        }
+
+token_estimator = TokenEstimator()
+
+def message_text(message):
+    """The parts of a message that count towards the prompt"""
+    text = message.get('content') or ''
+    if not isinstance(text, str):
+        text = json.dumps(text)
+    for call in message.get('tool_calls') or []:
+        function = call.get('function') or {}
+        text += (function.get('name') or '') + (function.get('arguments') or '')
+    return text
+
+def context_budget(model_id, max_tokens, tools):
+    """Prompt tokens we allow for a request, after the reply and tool schemas"""
+    window = get_model_info(model_id).get('context_window') or LOCAL_CONTEXT_WINDOW
+    if CONTEXT_MAX_TOKENS:
+        window = min(window, CONTEXT_MAX_TOKENS)
+    # Leave headroom for chat template tokens the estimate does not see
+    return int(window * 0.95) - max_tokens - token_estimator.tools_tokens(model_id, tools)
+
+def tool_call_targets(messages):
+    """Map tool_call_id -> (tool name, file path or None, arguments)"""
+    targets = {}
+    for message in messages:
+        for call in message.get('tool_calls') or []:
+            function = call.get('function') or {}
+            try:
+                arguments = json.loads(function.get('arguments') or '{}')
+            except ValueError:
+                arguments = {}
+            if not isinstance(arguments, dict):
+                arguments = {}
+            targets[call.get('id')] = (function.get('name'), arguments.get('file_path'), arguments)
+    return targets
+
+def stub_tool_message(message, reason):
+    return dict(message, content=json.dumps({"success": True, "omitted": True, "note": reason}))
+
+def stub_superseded(messages):
+    """Replace tool results that a later tool call made stale.
+
+    A read_file or outline_file result is stale once the same file (and
+    line range) is read again or the file is written (apply_patch writes
+    every file in its patch), a read_files result
+    once any of its files is written, a list_files result
+    once the same listing is requested again, and write_file content once
+    the file is written or read again. Returns the new list and the number
+    of stubs.
+    """
+    targets = tool_call_targets(messages)
+    compacted = list(messages)
+    stubbed = 0
+    later_reads, later_read_paths, later_writes, later_listings = set(), set(), set(), set()
+
+    for index in range(len(compacted) - 1, -1, -1):
+        message = compacted[index]
+        if message.get('role') == 'tool':
+            name, path, arguments = targets.get(message.get('tool_call_id'), (None, None, {}))
+            if name in ('read_file', 'outline_file') and path:
+                read = (name, path, arguments.get('start_line'), arguments.get('end_line'), arguments.get('start_column'))
+                if path in later_writes:
+                    compacted[index] = stub_tool_message(message, f"Contents of {path} omitted: the file was changed later. Call {name} for the current version.")
+                    stubbed += 1
+                elif read in later_reads:
+                    compacted[index] = stub_tool_message(message, f"Contents of {path} omitted: a later {name} result has the same lines.")
+                    stubbed += 1
+                later_reads.add(read)
+                later_read_paths.add(path)
+            elif name == 'read_files':
+                paths = [path for path in arguments.get('file_paths') or [] if isinstance(path, str)]
+                changed = [path for path in paths if path in later_writes]
+                if changed:
+                    compacted[index] = stub_tool_message(message, f"Contents omitted: {', '.join(changed)} changed later. Call read_files for the current versions.")
+                    stubbed += 1
+                later_read_paths.update(paths)
+            elif name == 'list_files':
+                listing = json.dumps(arguments, sort_keys=True)
+                if listing in later_listings:
+                    compacted[index] = stub_tool_message(message, "File listing omitted: the same listing was requested again later.")
+                    stubbed += 1
+                later_listings.add(listing)
+        elif message.get('tool_calls'):
+            calls = []
+            for call in message['tool_calls']:
+                name, path, arguments = targets.get(call.get('id'), (None, None, {}))
+                if name == 'write_file' and path and (path in later_writes or path in later_read_paths) \
+                        and len(arguments.get('content') or '') > 200:
+                    arguments = dict(arguments, content=f"[{len(arguments['content'])} characters omitted; superseded by a later call]")
+                    call = dict(call, function=dict(call['function'], arguments=json.dumps(arguments)))
+                    stubbed += 1
+                calls.append(call)
+                if name == 'apply_patch':
+                    later_writes.update(patched_paths(arguments.get('patch')))
+                elif name in WRITE_TOOLS and path:
+                    later_writes.add(path)
+            compacted[index] = dict(message, tool_calls=calls)
+
+    return compacted, stubbed
+
+def patched_paths(patch_text):
+    """Paths an apply_patch call may have written"""
+    try:
+        return [file_patch.path for file_patch in parse_patch(patch_text or '') if file_patch.path]
+    except PatchError:
+        return []
+
+def exchange_starts(messages):
+    """Indexes of user messages, where whole exchanges can be cut"""
+    return [index for index, message in enumerate(messages) if message.get('role') == 'user']
+
+def compact_messages(model_id, messages, budget):
+    """Fit messages into budget tokens and return (messages, stats)"""
+    sizes = [token_estimator.message_tokens(model_id, message) for message in messages]
+    before = sum(sizes)
+    compacted, stubbed = stub_superseded(messages)
+    sizes = [token_estimator.message_tokens(model_id, message) for message in compacted]
+    total = sum(sizes)
+    dropped = 0
+
+    # Over budget: stub older tool results, oldest first, but keep the
+    # results of the most recent tool round the model is about to read
+    if total > budget:
+        last_assistant = max((i for i, m in enumerate(compacted) if m.get('role') == 'assistant'), default=len(compacted))
+        for index in range(last_assistant):
+            if total <= budget:
+                break
+            message = compacted[index]
+            if message.get('role') == 'tool' and sizes[index] > 50:
+                compacted[index] = stub_tool_message(message, "Result omitted to fit the context window. Call the tool again if you need it.")
+                new_size = token_estimator.message_tokens(model_id, compacted[index])
+                total -= sizes[index] - new_size
+                sizes[index] = new_size
+                stubbed += 1
+
+    # Still over: drop the oldest whole exchanges, keeping system messages
+    # and everything from the last user message on
+    if total > budget:
+        starts = exchange_starts(compacted)
+        cut = None
+        for start, end in zip(starts, starts[1:]):
+            if total <= budget:
+                break
+            total -= sum(sizes[start:end])
+            dropped += end - start
+            cut = end
+        if cut is not None:
+            keep = [i for i, m in enumerate(compacted) if m.get('role') == 'system' and i < starts[0]]
+            compacted = [compacted[i] for i in keep] + compacted[cut:]
+
+    stats = {
+        'tokens_before': before,
+        'tokens_after': total,
+        'tokens_saved': before - total,
+        'budget': budget,
+        'stubbed': stubbed,
+        'dropped': dropped
+    }
+    return compacted, stats
+
+def prepare_chat_request(data):
+    """Build the upstream client, payload and limits for a chat request.
+
+    Shared by the blocking and streaming variants of /api/chat so both send
+    exactly the same prompt, tools and limits upstream.
+    """
+    model = data.get('model')
+    messages = data.get('messages', [])
+    repo_context = data.get('repo_context')  # {repo, branch}
+
+    # Determine if this is a local or cloud model
+    use_local = is_local_model(model)
+
+    if use_local:
+        # Local Ollama model
+        client = ollama_client
+        actual_model = get_ollama_model_id(model)
+    else:
+        # Nebius cloud model
+        client = nebius_client
+        actual_model = model
+
+    # Add system prompt for efficient tool usage when repo is connected
+    if repo_context:
+        # Prepend system message if not already present
+        if not messages or messages[0].get('role') != 'system':
+            messages = [{'role': 'system', 'content': REPO_SYSTEM_PROMPT}] + messages
+
+    # Define tools for GitHub file operations
+    tools = build_repo_tools(repo_context) if repo_context else []
+
+    # Local models are much slower (CPU inference); use a smaller default
+    default_max_tokens = 512 if use_local else 4000
+    payload = {
+        'model': actual_model,
+        'messages': messages,
+        'temperature': data.get('temperature', 0.7),
+        'max_tokens': data.get('max_tokens', default_max_tokens)
+    }
+
+    # Add tools for cloud models, and for local models that have reliable
+    # function calling support (llama3.1, qwen2.5, qwen2.5-coder).
+    # Other local models stall or produce malformed tool call responses.
+    if tools and (not use_local or local_model_supports_tools(model)):
+        payload['tools'] = tools
+        payload['tool_choice'] = 'auto'
+        # Local models need more tokens to fit tool call JSON
+        if use_local and 'max_tokens' not in data:
+            payload['max_tokens'] = 2048
+
+    # Fit the conversation to the model's context window
+    compaction = None
+    if CONTEXT_COMPACTION and data.get('compact', True):
+        budget = context_budget(model, payload['max_tokens'], payload.get('tools'))
+        payload['messages'], compaction = compact_messages(model, payload['messages'], budget)
+        token_estimator.record(compaction)
+
+    # Keep timeout under Render's ~60s proxy limit so we return a clean
+    # error instead of a 502. Cloud models get a longer budget.
+    timeout = 55 if use_local else 120
+
+    return {
+        'client': client,
+        'payload': payload,
+        'use_local': use_local,
+        'timeout': timeout,
+        'model': model,
+        'compaction': compaction
+    }
+
+def record_usage(upstream, usage):
+    """Feed the reported prompt size back into the token estimator"""
+    if not usage:
+        return
+    payload = upstream['payload']
+    prompt_bytes = sum(len(message_text(message).encode('utf-8')) for message in payload['messages'])
+    if payload.get('tools'):
+        prompt_bytes += len(json.dumps(payload['tools']).encode('utf-8'))
+    token_estimator.observe(upstream['model'], prompt_bytes, usage.get('prompt_tokens'))
+
+def sse_event(event, data):
+    """Format a single Server-Sent Events frame"""
+    trace = current_trace.get()
+    if trace is None:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    started = time.perf_counter()
+    frame = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    trace.tally('json:serialize events', time.perf_counter() - started)
+    return frame
+
+class StreamAccumulator:
+    """Assemble OpenAI-style streaming deltas into a complete message.
+
+    Tool calls arrive as fragments keyed by index: the first fragment carries
+    the id and function name, later ones append to the JSON arguments string.
+    """
+
+    def __init__(self):
+        self.content = ''
+        self.reasoning_content = ''
+        self.tool_calls = {}
+        self.finish_reason = None
+        self.usage = None
+        self.model = None
+
+    def add(self, chunk):
+        """Merge one upstream chunk and return the events to relay"""
+        events = []
+        self.model = chunk.get('model') or self.model
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+
+        for choice in chunk.get('choices') or []:
+            delta = choice.get('delta') or {}
+            if choice.get('finish_reason'):
+                self.finish_reason = choice['finish_reason']
+
+            if delta.get('content'):
+                self.content += delta['content']
+                events.append(('delta', {'content': delta['content']}))
+
+            if delta.get('reasoning_content'):
+                self.reasoning_content += delta['reasoning_content']
+                events.append(('reasoning', {'content': delta['reasoning_content']}))
+
+            for fragment in delta.get('tool_calls') or []:
+                index = fragment.get('index', len(self.tool_calls))
+                call = self.tool_calls.setdefault(index, {
+                    'id': None,
+                    'type': 'function',
+                    'function': {'name': '', 'arguments': ''}
+                })
+                function = fragment.get('function') or {}
+                if fragment.get('id'):
+                    call['id'] = fragment['id']
+                if function.get('name'):
+                    call['function']['name'] += function['name']
+                if function.get('arguments'):
+                    call['function']['arguments'] += function['arguments']
+                events.append(('tool_call', {
+                    'index': index,
+                    'id': call['id'],
+                    'name': call['function']['name'],
+                    'arguments_delta': function.get('arguments', '')
+                }))
+
+        return events
+
+    def message(self):
+        """The assembled assistant message in non-streaming format"""
+        message = {'role': 'assistant', 'content': self.content or None}
+        if self.reasoning_content:
+            message['reasoning_content'] = self.reasoning_content
+        if self.tool_calls:
+            message['tool_calls'] = []
+            for index in sorted(self.tool_calls):
+                call = self.tool_calls[index]
+                if not call['id']:
+                    call['id'] = f"call_{index}"
+                message['tool_calls'].append(call)
+        return message
+
+    def result(self):
+        """A full chat completion response equivalent to stream=False"""
+        result = {
+            'object': 'chat.completion',
+            'model': self.model,
+            'choices': [{
+                'index': 0,
+                'message': self.message(),
+                'finish_reason': self.finish_reason
+            }]
+        }
+        if self.usage:
+            result['usage'] = self.usage
+        return result
+
+def iter_upstream_stream(client, payload, timeout):
+    """Yield parsed chunks from an OpenAI-compatible streaming completion"""
+    payload = dict(payload, stream=True, stream_options={'include_usage': True})
+    with client.post(payload, timeout, stream=True) as response:
+        response.raise_for_status()
+        # SSE responses often omit a charset; the spec mandates UTF-8
+        response.encoding = 'utf-8'
+        # Read through to the end of the body even after [DONE] so the
+        # connection goes back to the pool instead of being discarded
+        trace = current_trace.get()
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            chunk = line[5:].strip()
+            if chunk == '[DONE]':
+                continue
+            if trace is None:
+                yield json.loads(chunk)
+            else:
+                started = time.perf_counter()
+                parsed = json.loads(chunk)
+                trace.tally('json:parse upstream chunks', time.perf_counter() - started)
+                yield parsed
+
+def describe_upstream_error(e, use_local):
+    """Human-readable message for a failed upstream completion"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return f"HTTP {e.response.status_code}: {e.response.text}"
+    if isinstance(e, requests.exceptions.Timeout):
+        if use_local:
+            return "Local model timed out (>55s). Try a smaller model or a shorter prompt."
+        return "Request timed out"
+    return str(e)
+
+# Model routing. Every upstream call is timed and scored per model id and
+# per endpoint. Repeated failures, including replies that come back close to
+# the timeout, open a circuit breaker; while it is open, requests for that
+# model go to FALLBACK_MODEL instead of waiting out another timeout. After
+# ROUTER_COOLDOWN seconds a single trial request is let through to probe it.
+FALLBACK_MODEL = os.environ.get('FALLBACK_MODEL', 'Qwen/Qwen3-Coder-30B-A3B-Instruct')
+ROUTER_FAILURE_THRESHOLD = int(os.environ.get('ROUTER_FAILURE_THRESHOLD', '3'))
+ROUTER_COOLDOWN = float(os.environ.get('ROUTER_COOLDOWN', '60'))
+ROUTER_WINDOW = int(os.environ.get('ROUTER_WINDOW', '50'))
+ROUTER_SLOW_FRACTION = 0.8  # replies slower than this share of the timeout count as failures
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CircuitBreaker:
+    """closed -> open after repeated failures -> half_open trial -> closed"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+
+    def allow(self):
+        """Whether a request may go through; claims the trial slot when half-open"""
+        if self.state == 'closed':
+            return True
+        now = time.time()
+        if self.state == 'open' and now - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self.trial_started = None
+        if self.state == 'half_open' and (self.trial_started is None or now - self.trial_started > self.cooldown):
+            self.trial_started = now
+            return True
+        return False
+
+    def available(self):
+        """Like allow() but without claiming the trial slot"""
+        if self.state == 'open':
+            return time.time() - self.opened_at >= self.cooldown
+        return self.state == 'closed' or self.trial_started is None
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_started = None
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            self.state = 'open'
+            self.opened_at = time.time()
+            self.trial_started = None
+
+    def describe(self):
+        info = {'state': self.state, 'failures': self.failures}
+        if self.state == 'open':
+            info['retry_in'] = round(max(0, self.cooldown - (time.time() - self.opened_at)), 1)
+        return info
+
+class ModelRouter:
+    """Rolling per-model health, circuit breakers and fallback decisions"""
+
+    def __init__(self, fallback_model, threshold, cooldown, window):
+        self.fallback_model = fallback_model
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.window = window
+        self.breakers = {}
+        self.samples = {}
+        self.decisions = deque(maxlen=50)
+        self._lock = threading.Lock()
+
+    def route(self, model_id, allow_fallback=True):
+        """Return (model to call, reason) for a requested model"""
+        endpoint = upstream_endpoint(model_id)
+        with self._lock:
+            # Check the endpoint first so a dead tunnel never uses up the model's trial slot
+            endpoint_ok = self._breaker(endpoint).allow()
+            model_ok = endpoint_ok and self._breaker(model_id).allow()
+        if endpoint_ok and model_ok:
+            return model_id, None
+        reason = f"circuit open for {endpoint if not endpoint_ok else model_id}"
+        fallback = self.fallback_for(model_id) if allow_fallback else None
+        self._decide(model_id, fallback or model_id, reason)
+        return fallback or model_id, reason
+
+    def fallback_for(self, model_id):
+        """The fallback model if it differs from model_id and looks healthy"""
+        fallback = self.fallback_model
+        if not fallback or fallback == model_id or not get_model_info(fallback):
+            return None
+        if not (OLLAMA_API_URL if is_local_model(fallback) else NEBIUS_API_KEY):
+            return None
+        with self._lock:
+            if not (self._breaker(fallback).available() and self._breaker(upstream_endpoint(fallback)).available()):
+                return None
+        return fallback
+
+    def record(self, upstream, seconds, error=None, usage=None, first_token=None):
+        """Score one upstream call and update the breakers"""
+        model_id = upstream['model']
+        endpoint = upstream['client'].name
+        failed = error is not None and is_upstream_failure(error)
+        slow = error is None and seconds > upstream['timeout'] * ROUTER_SLOW_FRACTION
+        completion_tokens = (usage or {}).get('completion_tokens')
+        generating = seconds - (first_token or 0)
+        sample = {
+            'at': time.time(),
+            'seconds': seconds,
+            'ok': not failed,
+            'first_token': first_token,
+            'tokens_per_sec': completion_tokens / generating if completion_tokens and generating > 0 else None
+        }
+        observe_upstream(model_id, endpoint, seconds, failed or error is not None, usage, first_token, sample['tokens_per_sec'])
+        with self._lock:
+            self.samples.setdefault(model_id, deque(maxlen=self.window)).append(sample)
+            if failed:
+                self._breaker(model_id).failure()
+                self._breaker(endpoint).failure()
+            elif slow:
+                self._breaker(model_id).failure()
+                self._breaker(endpoint).success()
+            elif error is None:
+                self._breaker(model_id).success()
+                self._breaker(endpoint).success()
+
+    def note_fallback(self, requested, model_id, reason):
+        self._decide(requested, model_id, reason)
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model_id, samples in self.samples.items():
+                samples = list(samples)
+                latencies = [s['seconds'] for s in samples if s['ok']]
+                ttfts = [s['first_token'] for s in samples if s['first_token'] is not None]
+                rates = [s['tokens_per_sec'] for s in samples if s['tokens_per_sec']]
+                models[model_id] = {
+                    'requests': len(samples),
+                    'error_rate': round(sum(1 for s in samples if not s['ok']) / len(samples), 3),
+                    'latency_p50': percentile(latencies, 0.5),
+                    'latency_p95': percentile(latencies, 0.95),
+                    'ttft_p50': percentile(ttfts, 0.5),
+                    'tokens_per_sec': round(sum(rates) / len(rates), 1) if rates else None,
+                    'breaker': self._breaker(model_id).describe()
+                }
+            breakers = {key: breaker.describe() for key, breaker in self.breakers.items()}
+            return {
+                'fallback_model': self.fallback_model,
+                'models': models,
+                'breakers': breakers,
+                'decisions': list(self.decisions)
+            }
+
+    def _breaker(self, key):
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(self.threshold, self.cooldown)
+        return self.breakers[key]
+
+    def _decide(self, requested, model_id, reason):
+        self.decisions.append({
+            'at': datetime.utcnow().isoformat() + 'Z',
+            'requested': requested,
+            'model': model_id,
+            'reason': reason
+        })
+
+def observe_upstream(model_id, endpoint, seconds, failed, usage, first_token, tokens_per_sec):
+    """Export one upstream call to /api/metrics and the current trace"""
+    model = model_id if get_model_info(model_id) else 'other'
+    trace_span('upstream', f"{endpoint} {model_id}", time.time() - seconds, model=model_id, failed=failed,
+               first_token_ms=None if first_token is None else round(first_token * 1000, 1),
+               prompt_tokens=(usage or {}).get('prompt_tokens'), completion_tokens=(usage or {}).get('completion_tokens'))
+    metrics.observe('llm_upstream_duration_seconds', seconds,
+                    {'model': model, 'endpoint': endpoint, 'outcome': 'error' if failed else 'ok'})
+    if first_token is not None:
+        metrics.observe('llm_time_to_first_token_seconds', first_token, {'model': model})
+    if usage:
+        metrics.inc('llm_prompt_tokens_total', {'model': model}, usage.get('prompt_tokens') or 0)
+        metrics.inc('llm_completion_tokens_total', {'model': model}, usage.get('completion_tokens') or 0)
+    if tokens_per_sec:
+        metrics.observe('llm_tokens_per_second', tokens_per_sec, {'model': model})
+
+model_router = ModelRouter(FALLBACK_MODEL, ROUTER_FAILURE_THRESHOLD, ROUTER_COOLDOWN, ROUTER_WINDOW)
+
+def upstream_endpoint(model_id):
+    return ollama_client.name if is_local_model(model_id) else nebius_client.name
+
+def is_upstream_failure(error):
+    """Errors that say the endpoint or model is unhealthy, not the request"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500 or error.response.status_code == 429)
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError))
+
+def prepare_routed_request(data):
+    """prepare_chat_request() for the model the router picks"""
+    model = data.get('model')
+    routed, reason = model_router.route(model, allow_fallback=data.get('fallback', True))
+    upstream = prepare_chat_request(dict(data, model=routed))
+    upstream['routing'] = {'requested': model, 'model': routed, 'fallback': routed != model, 'reason': reason}
+    return upstream
+
+def fallback_request(data, upstream, error, streaming):
+    """Upstream for the fallback model after a failed call, or None.
+
+    Blocking requests only fall back on errors that fail fast; after a read
+    timeout the client has already waited the full budget.
+    """
+    if upstream['routing']['fallback'] or not data.get('fallback', True) or not is_upstream_failure(error):
+        return None
+    if isinstance(error, requests.exceptions.ReadTimeout) and not streaming:
+        return None
+    requested = upstream['routing']['requested']
+    fallback = model_router.fallback_for(upstream['model'])
+    if not fallback:
+        return None
+    if isinstance(error, requests.exceptions.HTTPError):
+        reason = f"{upstream['model']} returned HTTP {error.response.status_code}"
+    else:
+        reason = f"{upstream['model']} failed: {type(error).__name__}"
+    model_router.note_fallback(requested, fallback, reason)
+    retry = prepare_chat_request(dict(data, model=fallback))
+    retry['routing'] = {'requested': requested, 'model': fallback, 'fallback': True, 'reason': reason}
+    return retry
+
+# Local model admission. Local models run on CPU, so concurrent requests slow
+# each other down until all of them time out. Each local model admits at most
+# max_concurrency requests at once (from its LOCAL_MODELS entry, otherwise
+# LOCAL_MAX_CONCURRENCY); the rest wait in a bounded queue that takes
+# sessions in turn, and streamed requests see their position and estimated
+# wait. A request predicted to finish later than LOCAL_QUEUE_BUDGET seconds
+# is turned away up front instead of timing out. Queue state is a small JSON
+# file per model in ADMISSION_DIR, changed under flock, so the limits hold
+# across all gunicorn workers.
+LOCAL_MAX_CONCURRENCY = int(os.environ.get('LOCAL_MAX_CONCURRENCY', '2'))
+LOCAL_QUEUE_MAX = int(os.environ.get('LOCAL_QUEUE_MAX', '16'))
+LOCAL_QUEUE_PER_SESSION = int(os.environ.get('LOCAL_QUEUE_PER_SESSION', '2'))
+LOCAL_QUEUE_BUDGET = float(os.environ.get('LOCAL_QUEUE_BUDGET', '120'))
+LOCAL_SERVICE_ESTIMATE = float(os.environ.get('LOCAL_SERVICE_ESTIMATE', '20'))  # seconds per request until measured
+ADMISSION_DIR = os.environ.get('ADMISSION_DIR') or os.path.join(tempfile.gettempdir(), f'llm-dashboard-admission-{os.getppid()}')
+ADMISSION_POLL = 0.25
+ADMISSION_STATUS_INTERVAL = 5  # seconds between repeated queue events, which double as keep-alives
+ADMISSION_MAX_HOLD = 600  # a slot held longer than this is assumed leaked
+ADMISSION_STALE_WAITER = 10  # a waiter that stopped polling this long ago has gone
+
+class AdmissionRejected(Exception):
+    """A local model's queue is too long to take another request"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+class LocalAdmission:
+    """Per-model concurrency limits and a fair queue, shared by all workers.
+
+    A model's state file holds the requests running on it, the requests
+    waiting (each polled by its own request thread) and a moving average of
+    how long a request takes. Waiters are ordered round-robin by session, in
+    order of arrival, so one session's burst cannot starve another's. Entries
+    of dead processes are dropped whenever the file is read.
+    """
+
+    def __init__(self, directory, default_limit, max_queue, per_session, budget, estimate):
+        self.directory = directory
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.per_session = per_session
+        self.budget = budget
+        self.estimate = estimate
+
+    def limit(self, model_id):
+        return int((get_model_info(model_id) or {}).get('max_concurrency') or self.default_limit)
+
+    def wait(self, model_id, key):
+        """Queue for a slot on model_id.
+
+        A generator that yields ('queue', status) while waiting, whenever the
+        position changes and every few seconds, and returns the ticket to
+        pass to release(). Raises AdmissionRejected if the queue is full or
+        the predicted wait is over budget. Closing it leaves the queue.
+        """
+        ticket = os.urandom(8).hex()
+        joined = time.time()
+        settled = False
+        last_position, last_sent = None, 0
+        try:
+            while True:
+                with self._state(model_id) as state:
+                    outcome, status = self._step(state, model_id, ticket, key, joined)
+                if outcome == 'admitted':
+                    settled = True
+                    metrics.observe('local_queue_wait_seconds', time.time() - joined, {'model': model_id})
+                    trace_span('queue', f"wait for {model_id}", joined, model=model_id)
+                    return model_id, ticket
+                if outcome == 'rejected':
+                    settled = True  # _step already left the queue
+                    metrics.inc('local_admission_rejected_total', {'model': model_id})
+                    raise AdmissionRejected(self._describe(status), status)
+                if status['position'] != last_position or time.time() - last_sent >= ADMISSION_STATUS_INTERVAL:
+                    last_position, last_sent = status['position'], time.time()
+                    yield 'queue', status
+                time.sleep(ADMISSION_POLL)
+        finally:
+            if not settled:
+                with self._state(model_id) as state:
+                    state['waiting'] = [entry for entry in state['waiting'] if entry['ticket'] != ticket]
+
+    def acquire(self, model_id, key):
+        """Blocking wait(); returns the ticket"""
+        waiting = self.wait(model_id, key)
+        while True:
+            try:
+                next(waiting)
+            except StopIteration as done:
+                return done.value
+
+    def check(self, model_id, key):
+        """Raise AdmissionRejected if a new request would be turned away now"""
+        with self._state(model_id, save=False) as state:
+            outcome, status = self._step(state, model_id, os.urandom(8).hex(), key, time.time())
+        if outcome == 'rejected':
+            metrics.inc('local_admission_rejected_total', {'model': model_id})
+            raise AdmissionRejected(self._describe(status), status)
+
+    def release(self, ticket, seconds=None):
+        """Free a slot; seconds is how long a completed request took"""
+        model_id, ticket_id = ticket
+        with self._state(model_id) as state:
+            state['running'].pop(ticket_id, None)
+            if seconds is not None:
+                average = state.get('average')
+                state['average'] = seconds if average is None else average * 0.7 + seconds * 0.3
+
+    def stats(self):
+        models = {}
+        for model in LOCAL_MODELS:
+            if not os.path.exists(self._path(model['id'])):
+                continue
+            with self._state(model['id'], save=False) as state:
+                models[model['id']] = {
+                    'limit': self.limit(model['id']),
+                    'running': len(state['running']),
+                    'waiting': len(state['waiting']),
+                    'service_seconds': round(state.get('average') or self.estimate, 1)
+                }
+        return {'budget_seconds': self.budget, 'max_queue': self.max_queue, 'models': models}
+
+    def _step(self, state, model_id, ticket, key, joined):
+        """Join or re-check the queue; returns (outcome, status)"""
+        now = time.time()
+        waiting = state['waiting']
+        entry = next((entry for entry in waiting if entry['ticket'] == ticket), None)
+        if entry is None:
+            entry = {'ticket': ticket, 'session': key, 'pid': os.getpid(), 'enqueued': now}
+            waiting.append(entry)
+        entry['seen'] = now
+
+        limit = self.limit(model_id)
+        ahead = self._order(waiting).index(entry)
+        if ahead < limit - len(state['running']):
+            waiting.remove(entry)
+            state['running'][ticket] = {'session': key, 'pid': os.getpid(), 'started': now}
+            return 'admitted', None
+
+        average = state.get('average') or self.estimate
+        wait = self._predict_wait(state['running'], limit, ahead, average)
+        status = {
+            'model': model_id,
+            'position': ahead + 1,
+            'running': len(state['running']),
+            'limit': limit,
+            'wait_seconds': round(wait, 1),
+            'service_seconds': round(average, 1),
+            'waited_seconds': round(now - joined, 1)
+        }
+        too_many = len(waiting) > self.max_queue or sum(1 for e in waiting if e['session'] == key) > self.per_session
+        if too_many or now - joined + wait + average > self.budget:
+            waiting.remove(entry)
+            return 'rejected', status
+        return 'waiting', status
+
+    def _order(self, waiting):
+        """Waiting entries in admission order: one per session per round, oldest session first"""
+        by_session = {}
+        for entry in sorted(waiting, key=lambda entry: entry['enqueued']):
+            by_session.setdefault(entry['session'], []).append(entry)
+        rounds = max((len(entries) for entries in by_session.values()), default=0)
+        return [entries[i] for i in range(rounds) for entries in by_session.values() if i < len(entries)]
+
+    def _predict_wait(self, running, limit, ahead, average):
+        """Seconds until a slot is free for a request with `ahead` requests before it"""
+        now = time.time()
+        slots = sorted(max(0.0, average - (now - slot['started'])) for slot in running.values())[:limit]
+        slots += [0.0] * (limit - len(slots))
+        heapq.heapify(slots)
+        for _ in range(ahead):
+            heapq.heapreplace(slots, slots[0] + average)
+        return slots[0]
+
+    def _describe(self, status):
+        model = (get_model_info(status['model']) or {}).get('name', status['model'])
+        return (f"{model} is busy: {status['position'] - 1} request(s) ahead, about {round(status['wait_seconds'])}s "
+                f"wait. Try again shortly or pick a cloud model.")
+
+    def _path(self, model_id):
+        return os.path.join(self.directory, hashlib.sha1(model_id.encode()).hexdigest()[:16] + '.json')
+
+    @contextlib.contextmanager
+    def _state(self, model_id, save=True):
+        """The model's queue state, locked against every other worker"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(model_id), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                state.setdefault('running', {})
+                state.setdefault('waiting', [])
+                self._prune(state)
+                yield state
+                if save:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _prune(self, state):
+        now = time.time()
+        state['running'] = {ticket: slot for ticket, slot in state['running'].items()
+                            if now - slot['started'] < ADMISSION_MAX_HOLD and pid_alive(slot['pid'])}
+        state['waiting'] = [entry for entry in state['waiting']
+                            if now - entry.get('seen', entry['enqueued']) < ADMISSION_STALE_WAITER and pid_alive(entry['pid'])]
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def admission_key(data):
+    """Who a local model request is queued for: its session, else the client address"""
+    if data.get('session_id'):
+        return f"session:{data['session_id']}"
+    if has_request_context():
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        return f"client:{forwarded.split(',')[0].strip() or request.remote_addr}"
+    return 'anonymous'
+
+def admission_rejected_response(e):
+    retry_after = max(1, round(e.status['wait_seconds']))
+    return jsonify({"error": str(e), "queue": e.status}), 503, {'Retry-After': str(retry_after)}
+
+local_admission = LocalAdmission(ADMISSION_DIR, LOCAL_MAX_CONCURRENCY, LOCAL_QUEUE_MAX, LOCAL_QUEUE_PER_SESSION,
+                                 LOCAL_QUEUE_BUDGET, LOCAL_SERVICE_ESTIMATE)
+
+def post_completion(data, upstream):
+    """Blocking completion through the router; returns (result, upstream used)"""
+    while True:
+        ticket = local_admission.acquire(upstream['model'], admission_key(data)) if upstream['use_local'] else None
+        started = time.time()
+        completed = False
+        try:
+            response = upstream['client'].post(upstream['payload'], upstream['timeout'])
+            response.raise_for_status()
+            with traced('json', 'parse upstream response', bytes=len(response.content)):
+                result = response.json()
+            completed = True
+        except Exception as e:
+            model_router.record(upstream, time.time() - started, error=e)
+            retry = fallback_request(data, upstream, e, streaming=False)
+            if not retry:
+                raise
+            upstream = retry
+            continue
+        finally:
+            if ticket:
+                local_admission.release(ticket, time.time() - started if completed else None)
+        model_router.record(upstream, time.time() - started, usage=result.get('usage'))
+        record_usage(upstream, result.get('usage'))
+        return result, upstream
+
+def routed_stream(data, upstream, key=None):
+    """Stream a completion through the router.
+
+    Yields ('upstream', upstream) whenever the serving model is chosen,
+    ('queue', status) while waiting for a busy local model and ('chunk',
+    chunk) for each upstream chunk. A failure before the first chunk
+    switches to the fallback model; later failures are raised. key is the
+    local queue key, for callers off the request thread.
+    """
+    while True:
+        yield 'upstream', upstream
+        ticket = None
+        if upstream['use_local']:
+            ticket = yield from local_admission.wait(upstream['model'], key or admission_key(data))
+        started = time.time()
+        first_token = None
+        usage = None
+        completed = False
+        try:
+            for chunk in iter_upstream_stream(upstream['client'], upstream['payload'], upstream['timeout']):
+                if first_token is None:
+                    first_token = time.time() - started
+                usage = chunk.get('usage') or usage
+                yield 'chunk', chunk
+            completed = True
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            watcher = upstream_abort.get()
+            if watcher is not None and watcher.aborted:
+                raise  # cancelled by the caller, not the model's fault
+            model_router.record(upstream, time.time() - started, error=e, first_token=first_token)
+            retry = fallback_request(data, upstream, e, streaming=True) if first_token is None else None
+            if not retry:
+                raise
+            upstream = retry
+            continue
+        finally:
+            if ticket:
+                local_admission.release(ticket, time.time() - started if completed else None)
+        model_router.record(upstream, time.time() - started, usage=usage, first_token=first_token)
+        record_usage(upstream, usage)
+        return
+
+def stream_chat(data, upstream, session_id=None, cache_key=None):
+    """Relay an upstream completion to the browser as Server-Sent Events.
+
+    cache_key is (key, head) when the finished answer should be cached.
+    """
+
+    def generate():
+        # Flush headers right away so proxies see a live connection
+        yield ': stream open\n\n'
+        accumulator = StreamAccumulator()
+        current = upstream
+        try:
+            for kind, item in routed_stream(data, upstream):
+                if kind == 'upstream':
+                    current = item
+                    if item['routing']['fallback']:
+                        yield sse_event('routing', item['routing'])
+                    continue
+                if kind == 'queue':
+                    yield sse_event('queue', item)
+                    continue
+                for event, event_data in accumulator.add(item):
+                    yield sse_event(event, event_data)
+            result = accumulator.result()
+            result['routing'] = current['routing']
+            if current['compaction']:
+                result['compaction'] = current['compaction']
+            if cache_key:
+                store_response(*cache_key, result, current)
+            if session_id:
+                result['session'] = record_reply(session_id, accumulator.message())
+            yield sse_event('done', result)
+        except AdmissionRejected as e:
+            yield sse_event('error', {"error": str(e), "queue": e.status})
+        except Exception as e:
+            yield sse_event('error', {"error": describe_upstream_error(e, current['use_local'])})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Response cache. A chat request sent with temperature 0, or with
+# "cache": true, is answered from a cache when the same request was answered
+# before. The key is a hash of the model, the normalised conversation (tool
+# call ids renumbered, whitespace around text trimmed), the tools, the
+# sampling parameters and, with a repository, the branch head commit, so
+# answers expire as soon as the code changes. Branches with uncommitted or
+# staged edits are not cached. Entries are JSON files in RESPONSE_CACHE_DIR
+# shared by all workers; a hit refreshes the file's mtime, and once the
+# directory grows past RESPONSE_CACHE_MAX_BYTES the least recently used
+# files are deleted. Fallback answers and failed requests are never stored.
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'true').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR') or os.path.join(tempfile.gettempdir(), f'llm-dashboard-responses-{os.getppid()}')
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+class ResponseCache:
+    """Completed chat responses by request hash, in files shared by all workers"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def key(self, data, head=None):
+        """Hash of everything that decides the answer"""
+        repo_context = data.get('repo_context')
+        request_data = {
+            'model': data.get('model'),
+            'messages': normalized_messages(data.get('messages', [])),
+            'system': REPO_SYSTEM_PROMPT if repo_context else None,
+            'tools': build_repo_tools(repo_context) if repo_context else [],
+            'temperature': data.get('temperature', 0.7),
+            'max_tokens': data.get('max_tokens'),
+            'compact': CONTEXT_COMPACTION and data.get('compact', True),
+            'repo': repo_context and repo_context.get('repo'),
+            'head': head
+        }
+        encoded = json.dumps(request_data, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """The stored entry, or None"""
+        started = time.perf_counter()
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self._count('misses')
+            metrics.inc('llm_response_cache_total', {'result': 'miss'})
+            trace_span('cache', 'response cache miss', started)
+            return None
+        self._count('hits')
+        metrics.inc('llm_response_cache_total', {'result': 'hit'})
+        trace_span('cache', 'response cache hit', started)
+        return entry
+
+    def put(self, key, result, head=None):
+        entry = {'key': key, 'head': head, 'stored_at': time.time(),
+                 'result': {name: value for name, value in result.items() if name not in ('session', 'compaction', 'cache')}}
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._path(key))
+        self._count('stores')
+        metrics.inc('llm_response_cache_total', {'result': 'store'})
+        self._evict()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'max_bytes': self.max_bytes,
+            'enabled': RESPONSE_CACHE
+        }
+
+    def _evict(self):
+        """Delete least recently used entries until the directory fits max_bytes"""
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries, total = [], 0
+            for item in os.scandir(self.directory):
+                if not item.name.endswith('.json'):
+                    continue
+                try:
+                    stat = item.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._count('evictions')
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+response_cache = ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES)
+
+def normalized_messages(messages):
+    """Messages reduced to what the model sees, with tool call ids numbered in order"""
+    call_ids = {}
+
+    def call_id(value):
+        return call_ids.setdefault(value, f"call_{len(call_ids)}") if value else None
+
+    def arguments(text):
+        try:
+            return json.loads(text or '{}')
+        except ValueError:
+            return text
+
+    normalized = []
+    for message in messages:
+        content = message.get('content')
+        entry = {'role': message.get('role'), 'content': content.strip() if isinstance(content, str) else content}
+        if message.get('name'):
+            entry['name'] = message['name']
+        if message.get('tool_call_id'):
+            entry['tool_call_id'] = call_id(message['tool_call_id'])
+        if message.get('tool_calls'):
+            entry['tool_calls'] = [{
+                'id': call_id(call.get('id')),
+                'name': (call.get('function') or {}).get('name'),
+                'arguments': arguments((call.get('function') or {}).get('arguments'))
+            } for call in message['tool_calls']]
+        normalized.append(entry)
+    return normalized
+
+def wants_response_cache(data):
+    """Cache at temperature 0, or when the client asks; "cache": false opts out"""
+    if not RESPONSE_CACHE or data.get('cache') is False:
+        return False
+    return data.get('cache') is True or data.get('temperature', 0.7) == 0
+
+def repo_head(repo_context):
+    """Commit the branch is at, or None while it has edits not yet committed"""
+    repo, branch = repo_context['repo'], repo_context['branch']
+    if git_mirror.has(repo, branch):
+        return None if git_mirror.pending(repo, branch) else git_mirror.head(repo, branch)
+    if staged_changes.pending(repo, branch):
+        return None
+    return tree_indexes.head(repo, branch)
+
+def response_cache_key(data):
+    """(key, head) for a cacheable request, else (None, None)"""
+    if not wants_response_cache(data):
+        return None, None
+    head = None
+    if data.get('repo_context'):
+        try:
+            head = repo_head(data['repo_context'])
+        except Exception as e:
+            app.logger.warning("Response cache skipped, branch head unknown: %s", e)
+            return None, None
+        if head is None:
+            return None, None
+    return response_cache.key(data, head), head
+
+def cached_response(entry):
+    """The stored completion marked as a cache hit"""
+    result = entry['result']
+    result['cache'] = {'hit': True, 'key': entry['key'], 'head': entry['head'],
+                       'age_seconds': round(time.time() - entry['stored_at'], 1)}
+    return result
+
+def store_response(key, head, result, upstream):
+    """Keep a successful, non-fallback answer; failures to write are only logged"""
+    finish_reason = (result.get('choices') or [{}])[0].get('finish_reason')
+    if upstream['routing']['fallback'] or finish_reason not in ('stop', 'length', 'tool_calls'):
+        result['cache'] = {'hit': False, 'stored': False}
+        return
+    try:
+        response_cache.put(key, result, head)
+        result['cache'] = {'hit': False, 'stored': True, 'key': key, 'head': head}
+    except OSError as e:
+        app.logger.warning("Could not store cached response: %s", e)
+        result['cache'] = {'hit': False, 'stored': False}
+
+def replay_chat(result, session_id=None):
+    """Send a cached completion as the same Server-Sent Events a live stream would"""
+
+    def generate():
+        yield ': stream open\n\n'
+        message = result['choices'][0]['message']
+        if message.get('reasoning_content'):
+            yield sse_event('reasoning', {'content': message['reasoning_content']})
+        if message.get('content'):
+            yield sse_event('delta', {'content': message['content']})
+        for index, call in enumerate(message.get('tool_calls') or []):
+            yield sse_event('tool_call', {'index': index, 'id': call['id'], 'name': call['function']['name'],
+                                          'arguments_delta': call['function']['arguments']})
+        if session_id:
+            result['session'] = record_reply(session_id, message)
+        yield sse_event('done', result)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Cache': 'HIT'
+    })
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    data = request.json
+    model = data.get('model')
+    session_id = data.get('session_id')
+
+    # With a session the client only sends the messages it added since
+    if session_id:
+        try:
+            with traced('cache', 'session load'):
+                data = session_context(data)
+        except SessionConflict as e:
+            return session_conflict_response(e)
+    messages = data.get('messages', [])
+
+    if not model or not messages:
+        return jsonify({"error": "Model and messages are required"}), 400
+
+    use_local = is_local_model(model)
+
+    try:
+        # A repeated deterministic request is answered without going upstream
+        cache_key, head = response_cache_key(data)
+        entry = response_cache.get(cache_key) if cache_key else None
+        if entry:
+            result = cached_response(entry)
+            if data.get('stream'):
+                return replay_chat(result, session_id)
+            if session_id:
+                result['session'] = record_reply(session_id, result['choices'][0]['message'])
+            response = jsonify(result)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        upstream = prepare_routed_request(data)
+
+        # Turn a busy local model down now rather than after a long wait
+        if upstream['use_local']:
+            local_admission.check(upstream['model'], admission_key(data))
+
+        # Streaming variant: relay tokens as they are generated
+        if data.get('stream'):
+            return stream_chat(data, upstream, session_id, (cache_key, head) if cache_key else None)
+
+        result, upstream = post_completion(data, upstream)
+
+        # Ensure the response has the expected OpenAI format
+        if 'choices' not in result or not result['choices']:
+            return jsonify({"error": f"Unexpected API response format - no choices: {result}"}), 500
+
+        # Validate that the first choice has a message
+        first_choice = result['choices'][0]
+        if 'message' not in first_choice:
+            return jsonify({"error": f"Unexpected API response format - no message in choice: {first_choice}"}), 500
+
+        result['routing'] = upstream['routing']
+        if upstream['compaction']:
+            result['compaction'] = upstream['compaction']
+        if cache_key:
+            store_response(cache_key, head, result, upstream)
+        if session_id:
+            result['session'] = record_reply(session_id, first_choice['message'])
+
+        with traced('json', 'serialize response'):
+            return jsonify(result)
+    
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except requests.exceptions.HTTPError as e:
+        error_msg = f"HTTP {e.response.status_code}: {e.response.text}"
+        return jsonify({"error": error_msg}), 500
+    except requests.exceptions.Timeout:
+        if use_local:
+            return jsonify({"error": "Local model timed out (>55s). Try a smaller model or a shorter prompt."}), 504
+        return jsonify({"error": "Request timed out"}), 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Fan-out. /api/chat/fanout sends one conversation to several models at once
+# and streams every model's tokens as they arrive, tagged with the model,
+# then its result with latency and token usage. Each model runs on the
+# shared fan-out pool without tools or fallback, so every answer really comes
+# from the model that was asked. In "first" mode the first answer that
+# passes the acceptance checks wins and the others are cancelled: their
+# upstream sockets are shut down, which ends even a call still waiting for
+# its first token, and a cancelled call is not held against the model by the
+# router. Each worker runs at most FANOUT_MAX_RUNS fan-outs at once, with a
+# pool thread for every model of each; more are turned away with a 429
+# rather than queued silently behind running generations.
+FANOUT_MAX_MODELS = int(os.environ.get('FANOUT_MAX_MODELS', '6'))
+FANOUT_MAX_RUNS = int(os.environ.get('FANOUT_MAX_RUNS', '4'))
+FANOUT_KEEPALIVE = 15  # seconds of upstream silence before a keep-alive comment
+
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_MAX_MODELS * FANOUT_MAX_RUNS, thread_name_prefix='fanout')
+fanout_runs = threading.BoundedSemaphore(FANOUT_MAX_RUNS)
+
+def fanout_acceptance(accept):
+    """Validated acceptance checks for first mode; raises ValueError"""
+    accept = dict(accept or {})
+    unknown = set(accept) - {'min_chars', 'contains', 'pattern', 'allow_truncated'}
+    if unknown:
+        raise ValueError(f"Unknown accept option(s): {', '.join(sorted(unknown))}")
+    if accept.get('pattern'):
+        try:
+            accept['pattern'] = re.compile(accept['pattern'])
+        except re.error as e:
+            raise ValueError(f"Invalid accept pattern: {e}")
+    accept['min_chars'] = int(accept.get('min_chars') or 1)
+    return accept
+
+def acceptable_answer(result, accept):
+    """(acceptable, reason) for one model's result"""
+    if result.get('error'):
+        return False, 'failed'
+    content = (result.get('content') or '').strip()
+    if len(content) < accept['min_chars']:
+        return False, 'too short' if content else 'empty answer'
+    if result.get('finish_reason') == 'length' and not accept.get('allow_truncated'):
+        return False, 'truncated at max_tokens'
+    if accept.get('contains') and accept['contains'].lower() not in content.lower():
+        return False, f"does not contain {accept['contains']!r}"
+    if accept.get('pattern') and not accept['pattern'].search(content):
+        return False, 'does not match pattern'
+    return True, None
+
+def fanout_model(data, index, key, events, cancelled, abort):
+    """Stream one model's answer onto the events queue; runs on the fan-out pool"""
+    model = data['model']
+    started = time.time()
+    first_token = None
+    accumulator = StreamAccumulator()
+    stream = None
+    upstream_abort.set(abort)
+    try:
+        upstream = prepare_routed_request(data)
+        stream = routed_stream(data, upstream, key)
+        for kind, item in stream:
+            if cancelled.is_set():
+                return
+            if kind == 'queue':
+                events.put(('queue', dict(item, model=model)))
+            elif kind == 'chunk':
+                for event, event_data in accumulator.add(item):
+                    if first_token is None:
+                        first_token = time.time() - started
+                    events.put((event, dict(event_data, model=model)))
+        result = {'content': accumulator.content, 'finish_reason': accumulator.finish_reason,
+                  'usage': accumulator.usage}
+        if accumulator.reasoning_content:
+            result['reasoning_content'] = accumulator.reasoning_content
+    except Exception as e:
+        if cancelled.is_set():
+            return
+        result = {'error': describe_upstream_error(e, is_local_model(model))}
+    finally:
+        if stream is not None:
+            stream.close()
+
+    total = time.time() - started
+    completion_tokens = (result.get('usage') or {}).get('completion_tokens')
+    generating = total - first_token if first_token is not None else None
+    result.update(model=model, index=index, latency={
+        'first_token_ms': None if first_token is None else round(first_token * 1000),
+        'total_ms': round(total * 1000),
+        'tokens_per_sec': round(completion_tokens / generating, 1) if completion_tokens and generating else None
+    })
+    events.put(('result', result))
+
+def start_fanout(data, models, mode, accept, key):
+    """Submit every model to the fan-out pool; returns (events, cancel).
+
+    events yields (event, data) pairs ending with 'done'; cancel stops the
+    models still running. The caller holds a fanout_runs slot, released
+    once every model's thread has finished, so the pool always has a
+    thread per model. If this raises, the slot is still the caller's to
+    release.
+    """
+    started = time.time()
+    events = Queue()
+    cancelled = threading.Event()
+    aborts = [UpstreamAbort() for _ in models]
+    running = [len(models)]
+    running_lock = threading.Lock()
+
+    def model_done(_):
+        with running_lock:
+            if running[0] < 0:
+                return  # start_fanout failed and the caller released the slot
+            running[0] -= 1
+            if not running[0]:
+                fanout_runs.release()
+
+    base = {name: data[name] for name in ('messages', 'temperature', 'max_tokens', 'compact') if name in data}
+
+    def cancel():
+        cancelled.set()
+        for abort in aborts:
+            abort.abort()
+
+    try:
+        for index, model in enumerate(models):
+            # Copy the context so metrics and traces of the pool threads count towards this request
+            future = fanout_pool.submit(contextvars.copy_context().run, fanout_model,
+                                        dict(base, model=model, fallback=False), index, key, events, cancelled, aborts[index])
+            future.add_done_callback(model_done)
+    except Exception:
+        # Stop the models already submitted without letting them release the slot
+        with running_lock:
+            running[0] = -1
+        cancel()
+        raise
+
+    return fanout_events(models, mode, accept, events, cancel, started), cancel
+
+def fanout_events(models, mode, accept, events, cancel, started):
+    """(event, data) pairs for a started fan-out, ending with 'done'"""
+    yield 'start', {'models': models, 'mode': mode}
+
+    pending = set(models)
+    results = {}
+    winner = None
+    try:
+        while pending:
+            try:
+                event, payload = events.get(timeout=FANOUT_KEEPALIVE)
+            except Empty:
+                yield None, None
+                continue
+            if event != 'result':
+                yield event, payload
+                continue
+            model = payload['model']
+            pending.discard(model)
+            if mode == 'first':
+                payload['acceptable'], payload['rejected_because'] = acceptable_answer(payload, accept)
+            results[model] = payload
+            yield 'result', payload
+            if mode == 'first' and payload['acceptable']:
+                winner = model
+                cancel()
+                for other in models:
+                    if other in pending:
+                        results[other] = {'model': other, 'index': models.index(other), 'cancelled': True}
+                        yield 'cancelled', results[other]
+                pending.clear()
+    finally:
+        # Also reached when the client disconnects: stop whatever still runs
+        cancel()
+
+    yield 'done', {
+        'mode': mode,
+        'winner': winner,
+        'total_ms': round((time.time() - started) * 1000),
+        'results': [results[model] for model in models]
+    }
+
+@app.route('/api/chat/fanout', methods=['POST'])
+def chat_fanout():
+    """Send one conversation to several models concurrently; streams SSE unless stream is false"""
+    data = request.json or {}
+    models = data.get('models')
+    messages = data.get('messages', [])
+    mode = data.get('mode', 'all')
+
+    if not isinstance(models, list) or not models or not messages:
+        return jsonify({"error": "models (a list) and messages are required"}), 400
+    models = list(dict.fromkeys(str(model) for model in models))
+    if len(models) > FANOUT_MAX_MODELS:
+        return jsonify({"error": f"At most {FANOUT_MAX_MODELS} models per fan-out"}), 400
+    if mode not in ('all', 'first'):
+        return jsonify({"error": "mode must be 'all' or 'first'"}), 400
+    try:
+        accept = fanout_acceptance(data.get('accept'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not fanout_runs.acquire(blocking=False):
+        return jsonify({"error": f"Too many fan-outs running (limit {FANOUT_MAX_RUNS}); try again shortly"}), 429, {'Retry-After': '5'}
+    try:
+        events, cancel = start_fanout(data, models, mode, accept, admission_key(data))
+    except Exception:
+        fanout_runs.release()
+        raise
+    if data.get('stream') is False:
+        for event, payload in events:
+            if event == 'done':
+                return jsonify(payload)
+
+    def generate():
+        yield ': stream open\n\n'
+        try:
+            for event, payload in events:
+                yield ': keep-alive\n\n' if event is None else sse_event(event, payload)
+        finally:
+            events.close()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Covers a client that leaves before the stream starts, when generate() never runs
+    response.call_on_close(cancel)
+    return response
+
+# Repository file access. Decoded file contents are cached by git blob sha,
+# so repeated read_file / edit_file calls skip the GitHub round trip.
+FILE_CACHE_MAX_BYTES = int(os.environ.get('FILE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+FILE_CACHE_DIR = os.environ.get('FILE_CACHE_DIR')  # optional tier shared by all workers
+FILE_CACHE_DISK_MAX_BYTES = int(os.environ.get('FILE_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+FILE_CACHE_BRANCH_TTL = float(os.environ.get('FILE_CACHE_BRANCH_TTL', '300'))
+
+class ByteLRU:
+    """Thread-safe LRU mapping bounded by the total size of its values"""
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        if key in self._items:
+            self.bytes -= self._items.pop(key)[1]
+
+class FileCache:
+    """Branch-aware cache of decoded file contents keyed by git blob sha.
+
+    Contents are addressed by (repo, path, blob sha) and so never go stale;
+    what changes is which sha a branch path points at. That mapping is
+    learned from reads, replaced by our own commits and expires after
+    branch_ttl seconds in case someone else pushes to the branch; a sha the
+    tree index saw more recently overrides it sooner. With a directory
+    configured, blobs and the mapping are also kept on disk so every
+    gunicorn worker shares them and sees our commits. The disk tier is
+    bounded by disk_max_bytes: least recently read blobs and expired
+    mappings are deleted once that much has been written since the last
+    sweep.
+    """
+
+    def __init__(self, max_bytes, directory=None, branch_ttl=300, disk_max_bytes=512 * 1024 * 1024):
+        self.blobs = ByteLRU(max_bytes, sizeof=lambda text: len(text.encode('utf-8')))
+        self.directory = directory
+        self.branch_ttl = branch_ttl
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.disk_evictions = 0
+        self._disk_written = disk_max_bytes  # sweep on the first write
+        self._heads = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+            os.makedirs(os.path.join(directory, 'paths'), exist_ok=True)
+
+    def current_sha(self, repo, branch, path, indexed=None):
+        """The blob sha we last saw at path on branch, if still fresh.
+
+        indexed is (sha, seen_at) from the tree index; when it was seen
+        after our entry was stored and differs, the entry is stale.
+        """
+        entry = self._read_head(repo, branch, path)
+        if not entry or time.time() - entry[1] >= self.branch_ttl:
+            return None
+        if indexed and indexed[0] and indexed[0] != entry[0] and indexed[1] > entry[1]:
+            self._count('stale')
+            return None
+        return entry[0]
+
+    def lookup(self, repo, branch, path, indexed=None):
+        """Return (content, sha) if the file is cached, else None"""
+        sha = self.current_sha(repo, branch, path, indexed)
+        content = self.blobs.get((repo, path, sha)) if sha else None
+        if content is None and sha and self.directory:
+            content = self._read_blob(sha)
+            if content is not None:
+                self.blobs.put((repo, path, sha), content)
+                self._count('disk_hits')
+        if content is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return content, sha
+
+    def store(self, repo, branch, path, sha, content):
+        self.blobs.put((repo, path, sha), content)
+        self._write_head(repo, branch, path, sha)
+        if self.directory:
+            self._write_file(self._blob_path(sha), content)
+            self._maybe_sweep(len(content))
+
+    def invalidate(self, repo, branch, path):
+        with self._lock:
+            self._heads.pop((repo, branch, path), None)
+        if self.directory:
+            try:
+                os.remove(self._head_path(repo, branch, path))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'entries': len(self.blobs),
+            'bytes': self.blobs.bytes,
+            'max_bytes': self.blobs.max_bytes,
+            'disk': bool(self.directory),
+            'disk_evictions': self.disk_evictions
+        }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _read_head(self, repo, branch, path):
+        if not self.directory:
+            return self._heads.get((repo, branch, path))
+        try:
+            with open(self._head_path(repo, branch, path)) as f:
+                entry = json.load(f)
+            return entry['sha'], entry['stored_at']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_head(self, repo, branch, path, sha):
+        with self._lock:
+            self._heads[(repo, branch, path)] = (sha, time.time())
+        if self.directory:
+            self._write_file(self._head_path(repo, branch, path),
+                             json.dumps({'sha': sha, 'stored_at': time.time()}))
+
+    def _read_blob(self, sha):
+        try:
+            with open(self._blob_path(sha), encoding='utf-8') as f:
+                content = f.read()
+            os.utime(self._blob_path(sha))  # mtime marks recent use for the sweep
+            return content
+        except OSError:
+            return None
+
+    def _maybe_sweep(self, written):
+        """Trim the disk tier once a tenth of its budget has been written since the last sweep"""
+        with self._lock:
+            self._disk_written += written
+            if self._disk_written < self.disk_max_bytes / 10:
+                return
+            self._disk_written = 0
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            for item in os.scandir(os.path.join(self.directory, 'paths')):
+                try:
+                    if now - item.stat().st_mtime > self.branch_ttl:
+                        os.remove(item.path)
+                except OSError:
+                    pass
+            blobs, total = [], 0
+            for shard in os.scandir(os.path.join(self.directory, 'blobs')):
+                if not shard.is_dir():
+                    continue
+                for item in os.scandir(shard.path):
+                    try:
+                        stat = item.stat()
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, item.path))
+                    total += stat.st_size
+            for _, size, path in sorted(blobs):
+                if total <= self.disk_max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self._count('disk_evictions')
+
+    def _blob_path(self, sha):
+        return os.path.join(self.directory, 'blobs', sha[:2], sha)
+
+    def _head_path(self, repo, branch, path):
+        key = hashlib.sha1(f"{repo}\0{branch}\0{path}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'paths', key)
+
+    def _write_file(self, target, text):
+        # Write-then-rename so other workers never read a partial file
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        os.replace(tmp, target)
+
+file_cache = FileCache(FILE_CACHE_MAX_BYTES, FILE_CACHE_DIR, FILE_CACHE_BRANCH_TTL, FILE_CACHE_DISK_MAX_BYTES)
+
+# Line ranges and outlines. read_file returns at most READ_FILE_PAGE_LINES
+# lines / READ_FILE_PAGE_BYTES characters at a time and says where to
+# continue, so a big file never lands in the context whole. A single line
+# longer than a page (minified or generated files) is cut too, and continues
+# from start_column. Line start offsets are cached per blob sha, which makes
+# paging through a file cheap.
+READ_FILE_PAGE_LINES = int(os.environ.get('READ_FILE_PAGE_LINES', '400'))
+READ_FILE_PAGE_BYTES = int(os.environ.get('READ_FILE_PAGE_BYTES', str(32 * 1024)))
+LINE_INDEX_MAX_BYTES = 16 * 1024 * 1024
+
+class LineIndex:
+    """Start offset of every line in a text"""
+
+    def __init__(self, content):
+        starts = array('I', [0])
+        position = content.find('\n')
+        while position >= 0:
+            starts.append(position + 1)
+            position = content.find('\n', position + 1)
+        if len(starts) > 1 and starts[-1] == len(content):
+            starts.pop()  # a trailing newline does not start another line
+        self.starts = starts
+        self.length = len(content)
+        self.ends_with_newline = content.endswith('\n')
+
+    @property
+    def lines(self):
+        return len(self.starts) if self.length else 0
+
+    def end(self, line):
+        """Offset just past the given line (1-based)"""
+        return self.starts[line] if line < len(self.starts) else self.length
+
+    def line_length(self, line):
+        """Characters on the given line (1-based), not counting its newline"""
+        length = self.end(line) - self.starts[line - 1]
+        return length - 1 if line < len(self.starts) or self.ends_with_newline else length
+
+    def page(self, start_line, end_line=None, max_lines=400, max_chars=32768, column=1):
+        """(start_line, end_line) clamped to the file and to one page, at least one line.
+
+        The page starts at column of start_line. The first line alone may
+        still be longer than max_chars; the caller cuts it.
+        """
+        start_line = min(max(1, start_line), max(1, self.lines))
+        last = min(end_line or self.lines, self.lines, start_line + max_lines - 1)
+        begin = self.starts[start_line - 1] + column - 1
+        # Last line ending within max_chars of the start
+        fits = bisect.bisect_right(self.starts, begin + max_chars) - 1
+        if self.length - begin <= max_chars:
+            fits = self.lines
+        return start_line, max(start_line, min(last, fits))
+
+line_indexes = ByteLRU(LINE_INDEX_MAX_BYTES, sizeof=lambda index: index.starts.itemsize * len(index.starts) + 64)
+
+def line_index(content, sha=None):
+    """LineIndex of a file, cached by blob sha when there is one"""
+    index = line_indexes.get(sha) if sha else None
+    if index is None:
+        index = LineIndex(content)
+        if sha:
+            line_indexes.put(sha, index)
+    return index
+
+class LineRangeError(ValueError):
+    """A read_file line range outside the file or ending before it starts"""
+
+    def __init__(self, message, total_lines=None):
+        super().__init__(message)
+        self.total_lines = total_lines
+
+def check_line_range(start_line, end_line, total_lines=None):
+    """Raise LineRangeError for an empty range or one starting past the last line"""
+    if end_line is not None and end_line < start_line:
+        span = f"; the file has {total_lines} lines" if total_lines is not None else ""
+        raise LineRangeError(f"end_line {end_line} is before start_line {start_line}{span}. "
+                             f"Use start_line <= end_line.", total_lines)
+    if total_lines is not None and start_line > max(total_lines, 1):
+        raise LineRangeError(f"start_line {start_line} is past the end of the file, which has {total_lines} lines. "
+                             f"Use a start_line from 1 to {max(total_lines, 1)}.", total_lines)
+
+def optional_int(value):
+    """A request or tool argument as an int, or None when omitted; raises ValueError for anything else"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{value} is not a whole number")
+    return int(value)
+
+def check_start_column(start_column, start_line, line_length):
+    """Raise LineRangeError for a start_column past the end of its line"""
+    if start_column > max(line_length, 1):
+        raise LineRangeError(f"start_column {start_column} is past the end of line {start_line}, which has "
+                             f"{line_length} characters. Use a start_column from 1 to {max(line_length, 1)}.")
+
+def read_file_page(path, content, sha, start_line=None, end_line=None, start_column=None):
+    """The read_file result for a file: whole if small, otherwise the requested page.
+
+    A first line longer than a page is cut, and the result says which
+    start_column to continue from. Raises LineRangeError for a range that
+    selects no lines.
+    """
+    index = line_index(content, sha)
+    if start_line is None and end_line is None and start_column is None and len(content) <= READ_FILE_PAGE_BYTES \
+            and index.lines <= READ_FILE_PAGE_LINES:
+        return {"success": True, "content": content, "path": path}
+
+    start_line = max(1, int(start_line or 1))
+    end_line = int(end_line) if end_line else None
+    column = max(1, int(start_column or 1))
+    check_line_range(start_line, end_line, index.lines)
+    if index.lines:
+        check_start_column(column, start_line, index.line_length(start_line))
+    first, last = index.page(start_line, end_line, READ_FILE_PAGE_LINES, READ_FILE_PAGE_BYTES, column)
+    begin = index.starts[first - 1] + column - 1 if index.lines else 0
+    stop = index.end(last) if index.lines else 0
+    cut = stop - begin > READ_FILE_PAGE_BYTES
+    if cut:
+        stop = begin + READ_FILE_PAGE_BYTES
+    result = {
+        "success": True,
+        "content": content[begin:stop],
+        "path": path,
+        "start_line": first,
+        "end_line": last,
+        "total_lines": index.lines,
+        "truncated": cut or last < index.lines
+    }
+    if column > 1:
+        result["start_column"] = column
+    requested_end = min(int(end_line), index.lines) if end_line else index.lines
+    if cut:
+        next_column = column + stop - begin
+        result["next_start_line"] = first
+        result["next_start_column"] = next_column
+        result["note"] = (f"Line {first} is {index.line_length(first)} characters long, more than one page; showing "
+                          f"characters {column}-{next_column - 1}. Call read_file with start_line={first} and "
+                          f"start_column={next_column} to continue, or search_files to find what you need.")
+    elif last < requested_end:
+        result["next_start_line"] = last + 1
+        result["note"] = (f"Showing lines {first}-{last} of {index.lines}. Call read_file with "
+                          f"start_line={last + 1} to continue, or outline_file to find the part you need.")
+    return result
+
+OUTLINE_LANGUAGES = {
+    '.py': 'python', '.pyi': 'python',
+    '.js': 'js', '.jsx': 'js', '.mjs': 'js', '.cjs': 'js', '.ts': 'js', '.tsx': 'js',
+    '.md': 'markdown', '.markdown': 'markdown'
+}
+PYTHON_SYMBOL = re.compile(r'^([ \t]*)(?:async[ \t]+)?(def|class)[ \t]+(\w+)', re.MULTILINE)
+JS_SYMBOL = re.compile(
+    r'^([ \t]*)(?:export[ \t]+(?:default[ \t]+)?)?(?:'
+    r'(?:async[ \t]+)?function\*?[ \t]*(?P<function>[\w$]+)'
+    r'|class[ \t]+(?P<class>[\w$]+)'
+    r'|(?:const|let|var)[ \t]+(?P<arrow>[\w$]+)[ \t]*=[ \t]*(?:async[ \t]*)?(?:function\b|\([^)\n]*\)[ \t]*=>|[\w$]+[ \t]*=>)'
+    r'|(?:static[ \t]+)?(?:async[ \t]+)?(?P<method>[\w$]+)[ \t]*\([^)\n]*\)[ \t]*\{)',
+    re.MULTILINE)
+JS_NOT_METHODS = {'if', 'for', 'while', 'switch', 'catch', 'with', 'return', 'function'}
+MARKDOWN_HEADING = re.compile(r'^(#{1,6})[ \t]+(.+?)[ \t#]*$')
+
+def outline(path, content):
+    """[{line, end_line, kind, name, level}] for the file's functions, classes or headings.
+
+    end_line is approximate: the line before the next symbol at the same
+    or an outer level. Returns None for unsupported file types.
+    """
+    language = OUTLINE_LANGUAGES.get(os.path.splitext(path)[1].lower())
+    if language is None:
+        return None
+    index = line_index(content)
+    symbols = []
+
+    def line_of(offset):
+        return bisect.bisect_right(index.starts, offset)
+
+    if language == 'python':
+        for match in PYTHON_SYMBOL.finditer(content):
+            kind = 'class' if match.group(2) == 'class' else 'function'
+            symbols.append({'line': line_of(match.start()), 'kind': kind, 'name': match.group(3),
+                            'level': len(match.group(1).expandtabs(4)) // 4})
+    elif language == 'js':
+        for match in JS_SYMBOL.finditer(content):
+            kind = next(group for group in ('function', 'class', 'arrow', 'method') if match.group(group))
+            name = match.group(kind)
+            if kind == 'method' and (name in JS_NOT_METHODS or not match.group(1)):
+                continue
+            symbols.append({'line': line_of(match.start()), 'kind': 'function' if kind == 'arrow' else kind,
+                            'name': name, 'level': len(match.group(1).expandtabs(2)) // 2})
+    else:
+        fenced = False
+        for number, line in enumerate(content.split('\n'), 1):
+            if line.lstrip().startswith(('```', '~~~')):
+                fenced = not fenced
+                continue
+            match = None if fenced else MARKDOWN_HEADING.match(line)
+            if match:
+                symbols.append({'line': number, 'kind': 'heading', 'name': match.group(2),
+                                'level': len(match.group(1)) - 1})
+
+    for position, symbol in enumerate(symbols):
+        following = (other['line'] for other in symbols[position + 1:] if other['level'] <= symbol['level'])
+        symbol['end_line'] = next(following, index.lines + 1) - 1
+    return symbols
+
+# Conversation sessions. Instead of re-sending the whole conversation on
+# every step, clients append new messages to a server-side session and the
+# server rebuilds the full context. Every append names the length the client
+# expects (session_base); on a mismatch the client gets a 409 and resends
+# everything, so a worker that lost or never saw the session just resyncs.
+# With SESSION_DIR set, sessions are append-only JSONL files shared by all
+# workers that survive restarts.
+SESSION_MAX_BYTES = int(os.environ.get('SESSION_MAX_BYTES', str(32 * 1024 * 1024)))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '3600'))
+SESSION_DIR = os.environ.get('SESSION_DIR')
+
+class SessionConflict(Exception):
+    """The client's idea of the session length differs from ours"""
+
+    def __init__(self, length):
+        super().__init__(f"Session has {length} messages")
+        self.length = length
+
+class SessionStore:
+    """Bounded, expiring store of conversation transcripts keyed by session id.
+
+    A session is its message list plus the size of the JSON lines it
+    serializes to, which bounds the in-memory LRU. On disk a session is
+    those same lines appended to one file, so comparing the file size with
+    the in-memory size tells a worker whether its copy is current.
+    """
+
+    def __init__(self, max_bytes, ttl=3600, directory=None):
+        self.memory = ByteLRU(max_bytes, sizeof=lambda session: session['bytes'])
+        self.ttl = ttl
+        self.directory = directory
+        self.created = 0
+        self.expired = 0
+        self.conflicts = 0
+        self._locks = [threading.Lock() for _ in range(64)]
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self, session_id):
+        """The session's messages, or None if it is unknown or expired"""
+        with self._session_lock(session_id):
+            session = self._read_disk(session_id) if self.directory else self._read_memory(session_id)
+        return list(session['messages']) if session else None
+
+    def append(self, session_id, messages, base=None, reset=False, create=True):
+        """Append messages and return the full conversation.
+
+        base is the number of messages the client believes the session
+        holds; reset replaces the session with messages instead. Raises
+        SessionConflict when base is wrong, or the session is missing and
+        create is False.
+        """
+        data = ''.join(json.dumps(message) + '\n' for message in messages)
+        with self._session_lock(session_id):
+            if self.directory:
+                session = self._append_disk(session_id, messages, data, base, reset, create)
+            else:
+                session = None if reset else self._read_memory(session_id)
+                self._check(session, base, reset, create)
+                session = self._extend(session, messages, data)
+            self.memory.put(session_id, session)
+        self._maybe_sweep()
+        return list(session['messages'])
+
+    def delete(self, session_id):
+        with self._session_lock(session_id):
+            self.memory.pop(session_id)
+            if self.directory:
+                self._remove(session_id)
+
+    def stats(self):
+        return {
+            'sessions': len(self.memory),
+            'bytes': self.memory.bytes,
+            'max_bytes': self.memory.max_bytes,
+            'created': self.created,
+            'expired': self.expired,
+            'conflicts': self.conflicts,
+            'ttl': self.ttl,
+            'disk': bool(self.directory)
+        }
+
+    def _check(self, session, base, reset, create):
+        if reset:
+            return
+        length = len(session['messages']) if session else 0
+        if (session is None and not create) or (base is not None and int(base) != length):
+            self._count('conflicts')
+            raise SessionConflict(length)
+
+    def _extend(self, session, messages, data):
+        if session is None:
+            self._count('created')
+            session = {'messages': [], 'bytes': 0}
+        return {
+            'messages': session['messages'] + list(messages),
+            'bytes': session['bytes'] + len(data.encode('utf-8')),
+            'updated_at': time.time()
+        }
+
+    def _read_memory(self, session_id):
+        session = self.memory.get(session_id)
+        if session and time.time() - session['updated_at'] > self.ttl:
+            self.memory.pop(session_id)
+            self._count('expired')
+            return None
+        return session
+
+    def _read_disk(self, session_id):
+        """The session as stored on disk, reusing the memory copy if current"""
+        try:
+            with open(self._path(session_id), encoding='utf-8') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return self._sync(session_id, f)
+        except FileNotFoundError:
+            self.memory.pop(session_id)
+            return None
+
+    def _append_disk(self, session_id, messages, data, base, reset, create):
+        with open(self._path(session_id), 'a+', encoding='utf-8') as f:
+            # flock serializes appends from different gunicorn workers
+            fcntl.flock(f, fcntl.LOCK_EX)
+            session = None if reset else self._sync(session_id, f)
+            self._check(session, base, reset, create)
+            if session is None:
+                f.truncate(0)
+            f.write(data)
+            f.flush()
+            return self._extend(session, messages, data)
+
+    def _sync(self, session_id, f):
+        """Bring the memory copy up to date with an open, locked session file"""
+        stat = os.fstat(f.fileno())
+        if not stat.st_size:
+            return None
+        if time.time() - stat.st_mtime > self.ttl:
+            self.memory.pop(session_id)
+            self._count('expired')
+            return None
+        session = self.memory.get(session_id)
+        if session is None or session['bytes'] != stat.st_size:
+            f.seek(0)
+            text = f.read()
+            session = {
+                'messages': [json.loads(line) for line in text.splitlines() if line],
+                'bytes': len(text.encode('utf-8')),
+                'updated_at': stat.st_mtime
+            }
+            self.memory.put(session_id, session)
+        return session
+
+    def _maybe_sweep(self):
+        """Remove expired session files now and then; memory expires lazily"""
+        if not self.directory or time.time() - self._last_sweep < self.ttl / 4:
+            return
+        self._last_sweep = time.time()
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _remove(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _path(self, session_id):
+        key = hashlib.sha1(session_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.jsonl')
+
+    def _session_lock(self, session_id):
+        return self._locks[hash(session_id) % len(self._locks)]
+
+sessions = SessionStore(SESSION_MAX_BYTES, SESSION_TTL, SESSION_DIR)
+
+def session_context(data):
+    """Rebuild the full conversation for a request that names a session_id.
+
+    Returns the request data with the session's messages in place of the
+    delta the client sent.
+    """
+    messages = sessions.append(data['session_id'], data.get('messages', []),
+                               base=data.get('session_base'), reset=bool(data.get('session_reset')))
+    return dict(data, messages=messages)
+
+def record_reply(session_id, message):
+    """Append the assistant's reply so the client need not send it back"""
+    return {'id': session_id, 'length': len(sessions.append(session_id, [message]))}
+
+def session_conflict_response(e):
+    return jsonify({
+        "error": "Session out of sync; resend the full conversation with session_reset",
+        "session_length": e.length
+    }), 409
+
+# Repository tree index. One flat path index per (repo, commit sha), shared
+# by every branch pointing at that commit. Branch heads are revalidated with
+# conditional requests, which GitHub answers with a cheap 304 when unchanged.
+TREE_INDEX_MAX = int(os.environ.get('TREE_INDEX_MAX', '32'))
+TREE_HEAD_TTL = float(os.environ.get('TREE_HEAD_TTL', '10'))
+
+class GitHubAPI(UpstreamClient):
+    """Pooled client for the raw GitHub REST calls PyGithub can't make
+    conditionally (ETag / If-None-Match)"""
+
+    def get(self, path, params=None, etag=None, accept=None, read_timeout=30, stream=False):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if accept:
+            headers['Accept'] = accept
+        started = time.time()
+        response = self.session.get(self.url + path, params=params, headers=headers, stream=stream,
+                                    timeout=(self.connect_timeout, read_timeout))
+        record_github_call('rest', response.headers, started, f"GET {path}")
+        return response
+
+github_api = GitHubAPI('github', GITHUB_API_URL.rstrip('/'), 10, headers={
+    'Authorization': f'token {GITHUB_TOKEN}',
+    'Accept': 'application/vnd.github+json'
+})
+
+def filter_paths(paths, prefix=None, pattern=None):
+    """Sorted paths under a directory prefix and/or matching a glob"""
+    if prefix:
+        prefix = prefix.strip('/') + '/'
+        # paths is sorted, so everything under prefix is one contiguous run
+        start = bisect.bisect_left(paths, prefix)
+        end = bisect.bisect_left(paths, prefix[:-1] + '0')  # '0' sorts right after '/'
+        paths = paths[start:end]
+    if pattern:
+        if '/' in pattern:
+            paths = [path for path in paths if fnmatch.fnmatchcase(path, pattern)]
+        else:
+            paths = [path for path in paths if fnmatch.fnmatchcase(path.rsplit('/', 1)[-1], pattern)]
+    return paths
+
+class TreeIndex:
+    """Flat, sorted index of the files in one commit's tree"""
+
+    def __init__(self, commit_sha, entries, truncated=False):
+        self.commit_sha = commit_sha
+        self.entries = entries  # path -> {'sha': ..., 'size': ..., 'mode': ...}
+        self.truncated = truncated
+        self.paths = sorted(entries)
+
+    def files(self, prefix=None, pattern=None):
+        """Return [{path, sha, size}] under a directory prefix and/or matching a glob"""
+        return [{'path': path, **self.entries[path]} for path in filter_paths(self.paths, prefix, pattern)]
+
+    def with_changes(self, commit_sha, changes):
+        """Derive the index for a child commit; changes maps path -> entry or None (deleted)"""
+        entries = dict(self.entries)
+        for path, entry in changes.items():
+            if entry is None:
+                entries.pop(path, None)
+            else:
+                entries[path] = {**entries.get(path, {}), **entry}
+        return TreeIndex(commit_sha, entries, self.truncated)
+
+class TreeIndexCache:
+    """Tree indexes per (repo, commit) plus the last known head of each branch"""
+
+    def __init__(self, api, max_indexes=32, head_ttl=10):
+        self.api = api
+        self.max_indexes = max_indexes
+        self.head_ttl = head_ttl
+        self.tree_fetches = 0
+        self.head_checks = 0
+        self.not_modified = 0
+        self.incremental_updates = 0
+        self._indexes = OrderedDict()
+        self._heads = {}
+        self._lock = threading.Lock()
+
+    def get(self, repo, branch):
+        """The index for the current head of branch"""
+        return self.for_commit(repo, self.head(repo, branch))
+
+    def head(self, repo, branch):
+        """Commit sha of branch, revalidated with If-None-Match once head_ttl passes"""
+        entry = self._heads.get((repo, branch))
+        if entry and time.time() - entry['checked_at'] < self.head_ttl:
+            return entry['sha']
+
+        response = self.api.get(f"/repos/{repo}/commits/{quote(branch)}",
+                                etag=entry and entry['etag'], accept='application/vnd.github.sha')
+        with self._lock:
+            self.head_checks += 1
+            if response.status_code == 304 and entry:
+                self.not_modified += 1
+                entry['checked_at'] = time.time()
+                return entry['sha']
+        response.raise_for_status()
+        sha = response.text.strip()
+        self._heads[(repo, branch)] = {
+            'sha': sha,
+            'etag': response.headers.get('ETag'),
+            'checked_at': time.time()
+        }
+        return sha
+
+    def for_commit(self, repo, commit_sha):
+        """The index for a commit; trees are immutable so this never revalidates"""
+        started = time.time()
+        with self._lock:
+            index = self._indexes.get((repo, commit_sha))
+            if index is not None:
+                self._indexes.move_to_end((repo, commit_sha))
+                trace_span('cache', 'tree index hit', started)
+                return index
+
+        response = self.api.get(f"/repos/{repo}/git/trees/{commit_sha}", params={'recursive': '1'})
+        response.raise_for_status()
+        with traced('json', 'parse tree', bytes=len(response.content)):
+            tree = response.json()
+        entries = {
+            item['path']: {'sha': item['sha'], 'size': item.get('size'), 'mode': item.get('mode')}
+            for item in tree.get('tree', []) if item.get('type') == 'blob'
+        }
+        index = TreeIndex(commit_sha, entries, tree.get('truncated', False))
+        with self._lock:
+            self.tree_fetches += 1
+        self._store(repo, index)
+        trace_span('cache', 'tree index miss', started, files=len(entries))
+        return index
+
+    def peek(self, repo, branch):
+        """The cached index at branch's last known head, without any request"""
+        entry = self._heads.get((repo, branch))
+        return self._indexes.get((repo, entry['sha'])) if entry else None
+
+    def indexed_blob(self, repo, branch, path):
+        """(blob sha, time the head was last confirmed) for path at branch's known head, without any request"""
+        entry = self._heads.get((repo, branch))
+        index = self._indexes.get((repo, entry['sha'])) if entry else None
+        if index is None or path not in index.entries:
+            return None
+        return index.entries[path].get('sha'), entry['checked_at']
+
+    def set_head(self, repo, branch, commit_sha):
+        """Record a head we moved ourselves (new branch, our own commit)"""
+        self._heads[(repo, branch)] = {'sha': commit_sha, 'etag': None, 'checked_at': time.time()}
+
+    def record_commit(self, repo, branch, parent_sha, commit_sha, changes):
+        """Update incrementally after our own commit instead of refetching the tree"""
+        with self._lock:
+            parent = self._indexes.get((repo, parent_sha))
+        if parent is None:
+            # Nothing to derive from; resolve the head again on next use
+            self._heads.pop((repo, branch), None)
+            return
+        self._store(repo, parent.with_changes(commit_sha, changes))
+        self.set_head(repo, branch, commit_sha)
+        with self._lock:
+            self.incremental_updates += 1
+
+    def stats(self):
+        return {
+            'indexes': len(self._indexes),
+            'branches': len(self._heads),
+            'tree_fetches': self.tree_fetches,
+            'head_checks': self.head_checks,
+            'not_modified': self.not_modified,
+            'incremental_updates': self.incremental_updates
+        }
+
+    def _store(self, repo, index):
+        with self._lock:
+            self._indexes[(repo, index.commit_sha)] = index
+            self._indexes.move_to_end((repo, index.commit_sha))
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+
+tree_indexes = TreeIndexCache(github_api, TREE_INDEX_MAX, TREE_HEAD_TTL)
+
+# Content search. search_files answers from an in-memory index per (repo,
+# commit): the text of every file plus a trigram -> files table, so a query
+# only scans the files that contain all of its trigrams. The index is built
+# from one tarball download (git archive for mirrored branches) and, like the
+# tree index, derived from its parent after our own commits: changed files go
+# into a small overlay that is scanned directly, and the table is rebuilt
+# locally once the overlay grows past SEARCH_OVERLAY_MAX files.
+SEARCH_INDEX_MAX_BYTES = int(os.environ.get('SEARCH_INDEX_MAX_BYTES', str(128 * 1024 * 1024)))
+SEARCH_MAX_FILE_BYTES = int(os.environ.get('SEARCH_MAX_FILE_BYTES', str(1024 * 1024)))
+SEARCH_OVERLAY_MAX = 100
+SEARCH_MAX_RESULTS = 200
+SEARCH_LINE_CHARS = 200
+
+def decode_text(data):
+    """Text of a file for searching, or None for binary and oversized files"""
+    if data is None or len(data) > SEARCH_MAX_FILE_BYTES or b'\0' in data[:8192]:
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+def iter_tar_files(fileobj, mode, strip_top=False):
+    """Yield (path, bytes) for each regular file in a streamed tar archive.
+
+    Oversized files are yielded with None instead of being read.
+    """
+    with tarfile.open(fileobj=fileobj, mode=mode) as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            path = member.name.split('/', 1)[-1] if strip_top else member.name
+            if member.size > SEARCH_MAX_FILE_BYTES:
+                yield path, None
+            else:
+                yield path, archive.extractfile(member).read()
+
+def regex_literals(pattern):
+    """Literal strings that every match of a regex must contain.
+
+    Deliberately conservative: alternation, groups and numeric escapes give
+    no literals, which means every file is scanned.
+    """
+    if '|' in pattern or '(' in pattern:
+        return []
+    literals, current = [], ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if escaped in ('x', 'u', 'U', 'N') or escaped.isdigit():
+                return []
+            i += 2
+            if escaped.isalnum() or not escaped:
+                # \d, \w, \b ... match classes of characters
+                literals.append(current)
+                current = ''
+                continue
+            current += escaped
+            continue
+        if char in '*?{':
+            # The preceding character is optional
+            literals.append(current[:-1])
+            current = ''
+            if char == '{':
+                i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+            i += 1
+            continue
+        if char == '[':
+            literals.append(current)
+            current = ''
+            end = i + 2 if pattern[i + 1:i + 2] == ']' else i + 1
+            while end < len(pattern) and pattern[end] != ']':
+                end += 2 if pattern[end] == '\\' else 1
+            i = end + 1
+            continue
+        if char in '.^$+':
+            literals.append(current)
+            current = ''
+        else:
+            current += char
+        i += 1
+    literals.append(current)
+    return [literal for literal in literals if len(literal) >= 3]
+
+class TrigramTable:
+    """Immutable text of a set of files plus lowercase trigram -> file id postings"""
+
+    def __init__(self, files):
+        self.paths = sorted(files)
+        self.ids = {path: file_id for file_id, path in enumerate(self.paths)}
+        self.contents = [files[path] for path in self.paths]
+        self.postings = {}
+        postings_count = 0
+        for file_id, content in enumerate(self.contents):
+            lowered = content.lower()
+            for gram in {lowered[i:i + 3] for i in range(len(lowered) - 2)}:
+                self.postings.setdefault(gram, array('I')).append(file_id)
+                postings_count += 1
+        self.bytes = sum(len(content) for content in self.contents) + 4 * postings_count + 100 * len(self.postings)
+
+    def candidates(self, literals):
+        """Ids of files containing every trigram of the literals; None if none apply"""
+        result = None
+        for literal in literals:
+            literal = literal.lower()
+            for i in range(len(literal) - 2):
+                postings = self.postings.get(literal[i:i + 3])
+                if postings is None:
+                    return set()
+                result = set(postings) if result is None else result.intersection(postings)
+                if not result:
+                    return result
+        return result
+
+class SearchIndex:
+    """Searchable contents of one commit: a shared trigram table plus an overlay
+    of files changed since it was built (path -> text, or None if deleted).
+
+    Indexes derived from one another share a table, and only the one that
+    owns it counts the table in bytes, so a cache charges it once.
+    """
+
+    def __init__(self, commit_sha, table, overlay=None, skipped=0):
+        self.commit_sha = commit_sha
+        self.table = table
+        self.overlay = overlay or {}
+        self.skipped = skipped
+        self.owns_table = True
+        paths = set(table.paths).difference(self.overlay)
+        paths.update(path for path, content in self.overlay.items() if content is not None)
+        self.paths = sorted(paths)
+        self.overlay_bytes = sum(len(content) for content in self.overlay.values() if content)
+
+    @property
+    def bytes(self):
+        return (self.table.bytes if self.owns_table else 0) + self.overlay_bytes
+
+    @classmethod
+    def build(cls, commit_sha, files, max_bytes):
+        """Index (path, bytes) pairs, skipping binary and oversized files"""
+        texts = {}
+        skipped = 0
+        total = 0
+        for path, data in files:
+            text = decode_text(data)
+            if text is None:
+                skipped += 1
+                continue
+            texts[path] = text
+            total += len(text)
+            if total > max_bytes // 2:
+                raise ValueError("Repository is too large to index for search; raise SEARCH_INDEX_MAX_BYTES")
+        return cls(commit_sha, TrigramTable(texts), skipped=skipped)
+
+    def with_changes(self, commit_sha, changes):
+        """Derive the index for a child commit; changes maps path -> text or None (deleted)"""
+        overlay = dict(self.overlay)
+        for path, content in changes.items():
+            if content is not None and len(content) > SEARCH_MAX_FILE_BYTES:
+                content = None
+            overlay[path] = content
+        if len(overlay) > SEARCH_OVERLAY_MAX:
+            files = {path: self.text(path) for path in self.table.paths if path not in overlay}
+            files.update((path, content) for path, content in overlay.items() if content is not None)
+            return SearchIndex(commit_sha, TrigramTable(files), skipped=self.skipped)
+        derived = SearchIndex(commit_sha, self.table, overlay, self.skipped)
+        derived.owns_table = self.owns_table
+        return derived
+
+    def text(self, path):
+        if path in self.overlay:
+            return self.overlay[path]
+        return self.table.contents[self.table.ids[path]]
+
+    def search(self, query, regex=False, case_sensitive=False, prefix=None, pattern=None, max_results=50):
+        """Matching lines as {path, line, text}, at most one per line and max_results in all.
+
+        Raises re.error for an invalid regex.
+        """
+        flags = re.MULTILINE | (0 if case_sensitive else re.IGNORECASE)
+        compiled = re.compile(query if regex else re.escape(query), flags)
+        candidates = self.table.candidates(regex_literals(query) if regex else [query])
+
+        matches = []
+        files_matched = 0
+        scanned = 0
+        truncated = False
+        for path in filter_paths(self.paths, prefix, pattern):
+            if path not in self.overlay and candidates is not None and self.table.ids[path] not in candidates:
+                continue
+            content = self.text(path)
+            scanned += 1
+            line, last, last_line = 1, 0, 0
+            for match in compiled.finditer(content):
+                line += content.count('\n', last, match.start())
+                last = match.start()
+                if line == last_line:
+                    continue
+                if len(matches) >= max_results:
+                    truncated = True
+                    break
+                if not last_line:
+                    files_matched += 1
+                last_line = line
+                start = content.rfind('\n', 0, match.start()) + 1
+                end = content.find('\n', match.start())
+                text = content[start:end if end >= 0 else len(content)].strip()
+                matches.append({'path': path, 'line': line, 'text': text[:SEARCH_LINE_CHARS]})
+            if truncated:
+                break
+        return {
+            'matches': matches,
+            'files_matched': files_matched,
+            'files_scanned': scanned,
+            'files_skipped': self.skipped,
+            'truncated': truncated
+        }
+
+class SearchIndexCache:
+    """Search indexes per (repo, commit) within a byte budget"""
+
+    def __init__(self, max_bytes):
+        self.indexes = ByteLRU(max_bytes, sizeof=lambda index: index.bytes)
+        self.builds = 0
+        self.build_seconds = 0.0
+        self.hits = 0
+        self.incremental_updates = 0
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def for_commit(self, repo, commit_sha, load):
+        """The index for a commit, built from load() -> (path, bytes) pairs on a miss"""
+        key = (repo, commit_sha)
+        looked_up = time.time()
+        index = self.indexes.get(key)
+        if index is None:
+            # One build per commit at a time; concurrent searches wait for it
+            with self._lock:
+                building = self._building.setdefault(key, threading.Lock())
+            with building:
+                index = self.indexes.get(key)
+                if index is None:
+                    started = time.time()
+                    try:
+                        index = SearchIndex.build(commit_sha, load(), self.indexes.max_bytes)
+                    finally:
+                        with self._lock:
+                            self._building.pop(key, None)
+                    self.indexes.put(key, index)
+                    with self._lock:
+                        self.builds += 1
+                        self.build_seconds += time.time() - started
+                    trace_span('cache', 'search index build', looked_up, files=len(index.table.paths))
+                    return index
+        with self._lock:
+            self.hits += 1
+        trace_span('cache', 'search index hit', looked_up)
+        return index
+
+    def record_commit(self, repo, parent_sha, commit_sha, changes):
+        """Derive a child commit's index after our own commit; changes maps path -> text or None"""
+        parent = self.indexes.get((repo, parent_sha)) if parent_sha else None
+        if parent is None:
+            return
+        child = parent.with_changes(commit_sha, changes)
+        if child.table is parent.table and child.owns_table:
+            # The newest index carries the shared table's cost; LRU drops older ones first
+            parent.owns_table = False
+            self.indexes.put((repo, parent_sha), parent)
+        self.indexes.put((repo, commit_sha), child)
+        with self._lock:
+            self.incremental_updates += 1
+
+    def stats(self):
+        return {
+            'indexes': len(self.indexes),
+            'bytes': self.indexes.bytes,
+            'max_bytes': self.indexes.max_bytes,
+            'builds': self.builds,
+            'build_seconds': round(self.build_seconds, 3),
+            'hits': self.hits,
+            'incremental_updates': self.incremental_updates
+        }
+
+search_indexes = SearchIndexCache(SEARCH_INDEX_MAX_BYTES)
+
+def github_tarball_files(repo, commit_sha):
+    """Yield (path, bytes) for a commit's files from one streamed tarball download"""
+    response = github_api.get(f"/repos/{repo}/tarball/{commit_sha}", read_timeout=120, stream=True)
+    try:
+        response.raise_for_status()
+        yield from iter_tar_files(response.raw, 'r|gz', strip_top=True)
+    finally:
+        response.close()
+
+# Repository handles. Most routes only need a URL to hang calls off, so
+# handles are lazy and cost no request; the few fields we do read (default
+# branch) live in a metadata record refreshed in the background.
+REPO_HANDLE_TTL = float(os.environ.get('REPO_HANDLE_TTL', '600'))
+REPO_HANDLE_MAX = int(os.environ.get('REPO_HANDLE_MAX', '64'))
+REPO_METADATA_TTL = float(os.environ.get('REPO_METADATA_TTL', '300'))
+
+class RepoRegistry:
+    """Memoized PyGithub Repository handles plus per-repo metadata.
+
+    handle() returns a lazy Repository, so get_contents/update_file go out
+    without the usual GET /repos/{repo} first. default_branch() serves the
+    recorded value and, once it is older than metadata_ttl, refreshes it on a
+    background thread (stale-while-revalidate), warming the branch head in
+    the tree index at the same time.
+    """
+
+    def __init__(self, handle_ttl, max_handles, metadata_ttl):
+        self.handle_ttl = handle_ttl
+        self.max_handles = max_handles
+        self.metadata_ttl = metadata_ttl
+        self.metadata_fetches = 0
+        self.background_refreshes = 0
+        self._handles = OrderedDict()
+        self._metadata = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def handle(self, repo_name):
+        with self._lock:
+            entry = self._handles.get(repo_name)
+            if entry and time.time() - entry[1] < self.handle_ttl:
+                self._handles.move_to_end(repo_name)
+                return entry[0]
+        repo = github_client.get_repo(repo_name, lazy=True)
+        self._remember_handle(repo_name, repo)
+        return repo
+
+    def default_branch(self, repo_name):
+        metadata = self._metadata.get(repo_name)
+        if metadata is None:
+            return self.refresh(repo_name)['default_branch']
+        if time.time() - metadata['fetched_at'] > self.metadata_ttl:
+            self._refresh_in_background(repo_name)
+        return metadata['default_branch']
+
+    def record(self, repo_name, default_branch):
+        """Seed metadata from data we already have (e.g. the repo list)"""
+        self._metadata[repo_name] = {'default_branch': default_branch, 'fetched_at': time.time()}
+
+    def refresh(self, repo_name):
+        repo = github_client.get_repo(repo_name)
+        with self._lock:
+            self.metadata_fetches += 1
+        self._remember_handle(repo_name, repo)
+        self.record(repo_name, repo.default_branch)
+        return self._metadata[repo_name]
+
+    def stats(self):
+        return {
+            'handles': len(self._handles),
+            'metadata': len(self._metadata),
+            'metadata_fetches': self.metadata_fetches,
+            'background_refreshes': self.background_refreshes
+        }
+
+    def _remember_handle(self, repo_name, repo):
+        with self._lock:
+            self._handles[repo_name] = (repo, time.time())
+            self._handles.move_to_end(repo_name)
+            while len(self._handles) > self.max_handles:
+                self._handles.popitem(last=False)
+
+    def _refresh_in_background(self, repo_name):
+        with self._lock:
+            if repo_name in self._refreshing:
+                return
+            self._refreshing.add(repo_name)
+            self.background_refreshes += 1
+
+        def refresh():
+            try:
+                metadata = self.refresh(repo_name)
+                tree_indexes.head(repo_name, metadata['default_branch'])
+            except Exception as e:
+                app.logger.warning("Refreshing metadata for %s failed: %s", repo_name, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(repo_name)
+
+        threading.Thread(target=refresh, name=f'repo-refresh-{repo_name}', daemon=True).start()
+
+repo_registry = RepoRegistry(REPO_HANDLE_TTL, REPO_HANDLE_MAX, REPO_METADATA_TTL)
+
+# Repository list. /api/github/repos serves the account's repositories from a
+# cache per token. The first page of GET /user/repos says how many pages
+# there are and the rest are fetched in parallel. Once REPO_LIST_TTL passes,
+# the cached list keeps being served while a background refresh runs.
+# Clients page through it with an opaque cursor and can filter by name.
+REPO_LIST_TTL = float(os.environ.get('REPO_LIST_TTL', '300'))
+REPO_LIST_FETCH_WORKERS = int(os.environ.get('REPO_LIST_FETCH_WORKERS', '4'))
+REPO_LIST_PAGE_SIZE = 100  # GitHub's maximum per_page
+REPO_LIST_DEFAULT_LIMIT = 100
+REPO_LIST_MAX_LIMIT = 500
+
+class RepoListCache:
+    """The repositories visible to each token, refreshed in the background"""
+
+    def __init__(self, api, ttl, workers):
+        self.api = api
+        self.ttl = ttl
+        self.workers = workers
+        self.fetches = 0
+        self.pages_fetched = 0
+        self.background_refreshes = 0
+        self._lists = {}
+        self._refreshing = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, token, refresh=False):
+        """[{name, full_name, private, default_branch}] for the token, fetching on first use"""
+        key = hashlib.sha256((token or '').encode()).hexdigest()
+        entry = self._lists.get(key)
+        if entry is None or refresh:
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+            with lock:
+                # Another request may have fetched it while we waited
+                entry = self._lists.get(key)
+                if entry is None or refresh:
+                    entry = self._fetch(key)
+        elif time.time() - entry['fetched_at'] > self.ttl:
+            self._refresh_in_background(key)
+        return entry['repos']
+
+    def stats(self):
+        return {
+            'tokens': len(self._lists),
+            'repos': sum(len(entry['repos']) for entry in self._lists.values()),
+            'fetches': self.fetches,
+            'pages_fetched': self.pages_fetched,
+            'background_refreshes': self.background_refreshes
+        }
+
+    def _fetch(self, key):
+        first = self._page(1)
+        last = 1
+        last_url = first.links.get('last', {}).get('url')
+        if last_url:
+            last = int(parse_qs(urlparse(last_url).query).get('page', ['1'])[0])
+        pages = [first.json()]
+        if last > 1:
+            # Copy the context so GitHub calls made on pool threads count towards this request
+            context = contextvars.copy_context()
+            with ThreadPoolExecutor(max_workers=min(self.workers, last - 1)) as pool:
+                pages += pool.map(lambda page: context.copy().run(self._page, page).json(), range(2, last + 1))
+
+        repos, seen = [], set()
+        for page in pages:
+            for repo in page:
+                # A repo created meanwhile can shift another onto the next page twice
+                if repo['full_name'] in seen:
+                    continue
+                seen.add(repo['full_name'])
+                repo_registry.record(repo['full_name'], repo['default_branch'])
+                repos.append({
+                    'name': repo['name'],
+                    'full_name': repo['full_name'],
+                    'private': repo['private'],
+                    'default_branch': repo['default_branch']
+                })
+        entry = self._lists[key] = {'repos': repos, 'fetched_at': time.time()}
+        with self._lock:
+            self.fetches += 1
+            self.pages_fetched += len(pages)
+        return entry
+
+    def _page(self, page):
+        response = self.api.get('/user/repos', params={'per_page': REPO_LIST_PAGE_SIZE, 'page': page, 'sort': 'full_name'})
+        response.raise_for_status()
+        return response
+
+    def _refresh_in_background(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            self.background_refreshes += 1
+
+        def refresh():
+            try:
+                self._fetch(key)
+            except Exception as e:
+                app.logger.warning("Refreshing the repository list failed: %s", e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name='repo-list-refresh', daemon=True).start()
+
+repo_lists = RepoListCache(github_api, REPO_LIST_TTL, REPO_LIST_FETCH_WORKERS)
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Offset from a cursor made by encode_cursor; raises ValueError if malformed"""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))['offset']
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid cursor")
+    return offset
+
+# Large and binary files. The contents API stops at 1 MB and wraps the file
+# in base64 inside JSON, so bigger files come from the raw blob endpoint as a
+# stream instead. Binary files are recognised from their first bytes and
+# described rather than decoded. Text files over FILE_MAX_TEXT_BYTES are
+# never held whole: read_file pages through the stream, and
+# GET /api/github/file?raw=1 streams any file to the client in chunks.
+GITHUB_CONTENTS_MAX_BYTES = 1024 * 1024
+FILE_MAX_TEXT_BYTES = int(os.environ.get('FILE_MAX_TEXT_BYTES', str(8 * 1024 * 1024)))
+FILE_CHUNK_BYTES = 64 * 1024
+BINARY_SNIFF_BYTES = 8192
+
+class BinaryFileError(Exception):
+    """A file that is not UTF-8 text"""
+
+    def __init__(self, path, size=None, sha=None):
+        super().__init__(f"{path} is a binary file; its contents cannot be shown as text")
+        self.path = path
+        self.size = size
+        self.sha = sha
+
+    def describe(self):
+        return {
+            "path": self.path,
+            "binary": True,
+            "size": self.size,
+            "sha": self.sha,
+            "content_type": mimetypes.guess_type(self.path)[0] or 'application/octet-stream'
+        }
+
+class FileTooLargeError(Exception):
+    """A text file too big to hold in memory whole"""
+
+    def __init__(self, path, size, sha=None):
+        super().__init__(f"{path} is {size} bytes, over the {FILE_MAX_TEXT_BYTES} byte limit for reading it whole")
+        self.path = path
+        self.size = size
+        self.sha = sha
+
+def looks_binary(prefix):
+    """Whether the first bytes of a file say it is not UTF-8 text"""
+    if b'\0' in prefix:
+        return True
+    try:
+        prefix.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the end of the prefix is fine
+        return e.reason != 'unexpected end of data'
+    return False
+
+def decode_file_text(path, data, sha=None):
+    """UTF-8 text of a file, or BinaryFileError"""
+    if looks_binary(data[:BINARY_SNIFF_BYTES]):
+        raise BinaryFileError(path, len(data), sha)
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        raise BinaryFileError(path, len(data), sha)
+
+def iter_file_chunks(repo_name, branch, path, sha=None):
+    """Yield a file's bytes in FILE_CHUNK_BYTES chunks without holding it whole"""
+    if git_mirror.has(repo_name, branch):
+        with open(git_mirror.path(repo_name, branch, path), 'rb') as f:
+            yield from iter(lambda: f.read(FILE_CHUNK_BYTES), b'')
+        return
+    if sha is None:
+        entry = tree_indexes.get(repo_name, branch).entries.get(path)
+        if entry is None:
+            raise FileNotFoundError(f"{path} not found on {branch}")
+        sha = entry['sha']
+    response = github_api.get(f"/repos/{repo_name}/git/blobs/{sha}", accept='application/vnd.github.raw',
+                              read_timeout=60, stream=True)
+    try:
+        response.raise_for_status()
+        yield from response.iter_content(FILE_CHUNK_BYTES)
+    finally:
+        response.close()
+
+def read_blob_text(repo_name, branch, path, sha, size=None):
+    """Text of a file streamed from the raw blob endpoint, within FILE_MAX_TEXT_BYTES"""
+    if size and size > FILE_MAX_TEXT_BYTES:
+        raise FileTooLargeError(path, size, sha)
+    data = bytearray()
+    chunks = iter_file_chunks(repo_name, branch, path, sha)
+    try:
+        for chunk in chunks:
+            if not data and looks_binary(chunk[:BINARY_SNIFF_BYTES]):
+                raise BinaryFileError(path, size, sha)
+            data += chunk
+            if len(data) > FILE_MAX_TEXT_BYTES:
+                raise FileTooLargeError(path, size or len(data), sha)
+    finally:
+        chunks.close()
+    return decode_file_text(path, bytes(data), sha)
+
+def stream_file_page(repo_name, branch, error, start_line=None, end_line=None, start_column=None):
+    """read_file result for a file too large to hold, read from its byte stream.
+
+    Reads up to the requested page and stops; total_lines stays unknown
+    unless start_line turns out to be past the end, which raises
+    LineRangeError. Columns count bytes here, not characters.
+    """
+    start_line = max(1, int(start_line or 1))
+    column = max(1, int(start_column or 1))
+    check_line_range(start_line, int(end_line) if end_line else None)
+    max_lines = READ_FILE_PAGE_LINES
+    if end_line:
+        max_lines = max(1, min(max_lines, int(end_line) - start_line + 1))
+    line = 1
+    collected = bytearray()
+    lines_read = 0
+    more = False
+    skip = column - 1
+    last_chunk = b''
+    chunks = iter_file_chunks(repo_name, branch, error.path, error.sha)
+    try:
+        for chunk in chunks:
+            last_chunk = chunk
+            if not collected and line == 1 and looks_binary(chunk[:BINARY_SNIFF_BYTES]):
+                raise BinaryFileError(error.path, error.size, error.sha)
+            position = 0
+            if line < start_line:
+                # Skip whole chunks that end before the first wanted line
+                newlines = chunk.count(b'\n')
+                if line + newlines < start_line:
+                    line += newlines
+                    continue
+                while line < start_line:
+                    position = chunk.index(b'\n', position) + 1
+                    line += 1
+            if skip:
+                # Skip to start_column, which must stay on start_line
+                taken = min(skip, len(chunk) - position)
+                if chunk.find(b'\n', position, position + taken) >= 0:
+                    break
+                position += taken
+                skip -= taken
+                if skip:
+                    continue
+            while position < len(chunk):
+                if lines_read >= max_lines or len(collected) >= READ_FILE_PAGE_BYTES:
+                    more = True
+                    break
+                newline = chunk.find(b'\n', position)
+                stop = newline + 1 if newline >= 0 else len(chunk)
+                limit = position + READ_FILE_PAGE_BYTES - len(collected)
+                if stop > limit:
+                    # Cut at the page limit, but not inside a UTF-8 character
+                    stop = limit
+                    while stop > position and limit - stop < 3 and chunk[stop] & 0xC0 == 0x80:
+                        stop -= 1
+                    if stop == position:
+                        more = True
+                        break
+                collected += chunk[position:stop]
+                if collected.endswith(b'\n'):
+                    lines_read += 1
+                position = stop
+            if more:
+                break
+    finally:
+        chunks.close()
+
+    if not collected and line <= start_line and not more:
+        # The whole file was read without reaching start_line
+        total_lines = line - 1 + (1 if last_chunk and not last_chunk.endswith(b'\n') else 0)
+        if start_line > max(total_lines, 1):
+            check_line_range(start_line, None, total_lines)
+    if skip:
+        raise LineRangeError(f"start_column {column} is past the end of line {start_line}. "
+                             f"Use the next_start_column from the previous result, or start_column=1.")
+
+    partial = bool(collected) and not collected.endswith(b'\n')
+    last = start_line + max(lines_read - 1, 0) + (1 if partial and lines_read else 0)
+    result = {
+        "success": True,
+        "content": collected.decode('utf-8', errors='replace'),
+        "path": error.path,
+        "start_line": start_line,
+        "end_line": last,
+        "total_lines": None,
+        "size": error.size,
+        "truncated": more
+    }
+    if column > 1:
+        result["start_column"] = column
+    if more and partial:
+        # Continue the cut line where this page stopped
+        next_column = (column if not lines_read else 1) + len(collected) - (collected.rfind(b'\n') + 1)
+        result["next_start_line"] = last
+        result["next_start_column"] = next_column
+        result["note"] = (f"Large file ({error.size} bytes) read as a stream; showing lines {start_line}-{last}, "
+                          f"the last one cut short. Call read_file with start_line={last} and "
+                          f"start_column={next_column} to continue, or search_files to find what you need.")
+    elif more:
+        result["next_start_line"] = last + 1
+        result["note"] = (f"Large file ({error.size} bytes) read as a stream; showing lines {start_line}-{last}. "
+                          f"Call read_file with start_line={last + 1} to continue, or search_files to find what you need.")
+    return result
+
+def stream_raw_file(repo_name, branch, path):
+    """The file's bytes streamed in chunks, so memory stays bounded for any size"""
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = {'Content-Disposition': f"inline; filename*=UTF-8''{quote(path.rsplit('/', 1)[-1])}"}
+    staged = None if git_mirror.has(repo_name, branch) else staged_changes.get_file(repo_name, branch, path)
+    if staged is not None:
+        return Response(staged.encode('utf-8'), mimetype=content_type, headers=headers)
+
+    size = None
+    if git_mirror.has(repo_name, branch):
+        size = os.path.getsize(git_mirror.path(repo_name, branch, path))
+        sha = None
+    else:
+        entry = tree_indexes.get(repo_name, branch).entries.get(path)
+        if entry is None:
+            return jsonify({"error": f"{path} not found on {branch}"}), 404
+        sha, size = entry['sha'], entry.get('size')
+    if size is not None:
+        headers['Content-Length'] = str(size)
+    chunks = iter_file_chunks(repo_name, branch, path, sha)
+    # Pull the first chunk now so a failed fetch is still an error response
+    first = next(chunks, b'')
+
+    def generate():
+        yield first
+        yield from chunks
+
+    return Response(stream_with_context(generate()), mimetype=content_type, headers=headers)
+
+def read_file_result(repo_name, branch, path, start_line=None, end_line=None, start_column=None):
+    """What read_file returns for a path: a page of text, a streamed page, or binary metadata"""
+    try:
+        content, sha = read_repo_file(repo_name, branch, path)
+    except BinaryFileError as e:
+        return dict(e.describe(), success=True, note="Binary file: its contents are not shown.")
+    except FileTooLargeError as e:
+        return stream_file_page(repo_name, branch, e, start_line, end_line, start_column)
+    return read_file_page(path, content, sha, start_line, end_line, start_column)
+
+def read_repo_file(repo_name, branch, path):
+    """Return (content, sha) for a file on a branch, serving repeats from cache.
+
+    Staged, not yet committed content wins and is returned with sha None.
+    Branches checked out by the git mirror are read from their worktree.
+    Raises BinaryFileError or FileTooLargeError for files that are not
+    text or too big to hold.
+    """
+    if git_mirror.has(repo_name, branch):
+        return git_mirror.read(repo_name, branch, path)
+
+    staged = staged_changes.get_file(repo_name, branch, path)
+    if staged is not None:
+        return staged, None
+
+    started = time.time()
+    cached = file_cache.lookup(repo_name, branch, path, tree_indexes.indexed_blob(repo_name, branch, path))
+    trace_span('cache', 'file cache hit' if cached is not None else 'file cache miss', started, path=path)
+    if cached is not None:
+        return cached
+
+    index = tree_indexes.peek(repo_name, branch)
+    entry = index.entries.get(path) if index else None
+    if entry is None or (entry.get('size') or 0) <= GITHUB_CONTENTS_MAX_BYTES:
+        try:
+            file_content = repo_registry.handle(repo_name).get_contents(path, ref=branch)
+        except GithubException as e:
+            # Files over 1 MB may be refused as too_large; fetch the blob instead
+            if e.status != 403 or 'too_large' not in str(e.data):
+                raise
+            entry = tree_indexes.get(repo_name, branch).entries.get(path)
+            if entry is None:
+                raise
+        else:
+            # Over 1 MB GitHub may instead answer with empty content and encoding "none"
+            if file_content.encoding != 'none':
+                content = decode_file_text(path, base64.b64decode(file_content.content), file_content.sha)
+                file_cache.store(repo_name, branch, path, file_content.sha, content)
+                return content, file_content.sha
+            entry = {'sha': file_content.sha, 'size': file_content.size}
+
+    content = read_blob_text(repo_name, branch, path, entry['sha'], entry.get('size'))
+    file_cache.store(repo_name, branch, path, entry['sha'], content)
+    return content, entry['sha']
+
+# Batch reads. read_files fetches several files at once on a bounded pool
+# shared by the whole worker process, so eight files cost one round trip of
+# latency instead of eight, and caps how much text one call returns.
+READ_FILES_MAX_FILES = 20
+READ_FILES_MAX_BYTES = int(os.environ.get('READ_FILES_MAX_BYTES', str(96 * 1024)))
+READ_FILES_WORKERS = int(os.environ.get('READ_FILES_WORKERS', '8'))
+
+file_read_pool = ThreadPoolExecutor(max_workers=READ_FILES_WORKERS, thread_name_prefix='file-read')
+
+def read_repo_files(repo_name, branch, paths):
+    """read_file results for several paths, in order, with errors reported per file.
+
+    Files are fetched concurrently. Contents are returned until
+    READ_FILES_MAX_BYTES is reached; later files are listed as omitted.
+    """
+    def read(path):
+        try:
+            return read_file_result(repo_name, branch, path)
+        except Exception as e:
+            return {"success": False, "path": path, "error": str(e)}
+
+    # Copy the context so GitHub calls made on pool threads count towards this request
+    futures = [file_read_pool.submit(contextvars.copy_context().run, read, path) for path in paths]
+    files = []
+    total = 0
+    omitted = 0
+    for path, future in zip(paths, futures):
+        result = future.result()
+        size = len(result.get('content') or '')
+        if result.get('success') and total + size > READ_FILES_MAX_BYTES:
+            result = {"success": False, "path": path, "omitted": True,
+                      "error": "Omitted: this call reached its size limit. Read this file separately."}
+            omitted += 1
+        else:
+            total += size
+        files.append(result)
+    return {"success": True, "files": files, "total_chars": total, "truncated": bool(omitted)}
+
+def commit_repo_file(repo_name, branch, path, content, message, sha=None):
+    """Create or update a file in one commit and cache the new blob.
+
+    Pass sha when the caller already knows the current blob (edit_file);
+    otherwise it is looked up, and a missing file is created.
+    """
+    repo = repo_registry.handle(repo_name)
+    committer = InputGitAuthor(GITHUB_NAME, GITHUB_EMAIL)
+
+    if sha is None:
+        sha = file_cache.current_sha(repo_name, branch, path)
+    if sha is None:
+        index = tree_indexes.peek(repo_name, branch)
+        if index is not None:
+            # The indexed tree tells us the blob sha, or that the file is new
+            sha = (index.entries.get(path) or {}).get('sha')
+        else:
+            try:
+                sha = repo.get_contents(path, ref=branch).sha
+            except Exception:
+                sha = None
+
+    try:
+        if sha:
+            # Update existing file
+            result = repo.update_file(path=path, message=message, content=content,
+                                      sha=sha, branch=branch, committer=committer)
+        else:
+            # Create new file
+            result = repo.create_file(path=path, message=message, content=content,
+                                      branch=branch, committer=committer)
+    except Exception:
+        # A rejected write usually means the sha we held is stale
+        file_cache.invalidate(repo_name, branch, path)
+        raise
+
+    file_cache.store(repo_name, branch, path, result['content'].sha, content)
+    commit = result['commit']
+    parent_sha = commit.parents[0].sha if commit.parents else None
+    tree_indexes.record_commit(repo_name, branch, parent_sha, commit.sha, {
+        path: {'sha': result['content'].sha, 'size': result['content'].size}
+    })
+    search_indexes.record_commit(repo_name, parent_sha, commit.sha, {path: content})
+    return result
+
+def git_blob_sha(data):
+    """The sha git assigns to a blob with these bytes"""
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def commit_repo_files(repo_name, branch, files, message):
+    """Commit several files at once through the Git Data API.
+
+    Costs the same handful of calls for any number of files: read the ref
+    and parent commit, create one tree (blobs inline), one commit, and move
+    the ref. Fails without side effects if the branch moved meanwhile.
+    """
+    repo = repo_registry.handle(repo_name)
+    ref = repo.get_git_ref(f"heads/{branch}")
+    parent = repo.get_git_commit(ref.object.sha)
+    parent_index = tree_indexes.for_commit(repo_name, parent.sha)
+
+    elements = []
+    changes = {}
+    for path, content in files.items():
+        # Keep the existing mode so executables stay executable
+        mode = (parent_index.entries.get(path) or {}).get('mode') or '100644'
+        elements.append(InputGitTreeElement(path, mode, 'blob', content=content))
+        data = content.encode('utf-8')
+        changes[path] = {'sha': git_blob_sha(data), 'size': len(data), 'mode': mode}
+
+    tree = repo.create_git_tree(elements, base_tree=parent.tree)
+    identity = InputGitAuthor(GITHUB_NAME, GITHUB_EMAIL)
+    commit = repo.create_git_commit(message, tree, [parent], author=identity, committer=identity)
+    ref.edit(commit.sha)
+
+    for path, content in files.items():
+        file_cache.store(repo_name, branch, path, changes[path]['sha'], content)
+    tree_indexes.record_commit(repo_name, branch, parent.sha, commit.sha, changes)
+    search_indexes.record_commit(repo_name, parent.sha, commit.sha, files)
+    return commit
+
+# Local git mirror. With REPO_BACKEND=git, select_repo keeps a bare mirror of
+# the repository on disk and checks the new chat branch out into its own
+# worktree; the file tools then read, list and edit that worktree instead of
+# calling the REST API. Each write is a local commit (or an uncommitted
+# change while staged), and commits reach GitHub in batched pushes: shortly
+# after a write, at the end of an agent turn, or on /api/github/flush. If the
+# branch moved on GitHub meanwhile, the push fetches and rebases first.
+# Branches selected without the mirror keep using the REST path.
+REPO_BACKEND = os.environ.get('REPO_BACKEND', 'api')
+GIT_MIRROR_DIR = os.environ.get('GIT_MIRROR_DIR') or os.path.join(tempfile.gettempdir(), 'llm-dashboard-git')
+GIT_REMOTE_URL = os.environ.get('GIT_REMOTE_URL', 'https://github.com/{repo}.git')  # a local path works too
+GIT_PUSH_DELAY = float(os.environ.get('GIT_PUSH_DELAY', '5'))
+GIT_WORKTREE_TTL = float(os.environ.get('GIT_WORKTREE_TTL', str(24 * 3600)))
+GIT_TIMEOUT = 120
+
+class GitMirrorError(Exception):
+    """A git command failed"""
+
+def git_subcommand(args):
+    """The subcommand in a git argument list, skipping options such as -c name=value"""
+    args = list(args)
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ('-c', '-C') and args:
+            args.pop(0)
+    return args[0] if args else 'command'
+
+class GitMirror:
+    """Bare mirrors and per-branch worktrees, shared by all workers on this machine.
+
+    Every git command that changes a repository runs under a per-repo
+    lock: a thread lock within the worker and flock across workers. Reads
+    go straight to the worktree files.
+    """
+
+    def __init__(self, directory, remote_url, push_delay, worktree_ttl, enabled=True):
+        self.directory = directory
+        self.remote_url = remote_url
+        self.push_delay = push_delay
+        self.worktree_ttl = worktree_ttl
+        self.enabled = enabled
+        self.pushes = 0
+        self.rebases = 0
+        self.push_failures = 0
+        self._messages = {}
+        self._timers = {}
+        self._locks = {}
+        self._lock_files = {}
+        self._depth = {}
+        self._lock = threading.Lock()
+        self._env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+
+    def has(self, repo, branch):
+        """Whether this branch is checked out in a worktree"""
+        return self.enabled and bool(branch) and os.path.isdir(self._worktree(repo, branch))
+
+    def select(self, repo, base_branch=None):
+        """Refresh the mirror, create a chat branch from base and check it out; returns its details"""
+        with self._locked(repo):
+            mirror = self._mirror(repo)
+            self._prune_worktrees(repo, mirror)
+            if not base_branch:
+                base_branch = self._git('symbolic-ref', '--short', 'HEAD', cwd=mirror).strip()
+            base_sha = self._git('rev-parse', f'refs/remotes/origin/{base_branch}', cwd=mirror).strip()
+
+            timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+            branch = f"chat-{timestamp}"
+            while self._ref_exists(mirror, f'refs/heads/{branch}') or self._ref_exists(mirror, f'refs/remotes/origin/{branch}'):
+                branch = f"chat-{timestamp}-{os.urandom(3).hex()}"
+            self._git('worktree', 'add', '-q', '-b', branch, self._worktree(repo, branch), base_sha, cwd=mirror)
+            self._git('push', '-q', 'origin', f'{base_sha}:refs/heads/{branch}', cwd=mirror, network=True)
+            self._git('update-ref', f'refs/remotes/origin/{branch}', base_sha, cwd=mirror)
+        return {'branch': branch, 'base_branch': base_branch, 'files': self.index(repo, branch).files()}
+
+    def read(self, repo, branch, path):
+        """(content, blob sha) of a text file in the worktree"""
+        target = self._file(repo, branch, path)
+        try:
+            size = os.path.getsize(target)
+            if size > FILE_MAX_TEXT_BYTES:
+                raise FileTooLargeError(path, size)
+            with open(target, 'rb') as f:
+                data = f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            raise GitMirrorError(f"{path} not found on {branch}")
+        sha = git_blob_sha(data)
+        return decode_file_text(path, data, sha), sha
+
+    def path(self, repo, branch, path):
+        """Absolute path of a file in the worktree"""
+        target = self._file(repo, branch, path)
+        if not os.path.isfile(target):
+            raise GitMirrorError(f"{path} not found on {branch}")
+        return target
+
+    def write(self, repo, branch, path, content, message, commit=True):
+        """Write a file; commits it unless staged. Returns the local commit sha, or None while staged"""
+        return self.write_files(repo, branch, {path: content}, message, commit)
+
+    def write_files(self, repo, branch, files, message, commit=True):
+        """Write several files as one commit (or stage them); same return as write"""
+        targets = {path: self._file(repo, branch, path) for path in files}
+        worktree = self._worktree(repo, branch)
+        paths = list(files)
+        with self._locked(repo):
+            for path, content in files.items():
+                os.makedirs(os.path.dirname(targets[path]), exist_ok=True)
+                with open(targets[path], 'wb') as f:
+                    f.write(content.encode('utf-8'))
+            if not commit:
+                self._messages.setdefault((repo, branch), []).append(message)
+                return None
+            self._git('add', '--', *paths, cwd=worktree)
+            parent_sha = self._git('rev-parse', 'HEAD', cwd=worktree).strip()
+            if self._git('diff', '--cached', '--quiet', '--', *paths, cwd=worktree, check=False, status=True):
+                self._commit(worktree, message, paths)
+            sha = self._git('rev-parse', 'HEAD', cwd=worktree).strip()
+        if sha != parent_sha:
+            search_indexes.record_commit(repo, parent_sha, sha, files)
+        self._schedule_push(repo, branch)
+        return sha
+
+    def index(self, repo, branch):
+        """TreeIndex of the worktree: the checked-out commit plus uncommitted changes"""
+        worktree = self._worktree(repo, branch)
+        head = self.head(repo, branch)
+        entries = {}
+        for record in self._git('ls-tree', '-r', '-l', '-z', 'HEAD', cwd=worktree).split('\0'):
+            if not record:
+                continue
+            meta, path = record.split('\t', 1)
+            mode, kind, sha, size = meta.split()
+            if kind == 'blob':
+                entries[path] = {'sha': sha, 'size': int(size), 'mode': mode}
+        changes = {}
+        for path, deleted in self._changed(worktree):
+            try:
+                changes[path] = None if deleted else {'sha': None, 'size': os.path.getsize(os.path.join(worktree, path))}
+            except OSError:
+                changes[path] = None
+        return TreeIndex(head, entries).with_changes(head, changes)
+
+    def head(self, repo, branch):
+        """Commit sha checked out in the branch's worktree"""
+        return self._git('rev-parse', 'HEAD', cwd=self._worktree(repo, branch)).strip()
+
+    def archive(self, repo, commit_sha):
+        """Yield (path, bytes) for every file in a commit, streamed from git archive"""
+        process = subprocess.Popen(['git', 'archive', '--format=tar', commit_sha], cwd=self._mirror_path(repo),
+                                   env=self._env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield from iter_tar_files(process.stdout, 'r|')
+        finally:
+            process.stdout.close()
+            if process.wait(GIT_TIMEOUT):
+                raise GitMirrorError(f"git archive of {commit_sha} failed")
+
+    def pending(self, repo, branch):
+        """Paths changed in the worktree but not yet committed"""
+        return [path for path, _ in self._changed(self._worktree(repo, branch))]
+
+    def flush(self, repo, branch, message=None):
+        """Commit uncommitted changes and push; returns (commit sha or None, files committed)"""
+        worktree = self._worktree(repo, branch)
+        with self._locked(repo):
+            files = self.pending(repo, branch)
+            messages = list(dict.fromkeys(self._messages.pop((repo, branch), [])))
+            sha = None
+            if files:
+                if not message:
+                    message = messages[0] if len(messages) == 1 else f"Update {len(files)} files"
+                    if len(messages) > 1:
+                        message += "\n\n" + "\n".join(f"- {m}" for m in messages)
+                parent_sha = self.head(repo, branch)
+                changes = {}
+                for path in files:
+                    try:
+                        changes[path] = self.read(repo, branch, path)[0]
+                    except (GitMirrorError, BinaryFileError, FileTooLargeError):
+                        changes[path] = None
+                self._git('add', '-A', cwd=worktree)
+                self._commit(worktree, message)
+                search_indexes.record_commit(repo, parent_sha, self.head(repo, branch), changes)
+            self.push(repo, branch)
+            # Read the sha after pushing, as a rebase rewrites it
+            sha = self._git('rev-parse', 'HEAD', cwd=worktree).strip() if files else None
+        return sha, files
+
+    def push(self, repo, branch):
+        """Push the branch's local commits, rebasing onto GitHub's branch if it moved"""
+        mirror = self._mirror_path(repo)
+        worktree = self._worktree(repo, branch)
+        with self._locked(repo):
+            timer = self._timers.pop((repo, branch), None)
+            if timer:
+                timer.cancel()
+            unpushed = self._git('rev-list', '--count', f'refs/remotes/origin/{branch}..refs/heads/{branch}',
+                                 cwd=mirror, check=False).strip()
+            if unpushed == '0':
+                return
+            for attempt in range(2):
+                try:
+                    self._git('push', '-q', 'origin', f'refs/heads/{branch}:refs/heads/{branch}', cwd=mirror, network=True)
+                    self._git('update-ref', f'refs/remotes/origin/{branch}', f'refs/heads/{branch}', cwd=mirror)
+                    self.pushes += 1
+                    return
+                except GitMirrorError:
+                    if attempt:
+                        self.push_failures += 1
+                        raise
+                # Someone else pushed to the branch: replay our commits on top
+                self._git('fetch', '-q', 'origin', f'+refs/heads/{branch}:refs/remotes/origin/{branch}',
+                          cwd=mirror, network=True)
+                try:
+                    self._git(*self._identity(), 'rebase', '-q', '--autostash', f'refs/remotes/origin/{branch}', cwd=worktree)
+                except GitMirrorError as e:
+                    app.logger.warning("Rebase of %s@%s failed: %s", repo, branch, e)
+                    self._git('rebase', '--abort', cwd=worktree, check=False)
+                    self.push_failures += 1
+                    raise GitMirrorError(f"{branch} diverged from GitHub and the local commits do not rebase cleanly")
+                self.rebases += 1
+
+    def push_quietly(self, repo, branch):
+        try:
+            self.push(repo, branch)
+        except Exception as e:
+            app.logger.warning("Push of %s@%s failed: %s", repo, branch, e)
+
+    def stats(self):
+        worktrees = 0
+        root = os.path.join(self.directory, 'worktrees')
+        if os.path.isdir(root):
+            worktrees = sum(len(os.listdir(os.path.join(root, name))) for name in os.listdir(root))
+        return {
+            'enabled': self.enabled,
+            'worktrees': worktrees,
+            'pushes': self.pushes,
+            'rebases': self.rebases,
+            'push_failures': self.push_failures,
+            'pending_pushes': len(self._timers)
+        }
+
+    def _schedule_push(self, repo, branch):
+        """Push after a short delay so a burst of commits goes up together"""
+        with self._lock:
+            if (repo, branch) in self._timers:
+                return
+            timer = self._timers[(repo, branch)] = threading.Timer(self.push_delay, self.push_quietly, (repo, branch))
+            timer.daemon = True
+        timer.start()
+
+    def _mirror(self, repo):
+        """Path of the repo's bare mirror, cloned or fetched so it is current"""
+        mirror = self._mirror_path(repo)
+        if os.path.isdir(mirror):
+            self._git('fetch', '-q', '--prune', 'origin', cwd=mirror, network=True)
+            return mirror
+        os.makedirs(self.directory, exist_ok=True)
+        partial = mirror + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        self._git('clone', '-q', '--bare', self.remote_url.format(repo=repo), partial, cwd=self.directory, network=True)
+        self._git('config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*', cwd=partial)
+        self._git('fetch', '-q', 'origin', cwd=partial, network=True)
+        os.rename(partial, mirror)
+        return mirror
+
+    def _prune_worktrees(self, repo, mirror):
+        """Remove worktrees idle for longer than the TTL once everything in them is pushed"""
+        root = os.path.join(self.directory, 'worktrees', quote(repo, safe=''))
+        if not os.path.isdir(root):
+            return
+        for name in os.listdir(root):
+            worktree = os.path.join(root, name)
+            branch = unquote(name)
+            try:
+                idle = time.time() - os.path.getmtime(os.path.join(worktree, '.git'))
+            except OSError:
+                continue
+            if idle < self.worktree_ttl or (repo, branch) in self._timers or self._changed(worktree):
+                continue
+            unpushed = self._git('rev-list', '--count', f'refs/remotes/origin/{branch}..refs/heads/{branch}',
+                                 cwd=mirror, check=False).strip()
+            if unpushed != '0':
+                continue
+            self._git('worktree', 'remove', '--force', worktree, cwd=mirror, check=False)
+            self._git('branch', '-q', '-D', branch, cwd=mirror, check=False)
+        self._git('worktree', 'prune', cwd=mirror, check=False)
+
+    def _changed(self, worktree):
+        """[(path, deleted)] for uncommitted changes in a worktree"""
+        output = self._git('status', '--porcelain', '-z', '--untracked-files=all', '--no-renames', cwd=worktree)
+        return [(record[3:], 'D' in record[:2]) for record in output.split('\0') if record]
+
+    def _commit(self, worktree, message, paths=None):
+        self._git(*self._identity(), 'commit', '-q', '-m', message, *(['--', *paths] if paths else []), cwd=worktree)
+        # Touch the worktree link so pruning sees it in use
+        os.utime(os.path.join(worktree, '.git'))
+
+    def _identity(self):
+        return '-c', f'user.name={GITHUB_NAME}', '-c', f'user.email={GITHUB_EMAIL}'
+
+    def _ref_exists(self, mirror, ref):
+        return self._git('show-ref', '--verify', '--quiet', ref, cwd=mirror, check=False, status=True) == 0
+
+    def _git(self, *args, cwd, network=False, check=True, status=False):
+        """Run git; returns stdout, or the exit status with status=True"""
+        env = self._env
+        if network and GITHUB_TOKEN and self.remote_url.startswith('https://'):
+            # Through the environment, not -c, so the token is not visible in ps
+            credentials = base64.b64encode(f'x-access-token:{GITHUB_TOKEN}'.encode()).decode()
+            count = int(env.get('GIT_CONFIG_COUNT') or 0)
+            env = dict(env, GIT_CONFIG_COUNT=str(count + 1), **{
+                f'GIT_CONFIG_KEY_{count}': 'http.extraHeader',
+                f'GIT_CONFIG_VALUE_{count}': f'Authorization: Basic {credentials}'})
+        result = subprocess.run(['git', *args], cwd=cwd, env=env, capture_output=True, text=True,
+                                timeout=GIT_TIMEOUT)
+        if status:
+            return result.returncode
+        if check and result.returncode:
+            raise GitMirrorError(f"git {git_subcommand(args)} failed: {result.stderr.strip()[-500:]}")
+        return result.stdout
+
+    def _mirror_path(self, repo):
+        return os.path.join(self.directory, quote(repo, safe='') + '.git')
+
+    def _worktree(self, repo, branch):
+        return os.path.join(self.directory, 'worktrees', quote(repo, safe=''), quote(branch, safe=''))
+
+    def _file(self, repo, branch, path):
+        """Absolute path of a repo file, refusing anything outside the worktree or inside .git"""
+        worktree = self._worktree(repo, branch)
+        target = os.path.normpath(os.path.join(worktree, path.lstrip('/')))
+        relative = os.path.relpath(target, worktree)
+        if relative.startswith('..') or relative.split(os.sep)[0] == '.git' or relative == '.':
+            raise GitMirrorError(f"Invalid path: {path}")
+        return target
+
+    @contextlib.contextmanager
+    def _locked(self, repo):
+        """Hold the repo lock; re-entrant within a thread"""
+        with self._lock:
+            lock = self._locks.setdefault(repo, threading.RLock())
+        with lock:
+            if not self._depth.get(repo):
+                os.makedirs(self.directory, exist_ok=True)
+                handle = open(self._mirror_path(repo) + '.lock', 'a')
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                self._lock_files[repo] = handle
+            self._depth[repo] = self._depth.get(repo, 0) + 1
+            try:
+                yield
+            finally:
+                self._depth[repo] -= 1
+                if not self._depth[repo]:
+                    handle = self._lock_files.pop(repo)
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                    handle.close()
+
+git_mirror = GitMirror(GIT_MIRROR_DIR, GIT_REMOTE_URL, GIT_PUSH_DELAY, GIT_WORKTREE_TTL, enabled=REPO_BACKEND == 'git')
+
+# Staged commits. Instead of one commit per edit, writes collect in a
+# per-branch working set that is committed in one go: explicitly, at the end
+# of an /api/agent turn, or once a size or age threshold is reached. Each
+# working set is a JSON file in STAGED_DIR, changed under flock, so every
+# gunicorn worker reads, lists and flushes the same staged edits. Every
+# worker that stages on a branch arms its own age timer; whichever fires
+# first commits, and the others find nothing left to do. A failed flush
+# keeps the edits staged and arms the timer again. The default directory
+# does not depend on the gunicorn master, so sets staged before a restart
+# are picked up at startup and committed rather than lost.
+STAGED_COMMITS = os.environ.get('STAGED_COMMITS', 'false').lower() in ('1', 'true', 'yes')
+STAGED_MAX_FILES = int(os.environ.get('STAGED_MAX_FILES', '50'))
+STAGED_MAX_BYTES = int(os.environ.get('STAGED_MAX_BYTES', str(5 * 1024 * 1024)))
+STAGED_MAX_AGE = float(os.environ.get('STAGED_MAX_AGE', '120'))
+STAGED_DIR = os.environ.get('STAGED_DIR') or os.path.join(tempfile.gettempdir(), 'llm-dashboard-staged')
+
+class StagedChangeset:
+    """Uncommitted file contents for one branch"""
+
+    def __init__(self, repo, branch, files=(), messages=(), created_at=None):
+        self.repo = repo
+        self.branch = branch
+        self.files = OrderedDict(files)
+        self.messages = list(messages)
+        self.created_at = time.time() if created_at is None else created_at
+
+    @property
+    def bytes(self):
+        return sum(len(content) for content in self.files.values())
+
+    def commit_message(self):
+        messages = list(dict.fromkeys(self.messages))
+        if len(messages) == 1:
+            return messages[0]
+        summary = f"Update {len(self.files)} files"
+        return summary + "\n\n" + "\n".join(f"- {message}" for message in messages)
+
+    def to_json(self):
+        return json.dumps({'repo': self.repo, 'branch': self.branch, 'created_at': self.created_at,
+                           'messages': self.messages, 'files': list(self.files.items())})
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        return cls(data['repo'], data['branch'], data['files'], data['messages'], data['created_at'])
+
+class StagedChanges:
+    """Per-branch working sets of staged edits, each flushed as one commit"""
+
+    def __init__(self, max_files, max_bytes, max_age, directory):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.directory = directory
+        self._cache = {}  # (repo, branch) -> (file stat, changeset), saves re-parsing on every read
+        self._timers = {}
+        self._locks = {}
+        self._depth = {}
+        self._lock_files = {}
+        self._lock = threading.Lock()
+
+    def get_file(self, repo, branch, path):
+        changeset = self.pending(repo, branch)
+        return changeset.files.get(path) if changeset else None
+
+    def pending(self, repo, branch):
+        """The branch's staged changeset, or None"""
+        target = self._path(repo, branch)
+        try:
+            stat = os.stat(target)
+        except FileNotFoundError:
+            self._cache.pop((repo, branch), None)
+            return None
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self._cache.get((repo, branch))
+        if cached and cached[0] == key:
+            return cached[1]
+        try:
+            with open(target, encoding='utf-8') as f:
+                changeset = StagedChangeset.from_json(f.read())
+        except FileNotFoundError:
+            return None
+        self._cache[(repo, branch)] = (key, changeset)
+        return changeset
+
+    def stage(self, repo, branch, path, content, message):
+        """Stage a write; returns the commit sha if it triggered a flush, else None"""
+        with self._locked(repo, branch):
+            current = self.pending(repo, branch)
+            changeset = StagedChangeset(repo, branch, current.files, current.messages,
+                                        current.created_at) if current else StagedChangeset(repo, branch)
+            changeset.files[path] = content
+            changeset.files.move_to_end(path)
+            changeset.messages.append(message)
+            self._write(changeset)
+            self._arm(repo, branch, changeset.created_at + self.max_age - time.time())
+
+            if len(changeset.files) >= self.max_files or changeset.bytes >= self.max_bytes:
+                return self.flush(repo, branch).sha
+        return None
+
+    def flush(self, repo, branch, message=None):
+        """Commit everything staged for branch; returns the commit or None if nothing was staged.
+
+        Staged content stays readable until the commit lands, and stays
+        staged if the commit fails.
+        """
+        with self._locked(repo, branch):
+            changeset = self.pending(repo, branch)
+            if not changeset or not changeset.files:
+                return None
+            commit = commit_repo_files(repo, branch, changeset.files, message or changeset.commit_message())
+            self._remove(repo, branch)
+            return commit
+
+    def flush_quietly(self, repo, branch):
+        with self._lock:
+            self._timers.pop((repo, branch), None)
+        changeset = self.pending(repo, branch)
+        if changeset and time.time() - changeset.created_at < self.max_age:
+            # Flushed elsewhere and staged again since this timer was armed
+            self._arm(repo, branch, changeset.created_at + self.max_age - time.time())
+            return
+        try:
+            self.flush(repo, branch)
+        except Exception as e:
+            app.logger.warning("Staged flush of %s@%s failed: %s", repo, branch, e)
+            self._arm(repo, branch, self.max_age)
+
+    def adopt(self):
+        """Arm age timers for changesets already on disk, e.g. staged before a restart"""
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        except FileNotFoundError:
+            return 0
+        adopted = 0
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    changeset = StagedChangeset.from_json(f.read())
+            except FileNotFoundError:
+                continue
+            except (ValueError, KeyError, TypeError) as e:
+                app.logger.warning("Ignoring unreadable staged changeset %s: %s", name, e)
+                continue
+            self._arm(changeset.repo, changeset.branch, changeset.created_at + self.max_age - time.time())
+            adopted += 1
+        if adopted:
+            app.logger.info("Adopted %d staged changeset(s) from %s", adopted, self.directory)
+        return adopted
+
+    def _arm(self, repo, branch, delay):
+        """Start this worker's age timer for a branch unless one is already running"""
+        with self._lock:
+            if (repo, branch) in self._timers:
+                return
+            timer = self._timers[(repo, branch)] = threading.Timer(max(delay, 0), self.flush_quietly, (repo, branch))
+        timer.daemon = True
+        timer.start()
 
-@app.route('/api/models', methods=['GET'])
-def get_models():
-    return jsonify({"models": ALL_MODELS})
+    def _write(self, changeset):
+        # Write-then-rename so other workers never read a partial file
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(changeset.to_json())
+        os.replace(tmp, self._path(changeset.repo, changeset.branch))
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    data = request.json
-    model = data.get('model')
-    messages = data.get('messages', [])
-    repo_context = data.get('repo_context')  # {repo, branch}
+    def _remove(self, repo, branch):
+        try:
+            os.remove(self._path(repo, branch))
+        except FileNotFoundError:
+            pass
+        self._cache.pop((repo, branch), None)
 
-    if not model or not messages:
-        return jsonify({"error": "Model and messages are required"}), 400
+    def _path(self, repo, branch):
+        key = hashlib.sha1(f"{repo}\0{branch}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    @contextlib.contextmanager
+    def _locked(self, repo, branch):
+        """Hold the branch lock across workers; re-entrant within a thread"""
+        key = (repo, branch)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.RLock())
+        with lock:
+            if not self._depth.get(key):
+                os.makedirs(self.directory, exist_ok=True)
+                handle = open(self._path(repo, branch)[:-len('.json')] + '.lock', 'a')
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                self._lock_files[key] = handle
+            self._depth[key] = self._depth.get(key, 0) + 1
+            try:
+                yield
+            finally:
+                self._depth[key] -= 1
+                if not self._depth[key]:
+                    handle = self._lock_files.pop(key)
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                    handle.close()
+
+staged_changes = StagedChanges(STAGED_MAX_FILES, STAGED_MAX_BYTES, STAGED_MAX_AGE, STAGED_DIR)
+staged_changes.adopt()
+
+def is_staged(repo_context):
+    return bool(repo_context.get('staged', STAGED_COMMITS))
+
+def save_repo_file(repo_context, path, content, message, sha=None):
+    """Write a file on the context's branch; returns the commit sha, or None while staged"""
+    if git_mirror.has(repo_context['repo'], repo_context['branch']):
+        return git_mirror.write(repo_context['repo'], repo_context['branch'], path, content, message,
+                                commit=not is_staged(repo_context))
+    if is_staged(repo_context):
+        return staged_changes.stage(repo_context['repo'], repo_context['branch'], path, content, message)
+    return commit_repo_file(repo_context['repo'], repo_context['branch'], path, content, message, sha=sha)['commit'].sha
 
+def save_repo_files(repo_context, files, message):
+    """Write several files on the context's branch in one commit; returns its sha, or None while staged"""
+    repo, branch = repo_context['repo'], repo_context['branch']
+    if git_mirror.has(repo, branch):
+        return git_mirror.write_files(repo, branch, files, message, commit=not is_staged(repo_context))
+    if is_staged(repo_context):
+        commit_sha = None
+        for path, content in files.items():
+            commit_sha = staged_changes.stage(repo, branch, path, content, message) or commit_sha
+        return commit_sha
+    if len(files) == 1:
+        path, content = next(iter(files.items()))
+        return commit_repo_file(repo, branch, path, content, message)['commit'].sha
+    return commit_repo_files(repo, branch, files, message).sha
+
+def staged_note(commit_sha):
+    return '' if commit_sha else ' (staged, will be committed at the end of the turn)'
+
+def flush_branch(repo, branch, message=None):
+    """Commit what is staged on a branch; returns (commit sha or None, files committed)"""
+    if git_mirror.has(repo, branch):
+        return git_mirror.flush(repo, branch, message)
+    changeset = staged_changes.pending(repo, branch)
+    files = list(changeset.files) if changeset else []
+    commit = staged_changes.flush(repo, branch, message)
+    return (commit.sha if commit else None), files
+
+def flush_branch_quietly(repo, branch):
     try:
-        # Determine if this is a local or cloud model
-        use_local = is_local_model(model)
+        flush_branch(repo, branch)
+    except Exception as e:
+        app.logger.warning("Flush of %s@%s failed: %s", repo, branch, e)
 
-        if use_local:
-            # Local Ollama model
-            api_url = OLLAMA_API_URL
-            actual_model = get_ollama_model_id(model)
-            headers = {
-                'Content-Type': 'application/json'
-            }
+def branch_search_index(repo, branch):
+    """Search index for a branch's head with its uncommitted edits overlaid"""
+    if git_mirror.has(repo, branch):
+        commit_sha = git_mirror.head(repo, branch)
+        index = search_indexes.for_commit(repo, commit_sha, lambda: git_mirror.archive(repo, commit_sha))
+        overlay = {}
+        for path in git_mirror.pending(repo, branch):
+            try:
+                overlay[path] = git_mirror.read(repo, branch, path)[0]
+            except (GitMirrorError, BinaryFileError, FileTooLargeError):
+                overlay[path] = None
+    else:
+        commit_sha = tree_indexes.head(repo, branch)
+        index = search_indexes.for_commit(repo, commit_sha, lambda: github_tarball_files(repo, commit_sha))
+        changeset = staged_changes.pending(repo, branch)
+        overlay = dict(changeset.files) if changeset else {}
+    return index.with_changes(commit_sha, overlay) if overlay else index
+
+# Patches. apply_patch takes a unified diff touching any number of files and
+# places each hunk where its context fits best: at the line it names, or else
+# at the nearest offset, comparing lines exactly, then ignoring trailing
+# whitespace, then ignoring all whitespace, then with up to PATCH_MAX_FUZZ
+# outer context lines dropped. Hunks whose changes are already in the file
+# are skipped. Files whose hunks all apply are written in one commit; files
+# with a failed hunk are left alone, and the failure shows the lines actually
+# found so the model can correct the hunk without re-reading the file.
+PATCH_MAX_FILES = 20
+PATCH_MAX_FUZZ = 2
+PATCH_SNIPPET_LINES = 12
+
+HUNK_HEADER = re.compile(r'^@@+ *(?:-(\d+)(?:,(\d+))? +\+(\d+)(?:,(\d+))?)? *@@+')
+
+class PatchError(ValueError):
+    pass
+
+class Hunk:
+    """One @@ section: (op, text) lines where op is ' ', '-' or '+'"""
+
+    def __init__(self, old_start):
+        self.old_start = old_start  # 1-based, or None when the header gave no numbers
+        self.lines = []
+        self.lead = 0  # context lines trimmed from the top
+
+    @property
+    def old_lines(self):
+        return [text for op, text in self.lines if op != '+']
+
+    @property
+    def new_lines(self):
+        return [text for op, text in self.lines if op != '-']
+
+    def trimmed(self, fuzz):
+        """Copy without up to fuzz context lines at either end"""
+        hunk = Hunk(self.old_start)
+        hunk.lines = list(self.lines)
+        for _ in range(fuzz):
+            if hunk.lines and hunk.lines[0][0] == ' ':
+                hunk.lines.pop(0)
+                hunk.lead += 1
+            if hunk.lines and hunk.lines[-1][0] == ' ':
+                hunk.lines.pop()
+        return hunk
+
+class FilePatch:
+    def __init__(self, old_path, new_path):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks = []
+
+    @property
+    def path(self):
+        return self.new_path or self.old_path
+
+def patch_path(header):
+    """Repository path from a ---/+++ line, or None for /dev/null"""
+    path = header[4:].split('\t', 1)[0].strip()
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    if path == '/dev/null':
+        return None
+    if path[:2] in ('a/', 'b/'):
+        path = path[2:]
+    return path.lstrip('/')
+
+def hunk_counts(match):
+    """(old, new) line counts from an @@ header, or None when it gave no numbers"""
+    if not match or not match.group(1):
+        return None
+    return int(match.group(2) or 1), int(match.group(4) or 1)
+
+def is_file_header(lines, index, hunk, counts):
+    """Whether lines[index] starts a ---/+++ file header rather than continuing the hunk.
+
+    Inside a hunk, a removed '-- comment' followed by an added '++ x' looks
+    just like a header. There it only counts as one once the hunk has all
+    the lines its @@ counts promise, or if an @@ line follows it.
+    """
+    if not (lines[index].startswith('--- ') and index + 1 < len(lines) and lines[index + 1].startswith('+++ ')):
+        return False
+    if hunk is None:
+        return True
+    if counts and len(hunk.old_lines) >= counts[0] and len(hunk.new_lines) >= counts[1]:
+        return True
+    return index + 2 < len(lines) and lines[index + 2].startswith('@@')
+
+def parse_patch(text):
+    """[FilePatch] from a unified diff. Hunk line counts are not trusted:
+    a hunk runs until the next header, and a bare empty line is blank context.
+    The counts only help tell a file header from hunk lines that look like one."""
+    lines = text.replace('\r\n', '\n').split('\n')
+    files = []
+    current = hunk = counts = None
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if is_file_header(lines, index, hunk, counts):
+            current = FilePatch(patch_path(line), patch_path(lines[index + 1]))
+            files.append(current)
+            hunk = None
+            index += 2
+            continue
+        if line.startswith('@@'):
+            if current is None:
+                raise PatchError("Hunk before any file header: each file needs '--- a/path' and '+++ b/path' lines")
+            match = HUNK_HEADER.match(line)
+            hunk = Hunk(int(match.group(1)) if match and match.group(1) else None)
+            counts = hunk_counts(match)
+            current.hunks.append(hunk)
+        elif hunk is not None and line[:1] in (' ', '-', '+'):
+            hunk.lines.append((line[0], line[1:]))
+        elif hunk is not None and line == '':
+            hunk.lines.append((' ', ''))
+        elif hunk is not None and line.startswith('\\'):
+            pass  # "\ No newline at end of file"
         else:
-            # Nebius cloud model
-            api_url = NEBIUS_API_URL
-            actual_model = model
-            headers = {
-                'Authorization': f'Bearer {NEBIUS_API_KEY}',
-                'Content-Type': 'application/json'
-            }
+            hunk = None  # diff --git, index, mode lines and prose between files
+        index += 1
 
-        # Add system prompt for efficient tool usage when repo is connected
-        if repo_context:
-            system_prompt = """You are a helpful coding assistant with access to a GitHub repository. You can read AND edit files directly.
+    for file_patch in files:
+        for hunk in file_patch.hunks:
+            # Blank lines trailing a hunk are usually just the gap before the next file
+            while hunk.lines and hunk.lines[-1] == (' ', ''):
+                hunk.lines.pop()
+        file_patch.hunks = [hunk for hunk in file_patch.hunks if hunk.lines]
+    if not files:
+        raise PatchError("No file headers found: the patch must be a unified diff with '--- a/path' and '+++ b/path' lines")
+    return files
 
-YOU HAVE FULL READ AND WRITE ACCESS. Use edit_file or write_file to make changes.
+PATCH_MATCHERS = (
+    ('exact', lambda line: line),
+    ('trailing_whitespace', lambda line: line.rstrip()),
+    ('whitespace', lambda line: ' '.join(line.split())),
+)
 
-EFFICIENCY GUIDELINES - Follow these to avoid running out of steps:
-1. READ files only ONCE. Don't re-read files you've already seen.
-2. Use edit_file with replace_all=true for bulk changes (e.g., changing all occurrences of a color).
-3. PLAN your edits first, then execute them efficiently.
-4. For color scheme changes: identify all unique colors, then use edit_file with replace_all=true for each color.
-5. Combine related changes - don't make separate calls for the same type of change.
-6. You have a maximum of 25 tool calls, so be efficient!
+def find_lines(lines, wanted, expected, normalize):
+    """Start of the occurrence of wanted in lines nearest to expected, or None"""
+    if not wanted:
+        return min(max(expected, 0), len(lines))
+    wanted = [normalize(line) for line in wanted]
+    last = len(lines) - len(wanted)
+    if last < 0:
+        return None
+    expected = min(max(expected, 0), last)
+    for distance in range(max(expected, last - expected) + 1):
+        for start in (expected - distance, expected + distance) if distance else (expected,):
+            if 0 <= start <= last and normalize(lines[start]) == wanted[0] and \
+                    all(normalize(lines[start + i]) == wanted[i] for i in range(1, len(wanted))):
+                return start
+    return None
 
-CRITICAL - edit_file EXACT MATCH RULES:
-- old_text must be copied EXACTLY from the file — same whitespace, indentation, and line endings.
-- After reading a file, copy-paste the exact text you want to replace as old_text.
-- Do NOT paraphrase, reformat, or clean up old_text.
-- If edit_file says "Could not find the specified text", re-read the file and copy old_text more carefully.
-- For multi-line old_text, include enough surrounding context (3-5 lines) to make it unique.
+def closest_lines(lines, wanted, expected):
+    """(start, snippet) of the region sharing most lines with wanted, for error reports"""
+    normalize = PATCH_MATCHERS[-1][1]
+    wanted = [normalize(line) for line in wanted]
+    present = set(wanted)
+    best, best_score = min(max(expected, 0), len(lines)), 0
+    for start in range(max(1, len(lines) - len(wanted) + 1)):
+        if normalize(lines[start]) not in present:
+            continue
+        score = sum(1 for i, line in enumerate(wanted)
+                    if start + i < len(lines) and normalize(lines[start + i]) == line)
+        if score > best_score or (score == best_score and abs(start - expected) < abs(best - expected)):
+            best, best_score = start, score
+    return best, lines[best:best + min(len(wanted) + 2, PATCH_SNIPPET_LINES)]
 
-TOOL TIPS:
-- edit_file: Best for targeted changes. Use old_text/new_text with replace_all=true for global find-replace.
-- write_file: Only use for new files or complete rewrites. Avoid for small edits.
-- list_files: Use to discover available files before reading."""
-
-            # Prepend system message if not already present
-            if not messages or messages[0].get('role') != 'system':
-                messages = [{'role': 'system', 'content': system_prompt}] + messages
-
-        # Define tools for GitHub file operations
-        tools = []
-        if repo_context:
-            tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "read_file",
-                        "description": f"Read the contents of any file from the repository {repo_context['repo']} on branch {repo_context['branch']}",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "file_path": {
-                                    "type": "string",
-                                    "description": "The path to the file in the repository (e.g., 'src/app.py', 'README.md')"
-                                }
-                            },
-                            "required": ["file_path"]
-                        }
-                    }
-                },
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "write_file",
-                        "description": f"Write or update a file in the repository {repo_context['repo']} on branch {repo_context['branch']}. Changes are automatically committed. Use this for creating new files or complete rewrites.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "file_path": {
-                                    "type": "string",
-                                    "description": "The path to the file in the repository"
-                                },
-                                "content": {
-                                    "type": "string",
-                                    "description": "The complete content to write to the file"
-                                },
-                                "commit_message": {
-                                    "type": "string",
-                                    "description": "Commit message describing the changes"
-                                }
-                            },
-                            "required": ["file_path", "content", "commit_message"]
-                        }
-                    }
-                },
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "edit_file",
-                        "description": f"Edit a file by replacing specific text. Use this for making targeted changes to existing files - much more efficient than rewriting the whole file. You can call this multiple times to make multiple changes.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "file_path": {
-                                    "type": "string",
-                                    "description": "The path to the file in the repository"
-                                },
-                                "old_text": {
-                                    "type": "string",
-                                    "description": "The exact text to find and replace (must match exactly)"
-                                },
-                                "new_text": {
-                                    "type": "string",
-                                    "description": "The new text to replace it with"
-                                },
-                                "replace_all": {
-                                    "type": "boolean",
-                                    "description": "If true, replace ALL occurrences. If false (default), replace only the first occurrence."
-                                },
-                                "commit_message": {
-                                    "type": "string",
-                                    "description": "Commit message describing the change"
-                                }
-                            },
-                            "required": ["file_path", "old_text", "new_text", "commit_message"]
-                        }
-                    }
-                },
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "list_files",
-                        "description": f"List all files in the repository {repo_context['repo']} on branch {repo_context['branch']}",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {}
-                        }
-                    }
-                }
-            ]
-        
-        # Local models are much slower (CPU inference); use a smaller default
-        default_max_tokens = 512 if use_local else 4000
-        payload = {
-            'model': actual_model,
-            'messages': messages,
-            'temperature': data.get('temperature', 0.7),
-            'max_tokens': data.get('max_tokens', default_max_tokens)
-        }
+def apply_hunk(lines, hunk, expected):
+    """Apply one hunk to lines in place; returns (result dict, change in line count)"""
+    if hunk.new_lines and hunk.old_lines != hunk.new_lines:
+        # A resent patch: its result sits right where it should and the old text does not
+        at_expected = lambda wanted: find_lines(lines[expected:expected + len(wanted)], wanted, 0, PATCH_MATCHERS[1][1]) == 0
+        if at_expected(hunk.new_lines) and not at_expected(hunk.old_lines):
+            return {"status": "already_applied"}, 0
 
-        # Add tools for cloud models, and for local models that have reliable
-        # function calling support (llama3.1, qwen2.5, qwen2.5-coder).
-        # Other local models stall or produce malformed tool call responses.
-        if tools and (not use_local or local_model_supports_tools(model)):
-            payload['tools'] = tools
-            payload['tool_choice'] = 'auto'
-            # Local models need more tokens to fit tool call JSON
-            if use_local and 'max_tokens' not in data:
-                payload['max_tokens'] = 2048
-
-        # Keep timeout under Render's ~60s proxy limit so we return a clean
-        # error instead of a 502. Cloud models get a longer budget.
-        timeout = 55 if use_local else 120
-        response = requests.post(api_url, headers=headers, json=payload, timeout=timeout)
-        response.raise_for_status()
-        
-        result = response.json()
+    for fuzz in range(PATCH_MAX_FUZZ + 1):
+        trimmed = hunk.trimmed(fuzz) if fuzz else hunk
+        if fuzz and len(trimmed.lines) == len(hunk.lines):
+            break  # nothing left to trim
+        old = trimmed.old_lines
+        if fuzz and not old and hunk.old_lines:
+            break  # would insert with no anchor at all
+        for name, normalize in PATCH_MATCHERS:
+            start = find_lines(lines, old, expected + trimmed.lead, normalize)
+            if start is None:
+                continue
+            # Keep the file's own context lines; only '-' lines go and '+' lines come in
+            replacement, position = [], start
+            for op, text in trimmed.lines:
+                if op == ' ':
+                    replacement.append(lines[position])
+                    position += 1
+                elif op == '-':
+                    position += 1
+                else:
+                    replacement.append(text)
+            lines[start:position] = replacement
+            result = {"status": "applied", "line": start + 1, "offset": start - expected - trimmed.lead, "match": name}
+            if fuzz:
+                result["fuzz"] = fuzz
+            return result, len(replacement) - (position - start)
 
-        # Ensure the response has the expected OpenAI format
-        if 'choices' not in result or not result['choices']:
-            return jsonify({"error": f"Unexpected API response format - no choices: {result}"}), 500
+    if hunk.new_lines and hunk.old_lines != hunk.new_lines and find_lines(lines, hunk.new_lines, expected, PATCH_MATCHERS[1][1]) is not None:
+        return {"status": "already_applied"}, 0
+    start, snippet = closest_lines(lines, hunk.old_lines, expected)
+    return {
+        "status": "failed",
+        "error": "Context and removed lines not found in the file",
+        "closest_line": start + 1,
+        "actual": '\n'.join(snippet)
+    }, 0
 
-        # Validate that the first choice has a message
-        first_choice = result['choices'][0]
-        if 'message' not in first_choice:
-            return jsonify({"error": f"Unexpected API response format - no message in choice: {first_choice}"}), 500
+def apply_file_patch(content, file_patch):
+    """(new content, hunk results, all applied) for one file; content is '' for a new file"""
+    newline = '\r\n' if '\r\n' in content else '\n'
+    lines = content.split(newline)
+    trailing_newline = bool(content) and lines[-1] == ''
+    if trailing_newline or not content:
+        lines.pop()
 
-        return jsonify(result)
-    
-    except requests.exceptions.HTTPError as e:
-        error_msg = f"HTTP {e.response.status_code}: {e.response.text}"
-        return jsonify({"error": error_msg}), 500
-    except requests.exceptions.Timeout:
-        if use_local:
-            return jsonify({"error": "Local model timed out (>55s). Try a smaller model or a shorter prompt."}), 504
-        return jsonify({"error": "Request timed out"}), 504
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    results, delta, cursor = [], 0, 0
+    for number, hunk in enumerate(file_patch.hunks, 1):
+        if hunk.old_start is None:
+            expected = cursor  # no line numbers: look just after the previous hunk first
+        elif hunk.old_lines:
+            expected = hunk.old_start - 1 + delta
+        else:
+            expected = hunk.old_start + delta  # "-N,0" inserts after line N
+        result, change = apply_hunk(lines, hunk, expected)
+        delta += change
+        if result['status'] == 'applied':
+            cursor = result['line'] - 1 + len(hunk.trimmed(result.get('fuzz', 0)).new_lines)
+        results.append({"hunk": number, **result})
 
-@app.route('/api/execute_tool', methods=['POST'])
-def execute_tool():
-    """Execute a tool call from the LLM"""
-    data = request.json
-    tool_name = data.get('tool_name')
-    arguments = data.get('arguments', {})
-    repo_context = data.get('repo_context')
-    
-    if not tool_name:
-        return jsonify({"error": "tool_name is required"}), 400
-    
+    applied = all(result['status'] != 'failed' for result in results)
+    if not lines:
+        return '', results, applied
+    return newline.join(lines) + (newline if trailing_newline or not content else ''), results, applied
+
+def apply_repo_patch(repo_context, patch_text, message):
+    """Apply a unified diff to the context's branch; returns the apply_patch tool result"""
+    file_patches = parse_patch(patch_text)
+    if len(file_patches) > PATCH_MAX_FILES:
+        raise PatchError(f"A patch may touch at most {PATCH_MAX_FILES} files")
+    repo, branch = repo_context['repo'], repo_context['branch']
+
+    def read(file_patch):
+        if file_patch.old_path is None:
+            try:
+                return read_repo_file(repo, branch, file_patch.new_path)[0]
+            except Exception:
+                return None  # new file
+        return read_repo_file(repo, branch, file_patch.old_path)[0]
+
+    futures = [file_read_pool.submit(contextvars.copy_context().run, read, file_patch) for file_patch in file_patches]
+    files, reports = {}, []
+    for file_patch, future in zip(file_patches, futures):
+        report = {"path": file_patch.path}
+        if file_patch.new_path is None:
+            report.update(status="failed", error="Deleting files is not supported")
+        elif file_patch.old_path and file_patch.old_path != file_patch.new_path:
+            report.update(status="failed", error="Renaming files is not supported; patch the file in place")
+        elif file_patch.path in files:
+            report.update(status="failed", error="File appears twice in the patch; put all its hunks under one header")
+        else:
+            try:
+                content = future.result()
+            except Exception as e:
+                report.update(status="failed", error=f"Could not read file: {e}")
+            else:
+                new_content, hunks, applied = apply_file_patch('' if file_patch.old_path is None else content, file_patch)
+                report["hunks"] = hunks
+                if content is not None and file_patch.old_path is None and new_content != content:
+                    report.update(status="failed", error="File already exists; patch it with '--- a/path' instead of /dev/null")
+                elif not applied:
+                    report.update(status="failed", error="Not written: fix the failed hunks and send this file's patch again")
+                elif new_content == content:
+                    report["status"] = "unchanged"
+                else:
+                    report["status"] = "created" if file_patch.old_path is None else "patched"
+                    files[file_patch.path] = new_content
+        reports.append(report)
+
+    commit_sha = save_repo_files(repo_context, files, message) if files else None
+    failed = [report['path'] for report in reports if report['status'] == 'failed']
+    if not files:
+        summary = "No files changed"
+    else:
+        summary = f"{'Committed' if commit_sha else 'Saved'} {len(files)} files{staged_note(commit_sha)}"
+    if failed:
+        summary += f"; not applied to {', '.join(failed)}"
+    return {
+        "success": not failed,
+        "commit": commit_sha,
+        "message": summary,
+        "files": reports
+    }
+
+def run_tool(tool_name, arguments, repo_context):
+    """Dispatch a tool call from the LLM and return (result, status_code).
+
+    Does not touch the Flask request, so it can run on worker threads.
+    """
+    started = time.time()
+    trace = current_trace.get()
+    if trace is not None:
+        trace.mark()
+    result, status = dispatch_tool(tool_name, arguments, repo_context)
+    failed = status >= 400 or result.get('success') is False or 'error' in result
+    metrics.observe('tool_duration_seconds', time.time() - started,
+                    {'tool': tool_metric_label(tool_name), 'outcome': 'error' if failed else 'ok'})
+    trace_span('tool', tool_name, started, failed=failed,
+               path=(arguments or {}).get('file_path') if isinstance(arguments, dict) else None)
+    return result, status
+
+def tool_metric_label(tool_name):
+    return tool_name if tool_name in READ_ONLY_TOOLS or tool_name in WRITE_TOOLS else 'other'
+
+def dispatch_tool(tool_name, arguments, repo_context):
     try:
         if tool_name == 'read_file':
             file_path = arguments.get('file_path')
             if not file_path or not repo_context:
-                return jsonify({"error": "file_path and repo_context required"}), 400
-            
-            repo = github_client.get_repo(repo_context['repo'])
-            file_content = repo.get_contents(file_path, ref=repo_context['branch'])
-            content = base64.b64decode(file_content.content).decode('utf-8')
+                return {"error": "file_path and repo_context required"}, 400
             
-            return jsonify({
+            try:
+                start_line = optional_int(arguments.get('start_line'))
+                end_line = optional_int(arguments.get('end_line'))
+                start_column = optional_int(arguments.get('start_column'))
+            except (TypeError, ValueError):
+                return {"error": "start_line, end_line and start_column must be whole numbers"}, 400
+            try:
+                return read_file_result(repo_context['repo'], repo_context['branch'], file_path,
+                                        start_line, end_line, start_column), 200
+            except LineRangeError as e:
+                return {"success": False, "error": str(e), "path": file_path, "total_lines": e.total_lines}, 400
+
+        elif tool_name == 'read_files':
+            file_paths = arguments.get('file_paths')
+            if isinstance(file_paths, str):
+                file_paths = [file_paths]
+            if not file_paths or not isinstance(file_paths, list) or not repo_context:
+                return {"error": "file_paths (a list) and repo_context required"}, 400
+            file_paths = list(dict.fromkeys(str(path) for path in file_paths))
+            if len(file_paths) > READ_FILES_MAX_FILES:
+                return {"error": f"read_files takes at most {READ_FILES_MAX_FILES} paths per call"}, 400
+
+            return read_repo_files(repo_context['repo'], repo_context['branch'], file_paths), 200
+
+        elif tool_name == 'outline_file':
+            file_path = arguments.get('file_path')
+            if not file_path or not repo_context:
+                return {"error": "file_path and repo_context required"}, 400
+
+            content, sha = read_repo_file(repo_context['repo'], repo_context['branch'], file_path)
+            symbols = outline(file_path, content)
+            if symbols is None:
+                return {
+                    "success": False,
+                    "error": f"No outline for {file_path}: only Python, JavaScript/TypeScript and Markdown files are supported. Use read_file with start_line/end_line instead."
+                }, 200
+
+            return {
                 "success": True,
-                "content": content,
-                "path": file_path
-            })
+                "path": file_path,
+                "total_lines": line_index(content, sha).lines,
+                "symbols": symbols
+            }, 200
         
         elif tool_name == 'write_file':
             file_path = arguments.get('file_path')
@@ -323,44 +5483,15 @@ def execute_tool():
             commit_message = arguments.get('commit_message', f'Update {file_path}')
             
             if not all([file_path, content, repo_context]):
-                return jsonify({"error": "file_path, content, and repo_context required"}), 400
+                return {"error": "file_path, content, and repo_context required"}, 400
             
-            repo = github_client.get_repo(repo_context['repo'])
-            branch = repo_context['branch']
-            
-            # Try to get existing file
-            try:
-                file = repo.get_contents(file_path, ref=branch)
-                # Update existing file
-                result = repo.update_file(
-                    path=file_path,
-                    message=commit_message,
-                    content=content,
-                    sha=file.sha,
-                    branch=branch,
-                    committer={
-                        'name': GITHUB_NAME,
-                        'email': GITHUB_EMAIL
-                    }
-                )
-            except:
-                # Create new file
-                result = repo.create_file(
-                    path=file_path,
-                    message=commit_message,
-                    content=content,
-                    branch=branch,
-                    committer={
-                        'name': GITHUB_NAME,
-                        'email': GITHUB_EMAIL
-                    }
-                )
+            commit_sha = save_repo_file(repo_context, file_path, content, commit_message)
             
-            return jsonify({
+            return {
                 "success": True,
-                "commit": result['commit'].sha,
-                "message": f"Committed changes to {file_path}"
-            })
+                "commit": commit_sha,
+                "message": f"Committed changes to {file_path}" if commit_sha else f"Saved {file_path}{staged_note(commit_sha)}"
+            }, 200
 
         elif tool_name == 'edit_file':
             file_path = arguments.get('file_path')
@@ -370,24 +5501,22 @@ def execute_tool():
             commit_message = arguments.get('commit_message', f'Edit {file_path}')
 
             if not all([file_path, old_text is not None, new_text is not None, repo_context]):
-                return jsonify({"error": "file_path, old_text, new_text, and repo_context required"}), 400
+                return {"error": "file_path, old_text, new_text, and repo_context required"}, 400
 
-            repo = github_client.get_repo(repo_context['repo'])
             branch = repo_context['branch']
 
             # Get existing file
             try:
-                file = repo.get_contents(file_path, ref=branch)
-                current_content = base64.b64decode(file.content).decode('utf-8')
+                current_content, current_sha = read_repo_file(repo_context['repo'], branch, file_path)
             except Exception as e:
-                return jsonify({"error": f"Could not read file: {str(e)}"}), 400
+                return {"error": f"Could not read file: {str(e)}"}, 400
 
             # Check if old_text exists in the file
             if old_text not in current_content:
-                return jsonify({
+                return {
                     "success": False,
                     "error": f"Could not find the specified text in {file_path}. Make sure old_text matches exactly."
-                })
+                }, 200
 
             # Count occurrences
             count = current_content.count(old_text)
@@ -399,46 +5528,308 @@ def execute_tool():
                 new_content = current_content.replace(old_text, new_text, 1)
 
             # Update the file
-            result = repo.update_file(
-                path=file_path,
-                message=commit_message,
-                content=new_content,
-                sha=file.sha,
-                branch=branch,
-                committer={
-                    'name': GITHUB_NAME,
-                    'email': GITHUB_EMAIL
-                }
-            )
+            commit_sha = save_repo_file(repo_context, file_path, new_content, commit_message, sha=current_sha)
 
             replaced_msg = f"all {count} occurrences" if replace_all else "1 occurrence"
-            return jsonify({
+            return {
                 "success": True,
-                "commit": result['commit'].sha,
-                "message": f"Edited {file_path}: replaced {replaced_msg} successfully"
-            })
+                "commit": commit_sha,
+                "message": f"Edited {file_path}: replaced {replaced_msg} successfully{staged_note(commit_sha)}"
+            }, 200
+
+        elif tool_name == 'apply_patch':
+            patch_text = arguments.get('patch')
+            commit_message = arguments.get('commit_message') or 'Apply patch'
+            if not patch_text or not repo_context:
+                return {"error": "patch and repo_context required"}, 400
+
+            try:
+                return apply_repo_patch(repo_context, patch_text, commit_message), 200
+            except PatchError as e:
+                return {"success": False, "error": str(e)}, 400
 
         elif tool_name == 'list_files':
             if not repo_context:
-                return jsonify({"error": "repo_context required"}), 400
+                return {"error": "repo_context required"}, 400
             
-            repo = github_client.get_repo(repo_context['repo'])
-            tree = repo.get_git_tree(repo_context['branch'], recursive=True)
-            files = [item.path for item in tree.tree if item.type == 'blob']
+            if git_mirror.has(repo_context['repo'], repo_context['branch']):
+                index = git_mirror.index(repo_context['repo'], repo_context['branch'])
+                changeset = None
+            else:
+                index = tree_indexes.get(repo_context['repo'], repo_context['branch'])
+                changeset = staged_changes.pending(repo_context['repo'], repo_context['branch'])
+            if changeset:
+                # Overlay staged files so new ones show up before they are committed
+                index = index.with_changes(None, {path: {'sha': None} for path in list(changeset.files)})
+            files = [item['path'] for item in index.files(arguments.get('path'), arguments.get('pattern'))]
             
-            return jsonify({
+            return {
                 "success": True,
-                "files": files
-            })
+                "files": files,
+                "truncated": index.truncated
+            }, 200
+
+        elif tool_name == 'search_files':
+            query = arguments.get('query')
+            if not query or not repo_context:
+                return {"error": "query and repo_context required"}, 400
+
+            try:
+                max_results = min(int(arguments.get('max_results') or 50), SEARCH_MAX_RESULTS)
+            except (TypeError, ValueError):
+                max_results = 50
+            index = branch_search_index(repo_context['repo'], repo_context['branch'])
+            try:
+                result = index.search(query, regex=bool(arguments.get('regex')),
+                                      case_sensitive=bool(arguments.get('case_sensitive')),
+                                      prefix=arguments.get('path'), pattern=arguments.get('pattern'),
+                                      max_results=max(1, max_results))
+            except re.error as e:
+                return {"success": False, "error": f"Invalid regular expression: {e}"}, 400
+
+            return {"success": True, **result}, 200
         
         else:
-            return jsonify({"error": f"Unknown tool: {tool_name}"}), 400
+            return {"error": f"Unknown tool: {tool_name}"}, 400
     
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "error": str(e)
-        }), 500
+        }, 500
+
+@app.route('/api/execute_tool', methods=['POST'])
+def execute_tool():
+    """Execute a tool call from the LLM"""
+    data = request.json
+    tool_name = data.get('tool_name')
+    arguments = data.get('arguments') or {}
+    repo_context = data.get('repo_context')
+    
+    if not tool_name:
+        return jsonify({"error": "tool_name is required"}), 400
+    if not isinstance(arguments, dict):
+        return jsonify({"error": "arguments must be an object"}), 400
+
+    set_request_label('tool', tool_metric_label(tool_name))
+    result, status = run_tool(tool_name, arguments, repo_context)
+
+    # Record the result in the caller's session so it is never uploaded again.
+    # If the session is out of sync the next /api/chat call reports it.
+    if data.get('session_id') and data.get('tool_call_id'):
+        try:
+            with traced('cache', 'session append'):
+                sessions.append(data['session_id'], [{
+                    'role': 'tool',
+                    'tool_call_id': data['tool_call_id'],
+                    'name': tool_name,
+                    'content': json.dumps(result)
+                }], base=data.get('session_base'), create=False)
+        except SessionConflict:
+            pass
+
+    with traced('json', 'serialize response'):
+        return jsonify(result), status
+
+# Server-side agent loop. Tools that only read can run concurrently within
+# one assistant turn; anything that writes is run on its own, in order.
+AGENT_MAX_STEPS = 25
+AGENT_TOOL_WORKERS = int(os.environ.get('AGENT_TOOL_WORKERS', '4'))
+READ_ONLY_TOOLS = {'read_file', 'read_files', 'outline_file', 'list_files', 'search_files'}
+
+# Shared across requests so the bound applies to the whole worker process
+agent_tool_pool = ThreadPoolExecutor(max_workers=AGENT_TOOL_WORKERS, thread_name_prefix='agent-tool')
+
+def parse_tool_call(tool_call):
+    """Return (name, arguments) for an OpenAI-style tool call"""
+    function = tool_call.get('function') or {}
+    try:
+        arguments = json.loads(function.get('arguments') or '{}')
+    except ValueError:
+        arguments = {}
+    # "null", "[]" and bare strings parse fine but are not argument objects
+    if not isinstance(arguments, dict):
+        arguments = {}
+    return function.get('name'), arguments
+
+def run_tool_calls(tool_calls, repo_context):
+    """Execute one turn's tool calls, yielding (index, result) as each finishes.
+
+    Consecutive read-only calls are submitted to the pool together; a write
+    waits for the batch before it and blocks the calls after it, so edits to
+    the same file keep the order the model asked for.
+    """
+    def call(index):
+        name, arguments = parse_tool_call(tool_calls[index])
+        if not name:
+            return {"success": False, "error": "Invalid tool call - missing function name"}
+        result, _ = run_tool(name, arguments, repo_context)
+        return result
+
+    batch = []
+    for index in range(len(tool_calls)):
+        name, _ = parse_tool_call(tool_calls[index])
+        if name in READ_ONLY_TOOLS:
+            batch.append(index)
+            continue
+        yield from run_tool_batch(batch, call)
+        batch = []
+        yield index, call(index)
+    yield from run_tool_batch(batch, call)
+
+def run_tool_batch(indexes, call):
+    """Run independent tool calls on the shared pool, yielding as they complete"""
+    if len(indexes) == 1:
+        yield indexes[0], call(indexes[0])
+        return
+    # Copy the context so GitHub calls made on pool threads count towards this request
+    futures = {agent_tool_pool.submit(contextvars.copy_context().run, call, index): index for index in indexes}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+def summarize_tool_result(result):
+    """Short status line for progress events; full results stay server-side"""
+    if result.get('success') is False or result.get('error'):
+        return False, str(result.get('error') or 'failed')[:200]
+    return True, str(result.get('message') or 'done')[:200]
+
+def agent_steps(data, conversation, repo_context, max_steps):
+    """Generate SSE frames for the model/tool loop until a final answer"""
+    requested = data.get('model')
+    for step in range(1, max_steps + 1):
+        yield sse_event('step', {'step': step, 'max_steps': max_steps})
+
+        step_data = dict(data, messages=conversation)
+        upstream = prepare_routed_request(step_data)
+        accumulator = StreamAccumulator()
+        for kind, item in routed_stream(step_data, upstream):
+            if kind == 'queue':
+                yield sse_event('queue', dict(item, step=step))
+                continue
+            if kind == 'upstream':
+                upstream = item
+                if item['compaction'] and item['compaction']['tokens_saved']:
+                    yield sse_event('compaction', dict(item['compaction'], step=step))
+                if item['routing']['fallback']:
+                    yield sse_event('routing', dict(item['routing'], step=step))
+                    # Stay on the fallback for the rest of the turn
+                    data = dict(data, model=item['model'])
+                continue
+            for event, event_data in accumulator.add(item):
+                yield sse_event(event, dict(event_data, step=step))
+
+        message = accumulator.message()
+        conversation.append(message)
+        tool_calls = message.get('tool_calls')
+        if not tool_calls:
+            yield sse_event('done', {
+                'message': message,
+                'steps': step,
+                'finish_reason': accumulator.finish_reason,
+                'requested_model': requested,
+                'model': upstream['model']
+            })
+            return
+
+        for tool_call in tool_calls:
+            name, arguments = parse_tool_call(tool_call)
+            yield sse_event('tool_start', {
+                'step': step,
+                'id': tool_call['id'],
+                'name': name,
+                'arguments': {key: str(value)[:80] for key, value in arguments.items()}
+            })
+
+        results = [None] * len(tool_calls)
+        for index, result in run_tool_calls(tool_calls, repo_context):
+            results[index] = result
+            ok, summary = summarize_tool_result(result)
+            yield sse_event('tool_result', {
+                'step': step,
+                'id': tool_calls[index]['id'],
+                'name': tool_calls[index]['function']['name'],
+                'success': ok,
+                'message': summary
+            })
+
+        # Tool messages go back in the order the model issued the calls
+        for tool_call, result in zip(tool_calls, results):
+            conversation.append({
+                'role': 'tool',
+                'tool_call_id': tool_call['id'],
+                'name': tool_call['function']['name'],
+                'content': json.dumps(result)
+            })
+
+    yield sse_event('error', {"error": "Max tool call iterations reached. Please simplify your request."})
+
+def flush_staged_events(repo_context):
+    """Commit the turn's staged edits and describe the outcome as an SSE frame"""
+    try:
+        commit_sha, files = flush_branch(repo_context['repo'], repo_context['branch'])
+        if commit_sha:
+            yield sse_event('commit', {'success': True, 'commit': commit_sha, 'files': files})
+    except Exception as e:
+        yield sse_event('commit', {'success': False, 'error': str(e)})
+
+@app.route('/api/agent', methods=['POST'])
+def agent():
+    """Run the whole tool-calling loop server-side and stream progress as SSE"""
+    data = request.get_json(silent=True) or {}
+    model = data.get('model')
+    session_id = data.get('session_id')
+    if session_id:
+        try:
+            with traced('cache', 'session load'):
+                data = session_context(data)
+        except SessionConflict as e:
+            return session_conflict_response(e)
+    messages = data.get('messages', [])
+    repo_context = data.get('repo_context')
+
+    if not model or not messages:
+        return jsonify({"error": "Model and messages are required"}), 400
+    try:
+        max_steps = optional_int(data.get('max_steps'))
+    except (TypeError, ValueError):
+        max_steps = 0
+    if max_steps is not None and max_steps < 1:
+        return jsonify({"error": "max_steps must be a positive integer"}), 400
+    max_steps = min(max_steps or AGENT_MAX_STEPS, AGENT_MAX_STEPS)
+
+    use_local = is_local_model(model)
+    staged = bool(repo_context) and is_staged(repo_context)
+    if use_local:
+        try:
+            local_admission.check(model, admission_key(data))
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
+
+    def generate():
+        yield ': stream open\n\n'
+        conversation = list(messages)
+        try:
+            yield from agent_steps(data, conversation, repo_context, max_steps)
+            # Keep the whole turn, tool results included, for the next request
+            if session_id:
+                sessions.append(session_id, conversation[len(messages):], base=len(messages))
+        except GeneratorExit:
+            # Client went away mid-turn; still commit what the model staged
+            if staged:
+                flush_branch_quietly(repo_context['repo'], repo_context['branch'])
+            raise
+        except AdmissionRejected as e:
+            yield sse_event('error', {"error": str(e), "queue": e.status})
+        except Exception as e:
+            yield sse_event('error', {"error": describe_upstream_error(e, use_local)})
+        # End of turn: one commit for everything the model changed
+        if staged:
+            yield from flush_staged_events(repo_context)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/github/repos', methods=['GET'])
 def list_repos():
@@ -446,16 +5837,22 @@ def list_repos():
         return jsonify({"error": "GitHub token not configured"}), 500
     
     try:
-        user = github_client.get_user()
-        repos = []
-        for repo in user.get_repos():
-            repos.append({
-                'name': repo.name,
-                'full_name': repo.full_name,
-                'private': repo.private,
-                'default_branch': repo.default_branch
-            })
-        return jsonify({"repos": repos})
+        offset = decode_cursor(request.args['cursor']) if request.args.get('cursor') else 0
+        limit = min(max(1, int(request.args.get('limit', REPO_LIST_DEFAULT_LIMIT))), REPO_LIST_MAX_LIMIT)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        repos = repo_lists.get(GITHUB_TOKEN, refresh=request.args.get('refresh') in ('1', 'true'))
+        query = (request.args.get('q') or '').strip().lower()
+        if query:
+            repos = [repo for repo in repos if query in repo['full_name'].lower()]
+        end = offset + limit
+        return jsonify({
+            "repos": repos[offset:end],
+            "total": len(repos),
+            "next_cursor": encode_cursor(end) if end < len(repos) else None
+        })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -465,24 +5862,23 @@ def get_repo_tree(repo_name):
         return jsonify({"error": "GitHub token not configured"}), 500
     
     branch = request.args.get('branch', None)
+    prefix = request.args.get('prefix')
+    pattern = request.args.get('glob')
     
     try:
-        repo = github_client.get_repo(repo_name)
         if not branch:
-            branch = repo.default_branch
+            branch = repo_registry.default_branch(repo_name)
         
-        tree = repo.get_git_tree(branch, recursive=True)
-        files = []
-        for item in tree.tree:
-            if item.type == 'blob':  # Only files, not directories
-                files.append({
-                    'path': item.path,
-                    'sha': item.sha,
-                    'size': item.size
-                })
+        if git_mirror.has(repo_name, branch):
+            index = git_mirror.index(repo_name, branch)
+        else:
+            index = tree_indexes.get(repo_name, branch)
+        files = index.files(prefix, pattern)
         
         return jsonify({
             "files": files,
+            "commit": index.commit_sha,
+            "truncated": index.truncated,
             "branch": branch,
             "repo": repo_name
         })
@@ -502,33 +5898,43 @@ def select_repo():
         return jsonify({"error": "repo is required"}), 400
     
     try:
-        repo = github_client.get_repo(repo_name)
+        # Check the branch out locally; the file tools then work on disk
+        if git_mirror.enabled:
+            selected = git_mirror.select(repo_name, base_branch)
+            return jsonify({
+                "success": True,
+                "repo": repo_name,
+                **selected,
+                "message": f"Created branch '{selected['branch']}' from '{selected['base_branch']}'"
+            })
+
+        repo = repo_registry.handle(repo_name)
         
         # Get base branch if not specified
         if not base_branch:
-            base_branch = repo.default_branch
+            base_branch = repo_registry.default_branch(repo_name)
         
         # Create a new branch name with timestamp
         timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
         new_branch_name = f"chat-{timestamp}"
         
-        # Get the base branch reference
-        base_ref = repo.get_git_ref(f"heads/{base_branch}")
-        base_sha = base_ref.object.sha
+        # Get the base branch head (conditional request, usually a 304)
+        base_sha = tree_indexes.head(repo_name, base_branch)
         
-        # Create new branch from base
-        repo.create_git_ref(ref=f"refs/heads/{new_branch_name}", sha=base_sha)
+        # Create new branch from base; chats started in the same second
+        # would collide, so the later ones get a random suffix
+        for attempt in range(5):
+            try:
+                repo.create_git_ref(ref=f"refs/heads/{new_branch_name}", sha=base_sha)
+                break
+            except GithubException as e:
+                if e.status != 422 or attempt == 4:
+                    raise
+                new_branch_name = f"chat-{timestamp}-{os.urandom(3).hex()}"
         
-        # Get all files in the repo
-        tree = repo.get_git_tree(new_branch_name, recursive=True)
-        files = []
-        for item in tree.tree:
-            if item.type == 'blob':  # Only files
-                files.append({
-                    'path': item.path,
-                    'sha': item.sha,
-                    'size': item.size
-                })
+        # Get all files in the repo; the new branch shares the base commit's index
+        tree_indexes.set_head(repo_name, new_branch_name, base_sha)
+        files = tree_indexes.for_commit(repo_name, base_sha).files()
         
         return jsonify({
             "success": True,
@@ -555,17 +5961,26 @@ def get_file():
         return jsonify({"error": "repo and path are required"}), 400
     
     try:
-        repo = github_client.get_repo(repo_name)
         if not branch:
-            branch = repo.default_branch
-        
-        file_content = repo.get_contents(file_path, ref=branch)
-        content = base64.b64decode(file_content.content).decode('utf-8')
+            branch = repo_registry.default_branch(repo_name)
+
+        if request.args.get('raw') in ('1', 'true'):
+            return stream_raw_file(repo_name, branch, file_path)
+
+        raw_url = f"/api/github/file?{urlencode({'repo': repo_name, 'branch': branch, 'path': file_path, 'raw': 1})}"
+        try:
+            content, sha = read_repo_file(repo_name, branch, file_path)
+        except BinaryFileError as e:
+            return jsonify(dict(e.describe(), branch=branch, raw_url=raw_url))
+        except FileTooLargeError as e:
+            # The first page as a preview; the whole file is at raw_url
+            page = stream_file_page(repo_name, branch, e)
+            return jsonify(dict(page, sha=e.sha, branch=branch, raw_url=raw_url))
         
         return jsonify({
             "content": content,
             "path": file_path,
-            "sha": file_content.sha,
+            "sha": sha,
             "branch": branch
         })
     except Exception as e:
@@ -587,40 +6002,56 @@ def update_file():
         return jsonify({"error": "repo, path, content, and branch are required"}), 400
     
     try:
-        repo = github_client.get_repo(repo_name)
-        
-        # Try to get existing file
-        try:
-            file = repo.get_contents(file_path, ref=branch)
-            # Update existing file
-            result = repo.update_file(
-                path=file_path,
-                message=commit_message,
-                content=content,
-                sha=file.sha,
-                branch=branch,
-                committer={
-                    'name': GITHUB_NAME,
-                    'email': GITHUB_EMAIL
-                }
-            )
-        except:
-            # Create new file
-            result = repo.create_file(
-                path=file_path,
-                message=commit_message,
-                content=content,
-                branch=branch,
-                committer={
-                    'name': GITHUB_NAME,
-                    'email': GITHUB_EMAIL
-                }
-            )
+        repo_context = {'repo': repo_name, 'branch': branch, 'staged': data.get('staged', STAGED_COMMITS)}
+        commit_sha = save_repo_file(repo_context, file_path, content, commit_message)
         
         return jsonify({
             "success": True,
-            "commit": result['commit'].sha,
-            "message": "File updated successfully"
+            "commit": commit_sha,
+            "staged": commit_sha is None,
+            "message": "File updated successfully" if commit_sha else "File staged; flush to commit"
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/github/staged', methods=['GET'])
+def get_staged():
+    repo_name = request.args.get('repo')
+    branch = request.args.get('branch')
+    if not repo_name or not branch:
+        return jsonify({"error": "repo and branch are required"}), 400
+
+    if git_mirror.has(repo_name, branch):
+        return jsonify({"files": git_mirror.pending(repo_name, branch), "bytes": None, "age": None})
+
+    changeset = staged_changes.pending(repo_name, branch)
+    return jsonify({
+        "files": list(changeset.files) if changeset else [],
+        "bytes": changeset.bytes if changeset else 0,
+        "age": time.time() - changeset.created_at if changeset else 0
+    })
+
+@app.route('/api/github/flush', methods=['POST'])
+def flush_staged():
+    """Commit all staged changes on a branch as a single commit"""
+    if not github_client:
+        return jsonify({"error": "GitHub token not configured"}), 500
+
+    data = request.json
+    repo_name = data.get('repo')
+    branch = data.get('branch')
+    if not repo_name or not branch:
+        return jsonify({"error": "repo and branch are required"}), 400
+
+    try:
+        commit_sha, files = flush_branch(repo_name, branch, data.get('message'))
+        if not commit_sha:
+            return jsonify({"success": True, "commit": None, "message": "Nothing staged"})
+        return jsonify({
+            "success": True,
+            "commit": commit_sha,
+            "files": files,
+            "message": f"Committed {len(files)} files"
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -635,16 +6066,74 @@ def get_branches():
         return jsonify({"error": "repo is required"}), 400
     
     try:
-        repo = github_client.get_repo(repo_name)
-        branches = [branch.name for branch in repo.get_branches()]
+        repo = repo_registry.handle(repo_name)
+        branches = []
+        for branch in repo.get_branches():
+            # The listing already carries each head; no need to ask again later
+            tree_indexes.set_head(repo_name, branch.name, branch.commit.sha)
+            branches.append(branch.name)
         
         return jsonify({
             "branches": branches,
-            "default_branch": repo.default_branch
+            "default_branch": repo_registry.default_branch(repo_name)
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "file_cache": file_cache.stats(),
+        "tree_index": tree_indexes.stats(),
+        "search_index": search_indexes.stats(),
+        "repos": repo_registry.stats(),
+        "repo_list": repo_lists.stats(),
+        "sessions": sessions.stats(),
+        "context": token_estimator.stats(),
+        "git_mirror": git_mirror.stats(),
+        "responses": response_cache.stats()
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text format, merged across all gunicorn workers"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/routing', methods=['GET'])
+def routing_state():
+    """Per-model latency, error rates, circuit breakers, recent fallbacks, local queues and the model catalog"""
+    return jsonify(dict(model_router.stats(), local_admission=local_admission.stats(), catalog=model_catalog.stats()))
+
+@app.route('/api/session/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Return a conversation session, e.g. to resync a client"""
+    messages = sessions.load(session_id)
+    if messages is None:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"id": session_id, "length": len(messages), "messages": messages})
+
+@app.route('/api/session/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    sessions.delete(session_id)
+    return jsonify({"success": True})
+
+@app.route('/api/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """A run's timeline as JSON, or with format=chrome as a Trace Event Format file"""
+    if not TRACE_ID.match(trace_id):
+        return jsonify({"error": "Invalid trace id"}), 400
+    if request.args.get('format') == 'chrome':
+        trace = trace_store.chrome(trace_id)
+        if trace is None:
+            return jsonify({"error": "Trace not found"}), 404
+        return Response(json.dumps(trace), mimetype='application/json', headers={
+            'Content-Disposition': f'attachment; filename="trace-{trace_id}.json"'
+        })
+    timeline = trace_store.timeline(trace_id)
+    if timeline is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(timeline)
+
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=5000, debug=False)
 
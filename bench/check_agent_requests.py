@@ -0,0 +1,86 @@
+"""Check how /api/agent answers malformed requests.
+
+Posts requests without a JSON body and with max_steps values that are not
+positive integers, and checks that each gets a 400 with an error rather
+than a 500. Then runs valid requests against bench/fake_llm.py and checks
+that max_steps is honoured and capped at AGENT_MAX_STEPS. Exits non-zero
+if any check fails.
+
+    python bench/check_agent_requests.py
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_llm  # noqa: E402
+
+
+def sse_events(body):
+    """[(event, data)] from an SSE response body"""
+    events = []
+    for frame in body.split('\n\n'):
+        lines = frame.split('\n')
+        names = [line[len('event:'):].strip() for line in lines if line.startswith('event:')]
+        data = [line[len('data:'):].strip() for line in lines if line.startswith('data:')]
+        if names and data:
+            events.append((names[0], json.loads(data[0])))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-dir', default=os.path.dirname(HERE), help='checkout whose app.py to check')
+    args = parser.parse_args()
+
+    server, _ = fake_llm.make_server(answer_tokens=5)
+    root = tempfile.mkdtemp(prefix='check-agent-requests-')
+    os.environ.update({
+        'NEBIUS_API_URL': f"http://127.0.0.1:{server.server_port}/v1/chat/completions",
+        'NEBIUS_API_KEY': 'fake',
+        'METRICS_DIR': os.path.join(root, 'metrics'),
+        'TRACE_DIR': os.path.join(root, 'traces'),
+        'STAGED_DIR': os.path.join(root, 'staged'),
+    })
+    sys.path.insert(0, args.app_dir)
+    import app as app_module
+    client = app_module.app.test_client()
+    model = app_module.NEBIUS_MODELS[0]['id']
+    messages = [{'role': 'user', 'content': 'hello'}]
+
+    failures = []
+
+    def check(label, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {detail}")
+        if not ok:
+            failures.append(label)
+
+    response = client.post('/api/agent', data='not json', content_type='text/plain')
+    check('no JSON body', response.status_code == 400,
+          f"HTTP {response.status_code}: {(response.get_json(silent=True) or {}).get('error')}")
+
+    for max_steps in ('abc', 2.5, [3], 0, -1):
+        response = client.post('/api/agent', json={'model': model, 'messages': messages, 'max_steps': max_steps})
+        check(f'max_steps={max_steps!r}', response.status_code == 400,
+              f"HTTP {response.status_code}: {(response.get_json(silent=True) or {}).get('error')}")
+
+    for max_steps, expected in (('2', 2), (1000, app_module.AGENT_MAX_STEPS), (None, app_module.AGENT_MAX_STEPS)):
+        response = client.post('/api/agent', json={'model': model, 'messages': messages, 'max_steps': max_steps})
+        events = sse_events(response.get_data(as_text=True))
+        steps = [data.get('max_steps') for event, data in events if event == 'step']
+        check(f'max_steps={max_steps!r} runs', response.status_code == 200 and steps[:1] == [expected]
+              and events[-1][0] == 'done', f"HTTP {response.status_code}, step limit {steps[:1]}, "
+              f"last event {events[-1][0] if events else None}")
+
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
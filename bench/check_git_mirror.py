@@ -0,0 +1,153 @@
+"""Check the git backend (REPO_BACKEND=git) against a local bare repository.
+
+Creates a bare repository in a temporary directory and points
+GIT_REMOTE_URL at it, so nothing touches the network; GITHUB_API_URL
+points at a closed port so any REST call would fail. Then, through the
+app's HTTP routes, it selects the repository, writes files, and checks
+that the delayed push reaches the bare repository. It also checks that a
+branch moved by someone else is rebased before the push, and that a
+conflicting move aborts the rebase, keeps the local commit and reports the
+error. Exits non-zero if any check fails.
+
+    python bench/check_git_mirror.py
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = 'bench/demo'
+IDENTITY = ['-c', 'user.name=Someone Else', '-c', 'user.email=else@example.com']
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def make_remote(root):
+    """A bare repository at root/bench/demo.git with a few files on main"""
+    seed = os.path.join(root, 'seed')
+    os.makedirs(os.path.join(seed, 'static'))
+    with open(os.path.join(seed, 'README.md'), 'w') as f:
+        f.write('# Demo\n\nSeeded for the git backend check.\n')
+    with open(os.path.join(seed, 'static', 'theme.css'), 'w') as f:
+        f.write('.btn {\n  color: #3b82f6;\n}\n')
+    git('init', '-q', '-b', 'main', cwd=seed)
+    git('add', '-A', cwd=seed)
+    git(*IDENTITY, 'commit', '-qm', 'Initial commit', cwd=seed)
+    remote = os.path.join(root, 'remote', REPO + '.git')
+    git('clone', '-q', '--bare', seed, remote)
+    return remote
+
+
+def push_from_elsewhere(root, remote, branch, path, content, message):
+    """Commit to branch from another clone, as a second user would"""
+    other = os.path.join(root, 'other')
+    shutil.rmtree(other, ignore_errors=True)
+    git('clone', '-q', '-b', branch, remote, other)
+    with open(os.path.join(other, path), 'w') as f:
+        f.write(content)
+    git('add', '-A', cwd=other)
+    git(*IDENTITY, 'commit', '-qm', message, cwd=other)
+    git('push', '-q', 'origin', branch, cwd=other)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-dir', default=os.path.dirname(HERE), help='checkout whose app.py to check')
+    parser.add_argument('--push-delay', type=float, default=0.5, help='GIT_PUSH_DELAY for the check')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='check-git-mirror-')
+    remote = make_remote(root)
+    os.environ.update({
+        'REPO_BACKEND': 'git',
+        'GIT_REMOTE_URL': os.path.join(root, 'remote', '{repo}.git'),
+        'GIT_MIRROR_DIR': os.path.join(root, 'mirrors'),
+        'GIT_PUSH_DELAY': str(args.push_delay),
+        'GITHUB_TOKEN': 'unused',
+        'GITHUB_API_URL': 'http://127.0.0.1:9',
+        'METRICS_DIR': os.path.join(root, 'metrics'),
+    })
+    sys.path.insert(0, args.app_dir)
+    import app as app_module
+    client = app_module.app.test_client()
+
+    failures = []
+
+    def check(label, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {detail}")
+        if not ok:
+            failures.append(label)
+
+    def remote_log(branch):
+        try:
+            return git('--git-dir', remote, 'log', '--format=%s', branch).splitlines()
+        except subprocess.CalledProcessError:
+            return []
+
+    def wait_for_push(branch, subject):
+        deadline = time.time() + args.push_delay + 10
+        while time.time() < deadline:
+            if subject in remote_log(branch):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def tool(repo_context, name, **arguments):
+        response = client.post('/api/execute_tool', json={'tool_name': name, 'arguments': arguments,
+                                                          'repo_context': repo_context})
+        return response.get_json()
+
+    # Select: mirror, chat branch and worktree
+    selected = client.post('/api/github/repo/select', json={'repo': REPO}).get_json()
+    branch = selected.get('branch')
+    check('select', bool(branch) and remote_log(branch) == ['Initial commit'],
+          f"branch {branch} pushed with {len(remote_log(branch))} commit(s)")
+    repo_context = {'repo': REPO, 'branch': branch}
+
+    # Write, then the delayed push
+    result = tool(repo_context, 'edit_file', file_path='static/theme.css', old_text='#3b82f6', new_text='#B8860B',
+                  commit_message='Use the gold accent')
+    check('edit', bool(result.get('success')), result.get('message') or result.get('error'))
+    check('read back', '#B8860B' in (tool(repo_context, 'read_file', file_path='static/theme.css').get('content') or ''),
+          'worktree has the edit')
+    check('delayed push', wait_for_push(branch, 'Use the gold accent'), f"remote log: {remote_log(branch)}")
+
+    # Someone else pushes an unrelated change: rebase, then push
+    push_from_elsewhere(root, remote, branch, 'OTHER.md', 'theirs\n', 'Unrelated change')
+    tool(repo_context, 'write_file', file_path='docs/notes.md', content='mine\n', commit_message='Add notes')
+    flushed = client.post('/api/github/flush', json={'repo': REPO, 'branch': branch}).get_json()
+    log = remote_log(branch)
+    check('rebase onto a moved branch', bool(flushed.get('success')) and log[:2] == ['Add notes', 'Unrelated change'],
+          f"remote log: {log}")
+
+    # A conflicting change: the rebase is aborted and the local commit kept
+    push_from_elsewhere(root, remote, branch, 'README.md', '# Theirs\n', 'Conflicting change')
+    tool(repo_context, 'write_file', file_path='README.md', content='# Mine\n', commit_message='Rewrite README')
+    response = client.post('/api/github/flush', json={'repo': REPO, 'branch': branch})
+    flushed = response.get_json()
+    worktree = app_module.git_mirror._worktree(REPO, branch)
+    rebasing = any(os.path.exists(os.path.join(worktree, git('rev-parse', '--git-path', name, cwd=worktree)))
+                   for name in ('rebase-merge', 'rebase-apply'))
+    check('conflict reported', not flushed.get('success') or response.status_code >= 400,
+          f"HTTP {response.status_code}: {flushed.get('error') or flushed.get('message')}")
+    check('rebase aborted', not rebasing, 'no rebase in progress' if not rebasing else 'rebase left in progress')
+    check('local commit kept', git('log', '-1', '--format=%s', cwd=worktree) == 'Rewrite README'
+          and 'Conflicting change' not in git('log', '--format=%s', cwd=worktree).splitlines(),
+          f"worktree head: {git('log', '-1', '--format=%s', cwd=worktree)}")
+    check('remote untouched', remote_log(branch)[0] == 'Conflicting change', f"remote head: {remote_log(branch)[0]}")
+
+    shutil.rmtree(root, ignore_errors=True)
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
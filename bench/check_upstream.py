@@ -0,0 +1,91 @@
+"""Check that upstream LLM calls reuse pooled connections and retry 503s.
+
+Points app.py's nebius_client and ollama_client at bench/fake_llm.py, makes
+blocking and streaming completion calls through each, and checks that the
+fake server saw exactly one TCP connection per client. It then makes the
+fake answer 503 and checks that the call is retried on the same connection
+and succeeds, while a 502 is returned as is: the completion may still be
+running behind the gateway. Exits non-zero if any check fails.
+
+    python bench/check_upstream.py
+    python bench/check_upstream.py --calls 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_llm  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=5, help='blocking and streaming calls per client')
+    parser.add_argument('--app-dir', default=os.path.dirname(HERE), help='checkout whose app.py to check')
+    args = parser.parse_args()
+
+    servers = {name: fake_llm.make_server(answer_tokens=20) for name in ('nebius', 'ollama')}
+    os.environ.update({
+        'NEBIUS_API_URL': f"http://127.0.0.1:{servers['nebius'][0].server_port}/v1/chat/completions",
+        'NEBIUS_API_KEY': 'fake',
+        'OLLAMA_API_URL': f"http://127.0.0.1:{servers['ollama'][0].server_port}/v1/chat/completions",
+        'UPSTREAM_BACKOFF': '0',
+        'METRICS_DIR': tempfile.mkdtemp(prefix='check-upstream-metrics-'),
+    })
+    sys.path.insert(0, args.app_dir)
+    import app as app_module
+
+    failures = []
+
+    def check(label, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {detail}")
+        if not ok:
+            failures.append(label)
+
+    payload = {'model': 'fake-model', 'messages': [{'role': 'user', 'content': 'hello'}], 'max_tokens': 20}
+    clients = {'nebius': app_module.nebius_client, 'ollama': app_module.ollama_client}
+    for name, client in clients.items():
+        llm = servers[name][1]
+        answers = 0
+        for _ in range(args.calls):
+            response = client.post(payload, 30)
+            response.raise_for_status()
+            answers += bool(response.json()['choices'][0]['message']['content'])
+            chunks = list(app_module.iter_upstream_stream(client, payload, 30))
+            answers += any(choice.get('delta', {}).get('content') for chunk in chunks for choice in chunk['choices'])
+        stats = llm.stats()
+        check(f'{name} answers', answers == 2 * args.calls, f"{answers} of {2 * args.calls} calls answered")
+        check(f'{name} connection reuse', stats['connections'] == 1,
+              f"{stats['total']} completions over {stats['connections']} connection(s)")
+
+        llm.fail_next(1, 503)
+        response = client.post(payload, 30)
+        stats = llm.stats()
+        check(f'{name} 503 retried', response.status_code == 200 and stats['by_kind'].get('failed') == 1,
+              f"HTTP {response.status_code} after {stats['by_kind'].get('failed', 0)} failed attempt(s)")
+        check(f'{name} retry reused the connection', stats['connections'] == 1,
+              f"{stats['connections']} connection(s)")
+
+        llm.fail_next(client.max_retries + 1, 503)
+        response = client.post(payload, 30)
+        check(f'{name} gives up after {client.max_retries} retries', response.status_code == 503,
+              f"HTTP {response.status_code}")
+
+        failed = llm.stats()['by_kind'].get('failed', 0)
+        llm.fail_next(1, 502)
+        response = client.post(payload, 30)
+        attempts = llm.stats()['by_kind'].get('failed', 0) - failed
+        check(f'{name} 502 not replayed', response.status_code == 502 and attempts == 1,
+              f"HTTP {response.status_code} after {attempts} attempt(s)")
+
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+"""Local stand-in for the parts of the GitHub REST API that app.py uses.
+
+Keeps repositories in memory as real commit/tree/blob graphs, so branch
+creation, contents updates and Git Data API commits behave like GitHub,
+including ETags on the commits endpoint. Every request is counted so
+benchmarks can report GitHub calls per session.
+
+    python bench/fake_github.py --port 9100 --files 200 --latency-ms 80
+
+Point the app at it with GITHUB_API_URL=http://127.0.0.1:9100 and any
+GITHUB_TOKEN.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import re
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+def blob_sha(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def sample_files(count):
+    """A small but realistic mix of source files for benchmarks"""
+    files = {'README.md': '# Demo app\n\nUsed by the benchmark suite.\n'}
+    templates = [
+        ('src/module_{i}.py', 'import os\n\n\nclass Widget{i}:\n    color = "#3b82f6"\n\n    def render(self):\n        return "widget {i}"\n' * 4),
+        ('static/js/part_{i}.js', 'export function part{i}() {{\n  return "#3b82f6";\n}}\n' * 6),
+        ('static/css/theme_{i}.css', '.btn-{i} {{\n  color: #3b82f6;\n  background: #000000;\n}}\n' * 5),
+        ('docs/page_{i}.md', '## Page {i}\n\nSome documentation text.\n' * 8),
+    ]
+    i = 0
+    while len(files) < count:
+        path, body = templates[i % len(templates)]
+        files[path.format(i=i)] = body.format(i=i)
+        i += 1
+    return files
+
+
+class FakeRepo:
+    """One repository: blobs, trees, commits and branch refs"""
+
+    def __init__(self, full_name, files, default_branch='main', private=False):
+        self.full_name = full_name
+        self.default_branch = default_branch
+        self.private = private
+        self.blobs = {}
+        self.trees = {}
+        self.commits = {}
+        self.refs = {}
+        self.lock = threading.Lock()
+        self.refs[default_branch] = self.commit(self.make_tree(files), [], 'Initial commit')
+
+    def make_tree(self, files):
+        entries = {}
+        for path, content in files.items():
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            sha = blob_sha(data)
+            self.blobs[sha] = data
+            entries[path] = sha
+        sha = hashlib.sha1(json.dumps(sorted(entries.items())).encode()).hexdigest()
+        self.trees[sha] = entries
+        return sha
+
+    def commit(self, tree_sha, parents, message):
+        seed = json.dumps([tree_sha, parents, message, len(self.commits)]).encode()
+        sha = hashlib.sha1(seed).hexdigest()
+        self.commits[sha] = {'tree': tree_sha, 'parents': parents, 'message': message}
+        return sha
+
+    def resolve(self, ref):
+        if ref in self.refs:
+            return self.refs[ref]
+        if ref in self.commits:
+            return ref
+        return None
+
+    def files_at(self, commit_sha):
+        return self.trees[self.commits[commit_sha]['tree']]
+
+
+class FakeGitHub:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.repos = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def add_repo(self, full_name, files, **kwargs):
+        self.repos[full_name] = FakeRepo(full_name, files, **kwargs)
+        return self.repos[full_name]
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] += 1
+
+    def stats(self):
+        with self.lock:
+            return {'total': sum(self.requests.values()), 'by_route': dict(self.requests)}
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    github = None  # FakeGitHub, set by make_server
+
+    ROUTES = [
+        ('GET', r'/user', 'get_user'),
+        ('GET', r'/user/repos', 'list_repos'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)', 'get_repo'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/branches', 'list_branches'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/contents/(?P<path>.+)', 'get_contents'),
+        ('PUT', r'/repos/(?P<repo>[^/]+/[^/]+)/contents/(?P<path>.+)', 'put_contents'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/commits/(?P<ref>.+)', 'get_commit'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/git/refs?/heads/(?P<branch>.+)', 'get_ref'),
+        ('PATCH', r'/repos/(?P<repo>[^/]+/[^/]+)/git/refs/heads/(?P<branch>.+)', 'update_ref'),
+        ('POST', r'/repos/(?P<repo>[^/]+/[^/]+)/git/refs', 'create_ref'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/git/trees/(?P<sha>[^/]+)', 'get_tree'),
+        ('POST', r'/repos/(?P<repo>[^/]+/[^/]+)/git/trees', 'create_tree'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/git/commits/(?P<sha>[^/]+)', 'get_git_commit'),
+        ('POST', r'/repos/(?P<repo>[^/]+/[^/]+)/git/commits', 'create_commit'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/git/blobs/(?P<sha>[^/]+)', 'get_blob'),
+        ('GET', r'/repos/(?P<repo>[^/]+/[^/]+)/tarball/(?P<ref>.+)', 'get_tarball'),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def dispatch(self, verb):
+        url = urlparse(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = json.loads(self.rfile.read(length)) if length else {}
+
+        if url.path == '/_stats':
+            return self.send_json(self.github.stats())
+        if url.path == '/_reset' and verb == 'POST':
+            self.github.reset()
+            return self.send_json({'ok': True})
+
+        for route_verb, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if route_verb == verb and match:
+                self.github.count(f'{verb} {name}')
+                if self.github.latency:
+                    time.sleep(self.github.latency)
+                params = {key: unquote(value) for key, value in match.groupdict().items()}
+                repo = self.github.repos.get(params.pop('repo', None)) if 'repo' in match.groupdict() else None
+                if 'repo' in match.groupdict() and repo is None:
+                    return self.send_json({'message': 'Not Found'}, 404)
+                if repo is not None:
+                    with repo.lock:
+                        return getattr(self, name)(repo, **params)
+                return getattr(self, name)(**params)
+
+        self.github.count(f'{verb} unknown')
+        self.send_json({'message': f'Not Found: {verb} {url.path}'}, 404)
+
+    # Helpers
+
+    def end_headers(self):
+        # Like GitHub, report the rate limit on every response
+        used = self.github.stats()['total']
+        self.send_header('X-RateLimit-Limit', '5000')
+        self.send_header('X-RateLimit-Remaining', str(max(0, 5000 - used)))
+        super().end_headers()
+
+    @property
+    def base(self):
+        return f'http://{self.headers["Host"]}'
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def paginate(self, items, path):
+        per_page = int(self.query.get('per_page', 30))
+        page = int(self.query.get('page', 1))
+        last = max(1, -(-len(items) // per_page))
+        links = []
+        if page < last:
+            links.append(f'<{self.base}{path}?per_page={per_page}&page={page + 1}>; rel="next"')
+            links.append(f'<{self.base}{path}?per_page={per_page}&page={last}>; rel="last"')
+        headers = {'Link': ', '.join(links)} if links else {}
+        self.send_json(items[(page - 1) * per_page:page * per_page], headers=headers)
+
+    def repo_json(self, repo):
+        owner, name = repo.full_name.split('/')
+        return {
+            'id': abs(hash(repo.full_name)) % 10 ** 8,
+            'name': name,
+            'full_name': repo.full_name,
+            'owner': {'login': owner},
+            'private': repo.private,
+            'default_branch': repo.default_branch,
+            'url': f'{self.base}/repos/{repo.full_name}'
+        }
+
+    def commit_json(self, repo, sha):
+        commit = repo.commits[sha]
+        return {
+            'sha': sha,
+            'url': f'{self.base}/repos/{repo.full_name}/git/commits/{sha}',
+            'message': commit['message'],
+            'tree': {'sha': commit['tree'], 'url': f'{self.base}/repos/{repo.full_name}/git/trees/{commit["tree"]}'},
+            'parents': [{'sha': parent, 'url': f'{self.base}/repos/{repo.full_name}/git/commits/{parent}'}
+                        for parent in commit['parents']]
+        }
+
+    def ref_json(self, repo, branch):
+        return {
+            'ref': f'refs/heads/{branch}',
+            'url': f'{self.base}/repos/{repo.full_name}/git/refs/heads/{branch}',
+            'object': {'type': 'commit', 'sha': repo.refs[branch]}
+        }
+
+    # Routes
+
+    def get_user(self):
+        self.send_json({'login': 'bench', 'url': f'{self.base}/user'})
+
+    def list_repos(self):
+        repos = sorted(self.github.repos.values(), key=lambda repo: repo.full_name)
+        self.paginate([self.repo_json(repo) for repo in repos], '/user/repos')
+
+    def get_repo(self, repo):
+        self.send_json(self.repo_json(repo))
+
+    def list_branches(self, repo):
+        branches = [{'name': name, 'commit': {'sha': sha}} for name, sha in sorted(repo.refs.items())]
+        self.paginate(branches, f'/repos/{repo.full_name}/branches')
+
+    def get_contents(self, repo, path):
+        commit = repo.resolve(self.query.get('ref', repo.default_branch))
+        files = repo.files_at(commit) if commit else {}
+        if path not in files:
+            return self.send_json({'message': 'Not Found'}, 404)
+        data = repo.blobs[files[path]]
+        if len(data) > 1024 * 1024:
+            # Mirrors GitHub: contents over 1 MB come back without inline content
+            return self.send_json({'message': 'This API returns blobs up to 1 MB in size', 'errors': [{'code': 'too_large'}]}, 403)
+        self.send_json({
+            'type': 'file',
+            'encoding': 'base64',
+            'name': path.rsplit('/', 1)[-1],
+            'path': path,
+            'sha': files[path],
+            'size': len(data),
+            'content': base64.b64encode(data).decode(),
+            'url': f'{self.base}/repos/{repo.full_name}/contents/{path}'
+        })
+
+    def put_contents(self, repo, path):
+        branch = self.body.get('branch', repo.default_branch)
+        head = repo.refs.get(branch)
+        files = dict(repo.files_at(head))
+        if files.get(path) != self.body.get('sha') and (path in files or self.body.get('sha')):
+            return self.send_json({'message': f'{path} does not match {self.body.get("sha")}'}, 409)
+        data = base64.b64decode(self.body['content'])
+        new_files = {name: repo.blobs[sha] for name, sha in files.items()}
+        new_files[path] = data
+        sha = repo.commit(repo.make_tree(new_files), [head], self.body.get('message', ''))
+        repo.refs[branch] = sha
+        self.send_json({
+            'content': {'type': 'file', 'path': path, 'name': path.rsplit('/', 1)[-1],
+                        'sha': blob_sha(data), 'size': len(data)},
+            'commit': self.commit_json(repo, sha)
+        }, 201 if path not in files else 200)
+
+    def get_commit(self, repo, ref):
+        sha = repo.resolve(ref)
+        if sha is None:
+            return self.send_json({'message': 'No commit found'}, 422)
+        etag = f'"{sha}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if 'sha' in (self.headers.get('Accept') or ''):
+            body = sha.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_json({'sha': sha, 'commit': self.commit_json(repo, sha)}, headers={'ETag': etag})
+
+    def get_ref(self, repo, branch):
+        if branch not in repo.refs:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_json(self.ref_json(repo, branch))
+
+    def update_ref(self, repo, branch):
+        sha = self.body['sha']
+        if not self.body.get('force') and repo.refs[branch] not in repo.commits[sha]['parents']:
+            return self.send_json({'message': 'Update is not a fast forward'}, 422)
+        repo.refs[branch] = sha
+        self.send_json(self.ref_json(repo, branch))
+
+    def create_ref(self, repo):
+        branch = self.body['ref'].replace('refs/heads/', '', 1)
+        if branch in repo.refs:
+            return self.send_json({'message': 'Reference already exists'}, 422)
+        repo.refs[branch] = self.body['sha']
+        self.send_json(self.ref_json(repo, branch), 201)
+
+    def get_tree(self, repo, sha):
+        # Like GitHub, accept a branch name or commit sha as well as a tree sha
+        commit = repo.commits.get(repo.resolve(sha))
+        tree_sha = commit['tree'] if commit else sha
+        if tree_sha not in repo.trees:
+            return self.send_json({'message': 'Not Found'}, 404)
+        entries = repo.trees[tree_sha]
+        items = []
+        directories = set()
+        for path, blob in sorted(entries.items()):
+            parts = path.split('/')
+            for depth in range(1, len(parts)):
+                directories.add('/'.join(parts[:depth]))
+            items.append({'path': path, 'mode': '100644', 'type': 'blob', 'sha': blob, 'size': len(repo.blobs[blob])})
+        items += [{'path': path, 'mode': '040000', 'type': 'tree', 'sha': ''} for path in sorted(directories)]
+        if self.query.get('recursive') not in ('1', 'true'):
+            items = [item for item in items if '/' not in item['path']]
+        self.send_json({'sha': tree_sha, 'url': f'{self.base}/repos/{repo.full_name}/git/trees/{tree_sha}',
+                        'tree': items, 'truncated': False})
+
+    def create_tree(self, repo):
+        base = repo.trees.get(self.body.get('base_tree'), {})
+        files = {path: repo.blobs[sha] for path, sha in base.items()}
+        for item in self.body['tree']:
+            if item.get('sha') is None and 'content' not in item:
+                files.pop(item['path'], None)
+            elif 'content' in item:
+                files[item['path']] = item['content'].encode('utf-8')
+            else:
+                files[item['path']] = repo.blobs[item['sha']]
+        sha = repo.make_tree(files)
+        self.send_json({'sha': sha, 'url': f'{self.base}/repos/{repo.full_name}/git/trees/{sha}', 'tree': []}, 201)
+
+    def get_git_commit(self, repo, sha):
+        if sha not in repo.commits:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_json(self.commit_json(repo, sha))
+
+    def create_commit(self, repo):
+        sha = repo.commit(self.body['tree'], self.body.get('parents', []), self.body.get('message', ''))
+        self.send_json(self.commit_json(repo, sha), 201)
+
+    def get_blob(self, repo, sha):
+        if sha not in repo.blobs:
+            return self.send_json({'message': 'Not Found'}, 404)
+        data = repo.blobs[sha]
+        if 'raw' in (self.headers.get('Accept') or ''):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.send_json({'sha': sha, 'size': len(data), 'encoding': 'base64',
+                        'content': base64.b64encode(data).decode()})
+
+    def get_tarball(self, repo, ref):
+        sha = repo.resolve(ref)
+        if sha is None:
+            return self.send_json({'message': 'Not Found'}, 404)
+        # GitHub redirects to codeload; serve the archive directly, with the
+        # same owner-repo-sha/ top-level directory
+        top = f"{repo.full_name.replace('/', '-')}-{sha[:7]}"
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for path, blob in sorted(repo.files_at(sha).items()):
+                data = repo.blobs[blob]
+                info = tarfile.TarInfo(f'{top}/{path}')
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients that stop reading a streamed blob early are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(port=0, latency=0.0, files=200, repos=1):
+    """Start a fake GitHub on a background thread; returns (server, FakeGitHub)"""
+    github = FakeGitHub(latency)
+    for i in range(repos):
+        github.add_repo('bench/demo' if i == 0 else f'bench/demo-{i}', sample_files(files))
+    handler = type('BoundHandler', (Handler,), {'github': github})
+    server = QuietServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, github
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency-ms', type=float, default=0, help='added delay per request')
+    parser.add_argument('--files', type=int, default=200, help='files in each fake repo')
+    parser.add_argument('--repos', type=int, default=1)
+    args = parser.parse_args()
+    server, _ = make_server(args.port, args.latency_ms / 1000, args.files, args.repos)
+    print(f'Fake GitHub API on http://127.0.0.1:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
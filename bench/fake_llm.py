@@ -0,0 +1,276 @@
+"""Local stand-in for an OpenAI-compatible chat completions endpoint.
+
+Answers like Nebius or Ollama would, streaming or not, after a configurable
+time to first token and at a configurable generation speed. When the
+request offers tools it plays a scripted agent: each round of tool calls
+comes from PLAN, then it gives a final answer. Every request is counted,
+along with the prompt bytes it carried, so benchmarks can report upstream
+calls and upload size per session.
+
+    python bench/fake_llm.py --port 9200 --latency-ms 300 --tokens-per-sec 40
+
+Point the app at it with NEBIUS_API_URL / OLLAMA_API_URL set to
+http://127.0.0.1:9200/v1/chat/completions and any NEBIUS_API_KEY.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# One entry per agent round: the tool calls to make, as (name, arguments).
+# Paths exist in bench/fake_github.py's sample repo.
+PLAN = [
+    [('list_files', {'path': 'static', 'pattern': '*.css'})],
+    [('read_file', {'file_path': 'README.md'}),
+     ('read_file', {'file_path': 'static/css/theme_2.css'})],
+    [('edit_file', {'file_path': 'static/css/theme_2.css', 'old_text': '#3b82f6', 'new_text': '#B8860B',
+                    'replace_all': True, 'commit_message': 'Use the gold accent'})],
+    [('read_file', {'file_path': 'static/css/theme_2.css'})],
+]
+
+
+class FakeLLM:
+    def __init__(self, latency=0.0, tokens_per_sec=0.0, answer_tokens=60, plan=None, load_seconds=0.0):
+        self.latency = latency
+        self.load_seconds = load_seconds
+        self.loaded = set()
+        self.tokens_per_sec = tokens_per_sec
+        self.answer_tokens = answer_tokens
+        self.plan = PLAN if plan is None else plan
+        self.requests = Counter()
+        self.prompt_bytes = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.connections = 0
+        self.failures = []  # HTTP statuses to answer the next completions with
+        self.lock = threading.Lock()
+
+    def count(self, key, prompt_bytes):
+        with self.lock:
+            self.requests[key] += 1
+            self.prompt_bytes += prompt_bytes
+
+    def stats(self):
+        with self.lock:
+            return {'total': sum(self.requests.values()), 'by_kind': dict(self.requests),
+                    'prompt_bytes': self.prompt_bytes, 'peak_in_flight': self.peak_in_flight,
+                    'connections': self.connections}
+
+    def fail_next(self, count=1, status=503):
+        """Answer the next count completions with an error status"""
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    def next_failure(self):
+        with self.lock:
+            return self.failures.pop(0) if self.failures else None
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.prompt_bytes = 0
+            self.peak_in_flight = self.in_flight
+
+    def track(self, delta):
+        """Count completions being generated at once"""
+        with self.lock:
+            self.in_flight += delta
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def load(self, model):
+        """Seconds spent loading a model for an Ollama generate call; the first load is slow"""
+        with self.lock:
+            if model in self.loaded:
+                return 0.0
+        time.sleep(self.load_seconds)
+        with self.lock:
+            self.loaded.add(model)
+        return self.load_seconds
+
+    def next_round(self, messages):
+        """Index into the plan: tool rounds already answered since the last user message"""
+        rounds = 0
+        for message in reversed(messages):
+            if message.get('role') == 'user':
+                break
+            if message.get('role') == 'assistant' and message.get('tool_calls'):
+                rounds += 1
+        return rounds
+
+    def reply(self, body):
+        """(content, tool_calls) for a request"""
+        messages = body.get('messages') or []
+        step = self.next_round(messages)
+        if body.get('tools') and step < len(self.plan):
+            calls = [{
+                'id': f'call_{step}_{index}',
+                'type': 'function',
+                'function': {'name': name, 'arguments': json.dumps(arguments)}
+            } for index, (name, arguments) in enumerate(self.plan[step])]
+            return None, calls
+        words = ['Done.'] + 'The accent colour is now gold.'.split() * self.answer_tokens
+        return ' '.join(words[:max(1, self.answer_tokens)]), None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    llm = None  # FakeLLM, set by make_server
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.llm.lock:
+            self.llm.connections += 1
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/_stats':
+            return self.send_json(self.llm.stats())
+        if path.endswith('/models') or path == '/api/tags':
+            return self.send_json({'object': 'list', 'data': [{'id': 'fake-model', 'object': 'model'}],
+                                   'models': [{'name': 'fake-model:latest', 'model': 'fake-model:latest'}]})
+        if path == '/api/ps':
+            with self.llm.lock:
+                loaded = sorted(self.llm.loaded)
+            return self.send_json({'models': [{'name': name, 'model': name} for name in loaded]})
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length)
+        path = urlparse(self.path).path
+        if path == '/_reset':
+            self.llm.reset()
+            return self.send_json({'ok': True})
+        body = json.loads(raw or b'{}')
+        if path == '/api/generate':
+            # Ollama preload: no prompt, just load the weights
+            seconds = self.llm.load(body.get('model'))
+            return self.send_json({'model': body.get('model'), 'done': True, 'load_duration': int(seconds * 1e9)})
+        status = self.llm.next_failure()
+        if status:
+            self.llm.count('failed', len(raw))
+            return self.send_json({'error': {'message': 'overloaded', 'code': status}}, status)
+        content, tool_calls = self.llm.reply(body)
+        self.llm.count('tool_calls' if tool_calls else 'answer', len(raw))
+        usage = {
+            'prompt_tokens': max(1, len(raw) // 4),
+            'completion_tokens': self.completion_tokens(content, tool_calls),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+
+        self.llm.track(1)
+        try:
+            self.respond(body, content, tool_calls, usage)
+        finally:
+            self.llm.track(-1)
+
+    def respond(self, body, content, tool_calls, usage):
+        time.sleep(self.llm.latency)
+        if body.get('stream'):
+            self.stream(body, content, tool_calls, usage)
+        else:
+            time.sleep(self.generation_time(usage['completion_tokens']))
+            message = {'role': 'assistant', 'content': content}
+            if tool_calls:
+                message['tool_calls'] = tool_calls
+            self.send_json({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': message,
+                             'finish_reason': 'tool_calls' if tool_calls else 'stop'}],
+                'usage': usage
+            })
+
+    def stream(self, body, content, tool_calls, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(delta, finish_reason=None):
+            self.write_event({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'model': body.get('model'),
+                              'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+
+        if tool_calls:
+            for index, call in enumerate(tool_calls):
+                chunk({'tool_calls': [{'index': index, 'id': call['id'], 'type': 'function',
+                                       'function': {'name': call['function']['name'], 'arguments': ''}}]})
+                chunk({'tool_calls': [{'index': index, 'function': {'arguments': call['function']['arguments']}}]})
+                time.sleep(self.generation_time(usage['completion_tokens'] / len(tool_calls)))
+            chunk({}, 'tool_calls')
+        else:
+            delay = self.generation_time(1)
+            for index, word in enumerate(content.split(' ')):
+                chunk({'content': word if index == 0 else ' ' + word})
+                time.sleep(delay)
+            chunk({}, 'stop')
+        if (body.get('stream_options') or {}).get('include_usage'):
+            self.write_event({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+        self.write_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    # Helpers
+
+    def completion_tokens(self, content, tool_calls):
+        if tool_calls:
+            return sum(len(call['function']['arguments']) // 4 + 5 for call in tool_calls)
+        return len(content.split(' '))
+
+    def generation_time(self, tokens):
+        return tokens / self.llm.tokens_per_sec if self.llm.tokens_per_sec else 0
+
+    def write_event(self, data):
+        payload = ('data: ' + (data if isinstance(data, str) else json.dumps(data)) + '\n\n').encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+        self.wfile.flush()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients that cancel a streamed completion close the connection mid-answer
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(port=0, latency=0.0, tokens_per_sec=0.0, answer_tokens=60, plan=None, load_seconds=0.0):
+    """Start a fake LLM endpoint on a background thread; returns (server, FakeLLM)"""
+    llm = FakeLLM(latency, tokens_per_sec, answer_tokens, plan, load_seconds)
+    handler = type('BoundHandler', (Handler,), {'llm': llm})
+    server = QuietServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, llm
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--latency-ms', type=float, default=0, help='time to first token')
+    parser.add_argument('--tokens-per-sec', type=float, default=0, help='generation speed (0 = instant)')
+    parser.add_argument('--answer-tokens', type=int, default=60, help='length of final answers')
+    parser.add_argument('--load-seconds', type=float, default=0, help='time to load a model on first Ollama preload')
+    args = parser.parse_args()
+    server, _ = make_server(args.port, args.latency_ms / 1000, args.tokens_per_sec, args.answer_tokens,
+                            load_seconds=args.load_seconds)
+    print(f'Fake LLM API on http://127.0.0.1:{server.server_port}/v1/chat/completions')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,100 @@
+"""Count the GitHub API requests one typical agent session makes.
+
+Replays the UI and tool calls of a small edit session (load the repo list,
+select a repo, list files, read a few, edit one file several times, add a
+file) through the app's
+HTTP routes against bench/fake_github.py, and prints the GitHub requests
+each step cost.
+
+    python bench/github_requests.py
+    python bench/github_requests.py --staged
+    python bench/github_requests.py --app-dir /tmp/baseline   # an older checkout, for comparison
+"""
+import argparse
+import functools
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fake_github import make_server  # noqa: E402
+
+
+def session_steps(repo_context):
+    """(label, tool_name, arguments) for a typical 12-call edit session"""
+    return [
+        ('list_files', 'list_files', {}),
+        ('read README.md', 'read_file', {'file_path': 'README.md'}),
+        ('read src/module_0.py', 'read_file', {'file_path': 'src/module_0.py'}),
+        ('read static/css/theme_2.css', 'read_file', {'file_path': 'static/css/theme_2.css'}),
+        ('re-read src/module_0.py', 'read_file', {'file_path': 'src/module_0.py'}),
+        ('edit theme_2.css #1', 'edit_file', {'file_path': 'static/css/theme_2.css', 'old_text': '#3b82f6',
+                                              'new_text': '#B8860B', 'replace_all': True, 'commit_message': 'Gold accent'}),
+        ('edit theme_2.css #2', 'edit_file', {'file_path': 'static/css/theme_2.css', 'old_text': '#000000',
+                                              'new_text': '#111111', 'replace_all': True, 'commit_message': 'Softer black'}),
+        ('edit module_0.py', 'edit_file', {'file_path': 'src/module_0.py', 'old_text': '#3b82f6',
+                                           'new_text': '#B8860B', 'commit_message': 'Gold widget'}),
+        ('write NOTES.md', 'write_file', {'file_path': 'NOTES.md', 'content': '# Notes\n',
+                                          'commit_message': 'Add notes'}),
+        ('re-read theme_2.css', 'read_file', {'file_path': 'static/css/theme_2.css'}),
+        ('list_files static/', 'list_files', {'path': 'static', 'pattern': '*.css'}),
+        ('read static/js/part_1.js', 'read_file', {'file_path': 'static/js/part_1.js'}),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-dir', default=os.path.dirname(HERE), help='directory containing app.py')
+    parser.add_argument('--staged', action='store_true', help='stage edits and flush once at the end')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    server, github = make_server()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    os.environ['GITHUB_API_URL'] = base_url
+    os.environ.setdefault('GITHUB_TOKEN', 'bench-token')
+
+    # Older checkouts hard-code api.github.com; redirect PyGithub for them too
+    import github as pygithub
+    pygithub.Github = functools.partial(pygithub.Github, base_url=base_url, seconds_between_requests=None,
+                                        seconds_between_writes=None)
+
+    sys.path.insert(0, args.app_dir)
+    import app as app_module
+    client = app_module.app.test_client()
+
+    steps = []
+
+    def measure(label, call):
+        before = github.stats()['total']
+        response = call()
+        steps.append({'step': label, 'github_requests': github.stats()['total'] - before,
+                      'status': response.status_code})
+        return response
+
+    measure('list_repos', lambda: client.get('/api/github/repos'))
+    selected = measure('select_repo', lambda: client.post('/api/github/repo/select', json={'repo': 'bench/demo'}))
+    branch = selected.get_json()['branch']
+    repo_context = {'repo': 'bench/demo', 'branch': branch, 'staged': args.staged}
+
+    for label, tool_name, arguments in session_steps(repo_context):
+        measure(label, lambda: client.post('/api/execute_tool', json={
+            'tool_name': tool_name, 'arguments': arguments, 'repo_context': repo_context}))
+
+    if args.staged:
+        measure('flush', lambda: client.post('/api/github/flush', json={'repo': 'bench/demo', 'branch': branch}))
+
+    total = sum(step['github_requests'] for step in steps)
+    if args.json:
+        print(json.dumps({'total': total, 'steps': steps, 'by_route': github.stats()['by_route']}, indent=2))
+        return
+
+    for step in steps:
+        print(f"{step['step']:<32} {step['github_requests']:>3}  (HTTP {step['status']})")
+    print(f"{'total':<32} {total:>3}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+"""Load test app.py with scripted agent sessions against local fakes.
+
+Starts bench/fake_llm.py and bench/fake_github.py in this process, runs the
+app under gunicorn, and replays the browser's callLLMWithTools loop: select
+a repo, then POST /api/chat and run each requested tool through
+/api/execute_tool until the model answers. Sessions run at each requested
+concurrency level. Per level it reports throughput, p50/p95/p99 latencies,
+upstream LLM and GitHub calls per session, the latency of /api/models
+under that load, and the memory of each gunicorn worker. Sessions per GB
+divides the most sessions the server held in flight at once by the peak
+memory of all workers. Everything goes to a JSON file for comparing runs.
+
+    python bench/load_test.py
+    python bench/load_test.py --concurrency 1 8 32 --sessions 64 --workers 4
+    python bench/load_test.py --server-mode sync threads gevent --concurrency 64
+    python bench/load_test.py --mode agent --llm-latency-ms 800 --tokens-per-sec 30
+    python bench/load_test.py --app-dir /tmp/baseline --output before.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_github  # noqa: E402
+import fake_llm  # noqa: E402
+
+PROMPT = 'Change the accent colour in theme_2.css to gold and tell me what you changed.'
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 4)}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Serving the app
+
+def start_app(args, env, server_mode):
+    """Run the app under gunicorn and wait until it answers"""
+    env = dict(env, SERVER_MODE=server_mode)
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+               '--timeout', '600', '--log-level', 'warning']
+    if args.worker_class:
+        command += ['--worker-class', args.worker_class]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    command += args.gunicorn_arg + ['app:app']
+    process = subprocess.Popen(command, cwd=args.app_dir, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(base_url + '/api/models', timeout=1).ok:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited with status {process.returncode}')
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('gunicorn did not start within 30s')
+
+
+def worker_pids(master_pid):
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The command name may contain spaces; fields after it are fixed
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+    return sorted(pids)
+
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class MemorySampler:
+    """Tracks the peak resident memory of each gunicorn worker"""
+
+    def __init__(self, master_pid, interval=0.25):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def _sample(self):
+        for pid in worker_pids(self.master_pid):
+            self.peaks[pid] = max(self.peaks.get(pid, 0.0), rss_mb(pid))
+
+    def report(self):
+        peaks = [round(value, 1) for value in self.peaks.values()]
+        return {
+            'workers': len(peaks),
+            'peak_rss_mb_per_worker': peaks,
+            'peak_rss_mb_avg': round(sum(peaks) / len(peaks), 1) if peaks else None,
+            'peak_rss_mb_total': round(sum(peaks), 1)
+        }
+
+
+class ModelsProbe:
+    """Times a cheap route (/api/models) while sessions are running"""
+
+    def __init__(self, base_url, interval=0.5):
+        self.base_url = base_url
+        self.interval = interval
+        self.seconds = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                requests.get(self.base_url + '/api/models', timeout=300)
+                self.seconds.append(time.time() - started)
+            except requests.RequestException:
+                pass
+            self._stop.wait(self.interval)
+
+
+# Scripted sessions
+
+def read_events(response):
+    """Yield (event, data) pairs from a Server-Sent Events response"""
+    event = 'message'
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith('event:'):
+            event = line[6:].strip()
+        elif line.startswith('data:'):
+            yield event, json.loads(line[5:].strip())
+            event = 'message'
+
+
+class ScriptedSession:
+    """One chat turn as the browser plays it, timing every request"""
+
+    def __init__(self, base_url, args, index):
+        self.base_url = base_url
+        self.args = args
+        self.index = index
+        self.http = requests.Session()
+        self.timings = []
+
+    def timed(self, kind, method, path, **kwargs):
+        started = time.time()
+        response = self.http.request(method, self.base_url + path, timeout=300, **kwargs)
+        if not kwargs.get('stream'):
+            response.content
+        self.timings.append((kind, time.time() - started, response.status_code))
+        return response
+
+    def run(self):
+        started = time.time()
+        try:
+            repo_context = None
+            if self.args.repo:
+                response = self.timed('select_repo', 'POST', '/api/github/repo/select', json={'repo': self.args.repo})
+                response.raise_for_status()
+                repo_context = {'repo': self.args.repo, 'branch': response.json()['branch']}
+            messages = [{'role': 'user', 'content': PROMPT}]
+            if self.args.mode == 'agent':
+                self.agent_turn(messages, repo_context)
+            else:
+                self.chat_turn(messages, repo_context)
+            return {'ok': True, 'seconds': time.time() - started, 'timings': self.timings}
+        except Exception as e:
+            return {'ok': False, 'seconds': time.time() - started, 'timings': self.timings, 'error': str(e)[:300]}
+        finally:
+            self.http.close()
+
+    def chat_turn(self, messages, repo_context):
+        """The callLLMWithTools loop: one /api/chat per step, tools via /api/execute_tool"""
+        session_id = f'bench-{os.getpid()}-{self.index}-{random.getrandbits(32):x}'
+        synced = 0
+        for _ in range(25):
+            payload = {'model': self.args.model, 'stream': True, 'repo_context': repo_context}
+            if self.args.no_sessions:
+                payload['messages'] = messages
+            else:
+                payload.update(messages=messages[synced:], session_id=session_id, session_base=synced)
+            message = self.chat_step(payload)
+            if message is None:
+                payload.update(messages=messages, session_reset=True)
+                payload.pop('session_base', None)
+                message = self.chat_step(payload)
+            messages.append(message)
+            synced = len(messages)
+            if not message.get('tool_calls'):
+                return
+            for call in message['tool_calls']:
+                body = {
+                    'tool_name': call['function']['name'],
+                    'arguments': json.loads(call['function']['arguments'] or '{}'),
+                    'repo_context': repo_context
+                }
+                if not self.args.no_sessions:
+                    body.update(session_id=session_id, session_base=len(messages), tool_call_id=call['id'])
+                result = self.timed('execute_tool', 'POST', '/api/execute_tool', json=body).json()
+                messages.append({'role': 'tool', 'tool_call_id': call['id'], 'name': call['function']['name'],
+                                 'content': json.dumps(result)})
+                synced = len(messages)
+        raise RuntimeError('no final answer after 25 steps')
+
+    def chat_step(self, payload):
+        """Stream one completion; None means the server asked for a resync"""
+        started = time.time()
+        with self.http.post(self.base_url + '/api/chat', json=payload, stream=True, timeout=300) as response:
+            if response.status_code == 409:
+                response.content
+                self.timings.append(('chat', time.time() - started, 409))
+                return None
+            response.raise_for_status()
+            result = None
+            for event, data in read_events(response):
+                if event in ('done', 'error'):
+                    result = (event, data)
+        self.timings.append(('chat', time.time() - started, response.status_code))
+        if not result or result[0] == 'error':
+            raise RuntimeError(f'chat failed: {result[1] if result else "stream ended early"}')
+        return result[1]['choices'][0]['message']
+
+    def agent_turn(self, messages, repo_context):
+        """The whole loop server-side in one /api/agent request"""
+        started = time.time()
+        with self.http.post(self.base_url + '/api/agent', stream=True, timeout=600, json={
+                'model': self.args.model, 'messages': messages, 'repo_context': repo_context}) as response:
+            response.raise_for_status()
+            result = None
+            for event, data in read_events(response):
+                if event in ('done', 'error'):
+                    result = (event, data)
+        self.timings.append(('agent', time.time() - started, response.status_code))
+        if not result or result[0] == 'error':
+            raise RuntimeError(f'agent failed: {result[1] if result else "stream ended early"}')
+
+
+def run_level(base_url, args, server_mode, concurrency, llm, github, master_pid):
+    llm.reset()
+    github.reset()
+    sessions = max(args.sessions, concurrency)
+    with MemorySampler(master_pid) as memory, ModelsProbe(base_url) as probe:
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda i: ScriptedSession(base_url, args, i).run(), range(sessions)))
+        wall = time.time() - started
+
+    ok = [result for result in results if result['ok']]
+    timings = [timing for result in results for timing in result['timings']]
+    by_kind = {}
+    for kind, seconds, _ in timings:
+        by_kind.setdefault(kind, []).append(seconds)
+    llm_stats = llm.stats()
+    github_stats = github.stats()
+    memory_report = memory.report()
+    # Each session has at most one completion in flight, so the most
+    # completions the fake LLM saw at once is how many sessions the server
+    # was actually serving concurrently rather than queueing
+    served = llm_stats['peak_in_flight']
+    return {
+        'server_mode': server_mode,
+        'concurrency': concurrency,
+        'sessions': sessions,
+        'completed': len(ok),
+        'errors': [result['error'] for result in results if not result['ok']][:10],
+        'wall_seconds': round(wall, 3),
+        'sessions_per_sec': round(len(ok) / wall, 3),
+        'requests_per_sec': round(len(timings) / wall, 3),
+        'session_seconds': percentiles([result['seconds'] for result in ok]),
+        'request_seconds': {kind: percentiles(values) for kind, values in sorted(by_kind.items())},
+        'session_resyncs': sum(1 for kind, _, status in timings if kind == 'chat' and status == 409),
+        'http_errors': sum(1 for kind, _, status in timings if status >= 300 and not (kind == 'chat' and status == 409)),
+        'llm_calls_per_session': round(llm_stats['total'] / sessions, 2),
+        'llm_prompt_kb_per_session': round(llm_stats['prompt_bytes'] / 1024 / sessions, 1),
+        'github_calls_per_session': round(github_stats['total'] / sessions, 2),
+        'models_route_seconds': percentiles(probe.seconds),
+        'peak_concurrent_upstream_calls': served,
+        'memory': memory_report,
+        'concurrent_sessions_per_gb': (round(served / (memory_report['peak_rss_mb_total'] / 1024), 1)
+                                       if memory_report['peak_rss_mb_total'] else None)
+    }
+
+
+def git_commit(directory):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app-dir', default=os.path.dirname(HERE), help='directory containing app.py')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='concurrent sessions per level')
+    parser.add_argument('--sessions', type=int, default=16, help='sessions per level (at least the concurrency)')
+    parser.add_argument('--mode', choices=['chat', 'agent'], default='chat',
+                        help='chat: browser-driven loop via /api/chat; agent: server-side loop via /api/agent')
+    parser.add_argument('--model', default='openai/gpt-oss-20b')
+    parser.add_argument('--repo', default='bench/demo', help="repository to select ('' for plain chat)")
+    parser.add_argument('--no-sessions', action='store_true', help='re-send the whole conversation every step')
+    parser.add_argument('--shared-sessions', action='store_true',
+                        help='give the workers a shared SESSION_DIR (otherwise a worker that misses a session resyncs)')
+    parser.add_argument('--server-mode', nargs='+', choices=['sync', 'threads', 'gevent'], default=['threads'],
+                        help='SERVER_MODE for gunicorn.conf.py; several run one after another for comparison')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--worker-class', help='override the gunicorn worker class')
+    parser.add_argument('--threads', type=int, help='override gunicorn threads per worker')
+    parser.add_argument('--gunicorn-arg', action='append', default=[], help='extra gunicorn argument (repeatable)')
+    parser.add_argument('--llm-latency-ms', type=float, default=200, help='fake LLM time to first token')
+    parser.add_argument('--tokens-per-sec', type=float, default=80, help='fake LLM generation speed')
+    parser.add_argument('--github-latency-ms', type=float, default=20, help='fake GitHub delay per request')
+    parser.add_argument('--files', type=int, default=200, help='files in the fake repo')
+    parser.add_argument('--output', help='results file (default bench/results/load-<time>.json)')
+    args = parser.parse_args()
+
+    llm_server, llm = fake_llm.make_server(latency=args.llm_latency_ms / 1000, tokens_per_sec=args.tokens_per_sec)
+    github_server, github = fake_github.make_server(latency=args.github_latency_ms / 1000, files=args.files)
+    llm_url = f'http://127.0.0.1:{llm_server.server_port}/v1/chat/completions'
+    env = dict(os.environ,
+               NEBIUS_API_URL=llm_url, NEBIUS_API_KEY='bench-key', OLLAMA_API_URL=llm_url,
+               GITHUB_API_URL=f'http://127.0.0.1:{github_server.server_port}', GITHUB_TOKEN='bench-token',
+               METRICS_DIR=tempfile.mkdtemp(prefix='bench-metrics-'), PYTHONUNBUFFERED='1')
+    if args.shared_sessions:
+        env['SESSION_DIR'] = tempfile.mkdtemp(prefix='bench-sessions-')
+
+    levels = []
+    for server_mode in args.server_mode:
+        process, base_url = start_app(args, env, server_mode)
+        try:
+            for concurrency in args.concurrency:
+                level = run_level(base_url, args, server_mode, concurrency, llm, github, process.pid)
+                levels.append(level)
+                chat = level['request_seconds'].get('chat') or level['request_seconds'].get('agent') or {}
+                print(f"{server_mode:>7} x{concurrency:<4} {level['completed']}/{level['sessions']} sessions, "
+                      f"{level['sessions_per_sec']:.2f} sessions/s, session p50/p95/p99 "
+                      f"{level['session_seconds']['p50']}/{level['session_seconds']['p95']}/{level['session_seconds']['p99']}s, "
+                      f"{args.mode} p95 {chat.get('p95')}s, /api/models p95 {level['models_route_seconds']['p95']}s, "
+                      f"LLM calls/session {level['llm_calls_per_session']}, "
+                      f"GitHub calls/session {level['github_calls_per_session']}, resyncs {level['session_resyncs']}, "
+                      f"served at once {level['peak_concurrent_upstream_calls']}, "
+                      f"peak RSS/worker {level['memory']['peak_rss_mb_avg']} MB, "
+                      f"sessions/GB {level['concurrent_sessions_per_gb']}")
+                for error in level['errors'][:3]:
+                    print(f'    error: {error}')
+        finally:
+            process.terminate()
+            process.wait(timeout=150)
+
+    results = {
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'app_commit': git_commit(args.app_dir),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'levels': levels
+    }
+    output = args.output or os.path.join(HERE, 'results', f"load-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# Gunicorn settings, read automatically when gunicorn starts in this directory.
+# Command-line flags (e.g. in the Procfile) still take precedence.
+#
+# SERVER_MODE chooses how a worker waits on slow upstream calls. An LLM call
+# can take up to two minutes, and most of that time is spent waiting on the
+# socket:
+#   threads (default)  gthread workers; each serves GUNICORN_THREADS requests at once
+#   gevent             greenlet workers; each serves GUNICORN_CONNECTIONS requests at once
+#                      (needs `pip install gevent`)
+#   sync               one request per worker process, as before
+# The number of worker processes comes from WEB_CONCURRENCY or --workers.
+import os
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threads')
+
+timeout = 600
+# Give streams in progress time to finish on restarts
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '120'))
+
+if SERVER_MODE == 'threads':
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', '64'))
+elif SERVER_MODE == 'gevent':
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        raise RuntimeError("SERVER_MODE=gevent needs gevent installed (pip install gevent)")
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', '1000'))
+elif SERVER_MODE != 'sync':
+    raise RuntimeError(f"Unknown SERVER_MODE {SERVER_MODE!r}; use threads, gevent or sync")